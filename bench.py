@@ -0,0 +1,308 @@
+"""Load test gem.py against mock_gemini.py, with no Gemini quota spent.
+
+    python bench.py --history-sizes 1000,10000,100000 --requests 200 --concurrency 16
+    python bench.py --output before.json
+    python bench.py --output after.json --compare before.json
+
+For each history size a fresh working directory is seeded with that many
+history entries, the mock and the app are started as separate processes, and
+every scenario is run against them in turn. Latency percentiles, requests per
+second and the app's resident memory are printed and written as JSON.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from history_store import SQLiteHistoryStore
+from mock_gemini import make_png
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("generate", "edit", "chat", "history", "search")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def seed_history(db_path, count):
+    store = SQLiteHistoryStore(db_path)
+    store.set_meta("json_migrated", "bench")
+    types = ("generate", "edit", "chat")
+    start = time.time() - count
+    batch = []
+    for i in range(count):
+        entry_type = types[i % len(types)]
+        entry = {
+            "id": str(uuid.uuid4()),
+            "timestamp": datetime.datetime.fromtimestamp(start + i).isoformat(),
+            "type": entry_type,
+            "prompt": f"benchmark prompt {i} about a {('red', 'green', 'blue')[i % 3]} bicycle",
+            "response_text": "Here is your image.",
+            "created_at": start + i,
+        }
+        if entry_type != "chat":
+            entry["image_path"] = f"/images/{uuid.uuid4().hex}.png"
+        batch.append(entry)
+        if len(batch) >= 5000:
+            store.add_many(batch)
+            batch = []
+    if batch:
+        store.add_many(batch)
+
+
+def start_process(args, cwd, env, log_path):
+    log = open(log_path, "wb")
+    return subprocess.Popen(args, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_until_up(client, url, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode} before it was ready")
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def run_scenario(client, base_url, name, total, concurrency, context, pid):
+    upload = context["upload"]
+    counter = iter(range(total))
+    latencies = []
+    statuses = {}
+    peak_rss = [rss_mb(pid)]
+
+    def make_request(i):
+        if name == "generate":
+            return client.post(f"{base_url}/generate-image/", data={"prompt": f"a bicycle number {i}", "fresh": "true"})
+        if name == "edit":
+            return client.post(
+                f"{base_url}/edit-image/",
+                data={"prompt": f"paint it colour {i}"},
+                files={"image": ("input.png", upload, "image/png")}
+            )
+        if name == "chat":
+            return client.post(
+                f"{base_url}/chat-with-image/",
+                data={"prompt": f"what is in this picture? ({i})", "image_url": context["image_url"], "fresh": "true"}
+            )
+        if name == "search":
+            query = ("red bicycle", "green", f"prompt {i}")[i % 3]
+            return client.get(f"{base_url}/search-history", params={"q": query, "limit": 20})
+        return client.get(f"{base_url}/get-full-history", params={"limit": 50})
+
+    async def worker():
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                response = await make_request(i)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    async def sample_rss():
+        while True:
+            await asyncio.sleep(0.2)
+            peak_rss.append(rss_mb(pid))
+
+    sampler = asyncio.create_task(sample_rss())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+
+    latencies.sort()
+    samples = [value for value in peak_rss if value is not None]
+    return {
+        "requests": total,
+        "errors": sum(count for status, count in statuses.items() if status != "200"),
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "rps": round(total / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2),
+        },
+        "rss_mb_peak": round(max(samples), 1) if samples else None,
+    }
+
+
+async def run_size(history_size, args):
+    workdir = tempfile.mkdtemp(prefix=f"gem-bench-{history_size}-")
+    os.symlink(os.path.join(ROOT, "static"), os.path.join(workdir, "static"))
+    seed_started = time.perf_counter()
+    seed_history(os.path.join(workdir, "history.db"), history_size)
+    seed_seconds = time.perf_counter() - seed_started
+
+    mock_port = free_port()
+    app_port = free_port()
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "GEMINI_API_KEY": "bench",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{mock_port}",
+        "GEMINI_MAX_CONCURRENCY": str(args.concurrency),
+        "GEMINI_MAX_QUEUE": str(args.concurrency * 4),
+        "LOG_LEVEL": "WARNING",
+    }
+    mock = start_process(
+        [sys.executable, os.path.join(ROOT, "mock_gemini.py"), "--port", str(mock_port),
+         "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate)],
+        workdir, env, os.path.join(workdir, "mock.log")
+    )
+    app = start_process(
+        [sys.executable, "-m", "uvicorn", "gem:app", "--port", str(app_port), "--log-level", "warning"],
+        workdir, env, os.path.join(workdir, "app.log")
+    )
+    base_url = f"http://127.0.0.1:{app_port}"
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(timeout=120.0, limits=limits) as client:
+            await wait_until_up(client, f"http://127.0.0.1:{mock_port}/stats", mock)
+            await wait_until_up(client, f"{base_url}/", app)
+
+            # A stored image for the chat scenario, and bytes for the edit uploads
+            warmup = await client.post(f"{base_url}/generate-image/", data={"prompt": "benchmark warm-up"})
+            warmup.raise_for_status()
+            context = {
+                "image_url": warmup.json()["image_url"],
+                "upload": make_png(args.upload_size, args.upload_size, "bench-upload"),
+            }
+
+            result = {
+                "history_size": history_size,
+                "seed_seconds": round(seed_seconds, 2),
+                "rss_mb_idle": rss_mb(app.pid),
+                "scenarios": {},
+            }
+            for name in args.scenarios:
+                stats = await run_scenario(client, base_url, name, args.requests, args.concurrency, context, app.pid)
+                result["scenarios"][name] = stats
+                latency = stats["latency_ms"]
+                print(
+                    f"{history_size:>7} {name:<8} {stats['rps']:>8.1f} rps  "
+                    f"p50 {latency['p50']:>8.1f}ms  p95 {latency['p95']:>8.1f}ms  p99 {latency['p99']:>8.1f}ms  "
+                    f"errors {stats['errors']:>4}  rss {stats['rss_mb_peak']} MB",
+                    flush=True
+                )
+            result["rss_mb_end"] = rss_mb(app.pid)
+            return result
+    finally:
+        for process in (app, mock):
+            process.terminate()
+        for process in (app, mock):
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        print(f"Logs for history size {history_size} are in {workdir}", flush=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline):
+    """Print p95 latency and throughput changes against an earlier results file."""
+    previous = {run["history_size"]: run["scenarios"] for run in baseline["runs"]}
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    for run in current["runs"]:
+        for name, stats in run["scenarios"].items():
+            before = previous.get(run["history_size"], {}).get(name)
+            if before is None:
+                continue
+            p95_change = (stats["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1) * 100
+            rps_change = (stats["rps"] / before["rps"] - 1) * 100
+            print(f"{run['history_size']:>7} {name:<8} p95 {p95_change:+6.1f}%  rps {rps_change:+6.1f}%")
+
+
+async def main(args):
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+            "upload_size": args.upload_size,
+            "scenarios": list(args.scenarios),
+        },
+        "runs": [],
+    }
+    for history_size in args.history_sizes:
+        results["runs"].append(await run_size(history_size, args))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark gem.py against a local Gemini stand-in")
+    parser.add_argument("--history-sizes", default="1000,10000,100000", help="comma-separated entry counts to seed")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="+/- seconds of mock latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of mock calls that fail")
+    parser.add_argument("--upload-size", type=int, default=1024, help="width and height of the edit upload")
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+    args.history_sizes = [int(size) for size in args.history_sizes.split(",") if size]
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    asyncio.run(main(args))
@@ -0,0 +1,112 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class ChatSession:
+    """One conversation about one image.
+
+    ``image_part`` is whatever the model is sent for the image on the first
+    turn (a file reference when the upload worked, inline bytes otherwise);
+    ``contents`` is the conversation so far, replayed on every turn. A
+    turn's question and answer are appended together once the answer is
+    complete, so overlapping turns never interleave half-finished exchanges.
+    """
+
+    def __init__(self, image_name, image_url, image_part, file_name=None):
+        self.id = str(uuid.uuid4())
+        self.image_name = image_name
+        self.image_url = image_url
+        self.image_part = image_part
+        self.file_name = file_name
+        self.contents = []
+        self.turns = []
+        self.history_entry = None
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    def summary(self):
+        return {
+            "session_id": self.id,
+            "image_url": self.image_url,
+            "uploaded": self.file_name is not None,
+            "created_at": self.created_at,
+            "last_used": self.last_used,
+            "turns": self.turns,
+        }
+
+
+class ChatSessionStore:
+    """Live chat sessions, evicted when idle for ``ttl`` seconds or beyond ``max_sessions``.
+
+    ``on_evict(session)`` is called for every session that is dropped, so
+    the caller can release what the session holds (e.g. an uploaded file).
+    """
+
+    def __init__(self, max_sessions=256, ttl=1800, on_evict=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self.created = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _drop(self, session):
+        if self.on_evict is not None:
+            self.on_evict(session)
+
+    def _expire(self, now):
+        dropped = []
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.ttl:
+                break
+            del self._sessions[session.id]
+            self.expirations += 1
+            dropped.append(session)
+        return dropped
+
+    def add(self, session):
+        with self._lock:
+            dropped = self._expire(time.time())
+            self._sessions[session.id] = session
+            self.created += 1
+            while len(self._sessions) > self.max_sessions:
+                dropped.append(self._sessions.popitem(last=False)[1])
+                self.evictions += 1
+        for old in dropped:
+            self._drop(old)
+        return session
+
+    def get(self, session_id):
+        now = time.time()
+        with self._lock:
+            dropped = self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = now
+                self._sessions.move_to_end(session_id)
+        for old in dropped:
+            self._drop(old)
+        return session
+
+    def remove(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._drop(session)
+        return session
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl": self.ttl,
+                "created": self.created,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
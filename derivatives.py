@@ -0,0 +1,148 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from response_cache import SingleFlight
+
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+}
+
+DERIVATIVE_WIDTHS = (64, 128, 256, 512, 1024)
+
+
+def render_derivative(source_bytes, width, fmt):
+    """Resize to ``width`` (never upscaling) and encode as ``fmt``. Runs in a worker process."""
+    pil_format = DERIVATIVE_FORMATS[fmt][0]
+    with Image.open(BytesIO(source_bytes)) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (width, img.height))
+        img.thumbnail((width, img.height), Image.LANCZOS)
+        if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = BytesIO()
+        img.save(out, format=pil_format, quality=80)
+        return out.getvalue()
+
+
+class DerivativeCache:
+    """On-disk cache of resized image variants with an LRU size budget.
+
+    Files are named after the source image and the rendering parameters, so
+    a content-addressed source always maps to the same derivative. Rendering
+    happens in a process pool to keep Pillow off the event loop. Its workers
+    are spawned, not forked, since a fork of the threaded server can inherit
+    locks held by other threads; call ``start`` before serving requests.
+    """
+
+    def __init__(self, directory, max_bytes, workers=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = workers
+        os.makedirs(directory, exist_ok=True)
+        self._executor = None
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        entries = []
+        for name in os.listdir(directory):
+            if name.startswith("."):
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._bytes += size
+
+    def _name(self, source_name, width, fmt):
+        return f"{os.path.splitext(source_name)[0]}_w{width}.{fmt}"
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _executor_for(self):
+        self.start()
+        return self._executor
+
+    def _store(self, name, path, data):
+        tmp_path = os.path.join(self.directory, f".tmp-{uuid.uuid4()}")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._remember(name, len(data))
+
+    def _remember(self, name, size):
+        with self._lock:
+            if name in self._files:
+                self._bytes -= self._files.pop(name)
+            self._files[name] = size
+            self._bytes += size
+            evicted = []
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old_name, old_size = self._files.popitem(last=False)
+                self._bytes -= old_size
+                evicted.append(old_name)
+                self.evictions += 1
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except FileNotFoundError:
+                pass
+
+    async def get(self, source_name, width, fmt, read_source):
+        """Return the path of the derivative, rendering it first if needed.
+
+        ``read_source`` is called (synchronously) only on a cache miss and
+        must return the source image bytes.
+        """
+        name = self._name(source_name, width, fmt)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            cached = name in self._files and os.path.exists(path)
+            if cached:
+                self._files.move_to_end(name)
+                self.hits += 1
+        if cached:
+            return path
+
+        async def render():
+            source_bytes = await asyncio.to_thread(read_source)
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(self._executor_for(), render_derivative, source_bytes, width, fmt)
+            await asyncio.to_thread(self._store, name, path, data)
+            return path
+
+        with self._lock:
+            self.misses += 1
+        return await self._flights.do(name, render)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -1,23 +1,59 @@
-from fastapi import FastAPI, File, Form, UploadFile
-from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
+from fastapi import FastAPI, File, Form, UploadFile, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, FileResponse, HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from google import genai
+from pydantic import BaseModel
+from typing import List, Optional
+from contextlib import asynccontextmanager
 from google.genai import types
 from PIL import Image
 from io import BytesIO
+from email.utils import formatdate, parsedate_to_datetime
 from dotenv import load_dotenv
+from history_store import open_history_store, parse_cursor, format_cursor, cursor_key
+from image_store import open_image_store, is_content_addressed, mime_type_for, ImageRejectedError
+from response_cache import ResponseCache, SingleFlight, make_cache_key
+from jobs import JobQueue, JobQueueFullError, TERMINAL_STATUSES
+from upstream import GeminiUpstream, GeminiBusyError, CircuitOpenError, parse_model_timeouts
+from derivatives import DerivativeCache, DERIVATIVE_FORMATS, DERIVATIVE_WIDTHS
+from retention import RetentionService
+from write_behind import WriteBehind
+from image_index import ImageIndex
+from chat_sessions import ChatSession, ChatSessionStore
+from shared_state import RedisCacheTier, open_lock, open_rate_limiter, redis_client
+from observability import MetricsMiddleware, configure_logging, registry, timed
 import base64
 import os
 import uuid
-import shutil
 import datetime
 import json
 import time
+import asyncio
+import hashlib
+import logging
 
 load_dotenv()
 
-app = FastAPI()
+configure_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "text"))
+logger = logging.getLogger("gem")
+
+@asynccontextmanager
+async def lifespan(app):
+    derivative_cache.start()
+    await write_behind.start()
+    await upstream.start()
+    await job_queue.start()
+    await retention.start()
+    await image_index.start()
+    yield
+    await image_index.stop()
+    await retention.stop()
+    await job_queue.stop()
+    await write_behind.stop()
+    derivative_cache.shutdown()
+    await upstream.close()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,6 +63,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 TEMP_DIR = "temp_images"
@@ -42,17 +80,195 @@ os.makedirs(PROMPTS_DIR, exist_ok=True)
 
 app.mount("/prompts", StaticFiles(directory=PROMPTS_DIR), name="prompts")
 
+# "local" shares state between workers on one machine through SQLite files; "redis" across machines
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local")
+shared_redis = redis_client(os.getenv("REDIS_URL", "redis://localhost:6379/0")) if STATE_BACKEND == "redis" else None
+
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "redis" if STATE_BACKEND == "redis" else "sqlite")
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "history.db")
+history_store = open_history_store(HISTORY_BACKEND, HISTORY_DB_PATH, PROMPTS_DIR, redis=shared_redis)
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+HISTORY_TYPES = ("generate", "edit", "chat")
+SEARCH_PAGE_SIZE = 20
+SIMILAR_PROMPT_THRESHOLD = float(os.getenv("SIMILAR_PROMPT_THRESHOLD", "0.6"))
+
+def parse_history_types(value):
+    entry_types = [t.strip() for t in value.split(",") if t.strip()] if value else None
+    if entry_types and any(t not in HISTORY_TYPES for t in entry_types):
+        raise ValueError(f"type must be one of: {', '.join(HISTORY_TYPES)}")
+    return entry_types
+
 API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=API_KEY)
 
-app.mount("/images", StaticFiles(directory=TEMP_DIR), name="images")
+IMAGE_MODEL = "gemini-2.0-flash-exp-image-generation"
+CHAT_MODEL = "gemini-1.5-flash-latest"
+
+upstream = GeminiUpstream(
+    API_KEY,
+    base_url=os.getenv("GEMINI_BASE_URL") or None,
+    max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+    max_queue=int(os.getenv("GEMINI_MAX_QUEUE", "32")),
+    max_connections=int(os.getenv("GEMINI_MAX_CONNECTIONS", "20")),
+    max_keepalive_connections=int(os.getenv("GEMINI_MAX_KEEPALIVE", "10")),
+    http2=os.getenv("GEMINI_HTTP2", "false").lower() in ("1", "true", "yes"),
+    default_timeout=float(os.getenv("GEMINI_TIMEOUT", "60")),
+    model_timeouts=parse_model_timeouts(os.getenv("GEMINI_MODEL_TIMEOUTS", f"{IMAGE_MODEL}=120,{CHAT_MODEL}=30")),
+    max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "2")),
+    breaker_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5")),
+    breaker_reset=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+    rate_limiter=open_rate_limiter(
+        STATE_BACKEND,
+        int(os.getenv("GEMINI_RATE_LIMIT", "0")),
+        window=float(os.getenv("GEMINI_RATE_WINDOW", "60")),
+        sqlite_path=os.getenv("RATE_LIMIT_DB_PATH", "rate_limit.db"),
+        redis=shared_redis
+    ),
+    rate_limit_max_wait=float(os.getenv("GEMINI_RATE_LIMIT_MAX_WAIT", "5"))
+)
+
+def busy_response(error):
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": str(getattr(error, "retry_after", 1))},
+        content={"success": False, "message": str(error)}
+    )
+
+IMAGE_BACKEND = os.getenv("IMAGE_BACKEND", "local")
+IMAGE_INDEX_PATH = os.getenv("IMAGE_INDEX_PATH", "image_index.db")
+IMAGE_S3_PUBLIC_URL = os.getenv("IMAGE_S3_PUBLIC_URL") or None
+IMAGE_S3_URL_EXPIRY = int(os.getenv("IMAGE_S3_URL_EXPIRY", "3600"))
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", str(40_000_000)))
+MODEL_INPUT_MAX_DIMENSION = int(os.getenv("MODEL_INPUT_MAX_DIMENSION", "2048"))
+
+derivative_cache = DerivativeCache(
+    os.getenv("DERIVATIVE_DIR", "image_derivatives"),
+    max_bytes=int(os.getenv("DERIVATIVE_CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+    workers=int(os.getenv("DERIVATIVE_WORKERS", "2"))
+)
+image_store = open_image_store(
+    IMAGE_BACKEND,
+    TEMP_DIR,
+    IMAGE_INDEX_PATH,
+    s3_bucket=os.getenv("IMAGE_S3_BUCKET"),
+    s3_prefix=os.getenv("IMAGE_S3_PREFIX", ""),
+    s3_endpoint_url=os.getenv("IMAGE_S3_ENDPOINT_URL"),
+    s3_region=os.getenv("IMAGE_S3_REGION"),
+    s3_public_url=IMAGE_S3_PUBLIC_URL,
+    s3_url_expiry=IMAGE_S3_URL_EXPIRY,
+    shard_levels=int(os.getenv("IMAGE_SHARD_LEVELS", "1"))
+)
+
+image_index = ImageIndex(
+    image_store,
+    TEMP_DIR,
+    shard_levels=getattr(image_store.backend, "shard_levels", 0),
+    poll_interval=float(os.getenv("IMAGE_INDEX_POLL_INTERVAL", "5"))
+)
+image_store.subscribe(image_index.on_change)
+
+# Images and history entries are stored by a background writer; ack says how far a write gets before the request returns
+write_behind = WriteBehind(
+    image_store,
+    history_store,
+    directory=os.getenv("WRITE_BEHIND_DIR", "write_behind"),
+    ack=os.getenv("WRITE_BEHIND_ACK", "journaled"),
+    image_ack=os.getenv("WRITE_BEHIND_IMAGE_ACK", "applied"),
+    fsync=os.getenv("WRITE_BEHIND_FSYNC", "interval"),
+    fsync_interval=float(os.getenv("WRITE_BEHIND_FSYNC_INTERVAL", "1")),
+    batch_size=int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "64")),
+    max_pending=int(os.getenv("WRITE_BEHIND_MAX_PENDING", "256")),
+    max_pending_bytes=int(os.getenv("WRITE_BEHIND_MAX_PENDING_BYTES", str(256 * 1024 * 1024)))
+)
+if write_behind.image_ack != "applied":
+    logger.warning("WRITE_BEHIND_IMAGE_ACK is not 'applied': new image URLs only work on this worker until stored")
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512")),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    ttl=int(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    disk_dir=os.getenv("RESPONSE_CACHE_DIR") or None,
+    disk_max_bytes=int(os.getenv("RESPONSE_CACHE_DISK_MAX_BYTES", str(256 * 1024 * 1024))),
+    shared=RedisCacheTier(shared_redis) if shared_redis is not None else None
+) if RESPONSE_CACHE_ENABLED else None
+
+upstream_flights = SingleFlight()
+image_decode_flights = SingleFlight()
+
+job_queue = JobQueue(
+    os.getenv("JOBS_DB_PATH", "jobs.db"),
+    workers=int(os.getenv("JOB_WORKERS", "2")),
+    max_queued=int(os.getenv("JOB_MAX_QUEUED", "100")),
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+    # An overloaded or short-circuited model is a reason to wait, not to give up on the job
+    transient_errors=(GeminiBusyError, CircuitOpenError),
+    retry_backoff=float(os.getenv("JOB_RETRY_BACKOFF", "10"))
+)
+
+def optional_number(name, cast=int):
+    value = os.getenv(name)
+    return cast(value) if value else None
+
+retention = RetentionService(
+    history_store,
+    image_store,
+    os.getenv("HISTORY_ARCHIVE_DIR", "history_archive"),
+    temp_dirs=(TEMP_DIR, derivative_cache.directory, os.getenv("RESPONSE_CACHE_DIR"), write_behind.directory),
+    legacy_image_dir=TEMP_DIR,
+    legacy_history_dir=PROMPTS_DIR,
+    max_age_days=optional_number("HISTORY_MAX_AGE_DAYS", float),
+    max_entries=optional_number("HISTORY_MAX_ENTRIES"),
+    max_image_bytes=optional_number("IMAGE_MAX_BYTES"),
+    orphan_grace=float(os.getenv("ORPHAN_GRACE_SECONDS", "86400")),
+    temp_file_max_age=float(os.getenv("TEMP_FILE_MAX_AGE", "3600")),
+    interval=float(os.getenv("RETENTION_INTERVAL", "3600")),
+    lock=open_lock(STATE_BACKEND, "retention", redis=shared_redis),
+    # Image reference counts are per machine; with shared state, check orphans against the shared history
+    verify_references=STATE_BACKEND == "redis",
+    caches=(response_cache,) if response_cache is not None else ()
+)
+
+CHAT_SESSION_UPLOAD = os.getenv("CHAT_SESSION_UPLOAD", "true").lower() in ("1", "true", "yes")
+
+# Keeps fire-and-forget cleanup tasks referenced until they finish
+background_tasks = set()
 
-def save_history_entry(entry_type, prompt, image_path=None, input_image_path=None, response_text="", additional_data=None):
+async def delete_uploaded_file(file_name):
+    try:
+        await upstream.delete_file(file_name)
+    except Exception as e:
+        logger.warning(f"Could not delete uploaded file {file_name}: {e}")
+
+def release_chat_session(session):
+    if session.file_name is None:
+        return
+    try:
+        task = asyncio.get_running_loop().create_task(delete_uploaded_file(session.file_name))
+    except RuntimeError:
+        return
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+chat_sessions = ChatSessionStore(
+    max_sessions=int(os.getenv("CHAT_SESSION_MAX", "256")),
+    ttl=float(os.getenv("CHAT_SESSION_TTL", "1800")),
+    on_evict=release_chat_session
+)
+
+registry.gauge("chat_sessions", "Live chat sessions", lambda: chat_sessions.stats()["sessions"])
+registry.gauge("gemini_in_flight", "Gemini calls currently running", lambda: upstream.in_flight)
+registry.gauge("gemini_waiting", "Gemini calls waiting for a concurrency slot", lambda: upstream.waiting)
+registry.gauge("jobs_queued", "Jobs waiting for a worker", job_queue.queued_count)
+registry.gauge("write_behind_pending", "Image and history writes waiting to be stored", lambda: write_behind.pending)
+
+def build_history_entry(entry_type, prompt, image_path=None, input_image_path=None, response_text="", additional_data=None):
     timestamp = datetime.datetime.now().isoformat()
-    entry_id = str(uuid.uuid4())
-    
     data = {
-        "id": entry_id,
+        "id": str(uuid.uuid4()),
         "timestamp": timestamp,
         "type": entry_type,
         "prompt": prompt,
@@ -60,6 +276,7 @@ def save_history_entry(entry_type, prompt, image_path=None, input_image_path=Non
         "created_at": time.time(),
     }
     
+    # The writer takes the image references when it stores the entry
     if image_path:
         data["image_path"] = image_path
     
@@ -69,20 +286,122 @@ def save_history_entry(entry_type, prompt, image_path=None, input_image_path=Non
     if additional_data:
         data.update(additional_data)
     
-    history_file = os.path.join(PROMPTS_DIR, f"{entry_type}_{entry_id}.json")
-    with open(history_file, "w") as f:
-        json.dump(data, f, indent=2)
+    return data
+
+async def save_history_entry(entry_type, prompt, image_path=None, input_image_path=None, response_text="", additional_data=None):
+    data = build_history_entry(entry_type, prompt, image_path, input_image_path, response_text, additional_data)
+    with timed("history"):
+        await write_behind.add_history([data])
+    return data["id"]
+
+def decode_image_data(image_data):
+    if isinstance(image_data, bytes):
+        return image_data
+    return base64.b64decode(image_data)
+
+def image_meta(record):
+    return {
+        "size": record["size"],
+        "width": record["width"],
+        "height": record["height"],
+        "sha256": record["sha256"],
+        "mime_type": record["mime_type"]
+    }
+
+async def save_image_bytes(image_bytes):
+    with timed("save"):
+        record = await write_behind.submit_image(image_bytes)
+    logger.info(f"Image queued as {record['filename']}, serving at URL: {record['url']}")
+    return {"image_url": record["url"], "image": image_meta(record)}
+
+async def resolve_image_name(image_url=None, image_id=None):
+    def resolve():
+        if image_url:
+            filename = os.path.basename(image_url.split("?", 1)[0])
+        elif image_id:
+            filename = os.path.basename(image_id)
+            if not os.path.splitext(filename)[1]:
+                # Stored images keep their real extension, so look the hash up; only legacy uuid names are always .png
+                record = image_store.get_record(filename) if is_content_addressed(filename) else None
+                filename = record["filename"] if record else f"{filename}.png"
+        else:
+            return None
+        
+        if not filename or filename.startswith("."):
+            return None
+        return filename if image_store.exists(filename) else None
     
-    return entry_id
+    # With the s3 backend the existence check is a round trip to the bucket
+    return await asyncio.to_thread(resolve)
 
-@app.post("/generate-image/")
-async def generate_image(prompt: str = Form(...)):
-    try:
-        print(f"Generating image with prompt: {prompt}")
-        contents = (prompt,)
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp-image-generation",
-            contents=contents,
+def prepare_model_image(pil_image):
+    # The model gains nothing from huge inputs; shrink them before they are re-encoded for upload
+    limit = (MODEL_INPUT_MAX_DIMENSION, MODEL_INPUT_MAX_DIMENSION)
+    if max(pil_image.size) > MODEL_INPUT_MAX_DIMENSION:
+        logger.info(f"Downscaling model input from {pil_image.size[0]}x{pil_image.size[1]}")
+        if pil_image.format == "JPEG":
+            pil_image.draft("RGB", limit)
+        pil_image.thumbnail(limit)
+    return pil_image
+
+def open_stored_image(filename):
+    with timed("decode"):
+        pil_image = prepare_model_image(Image.open(BytesIO(image_store.read(filename))))
+        pil_image.load()
+    return pil_image
+
+async def load_chat_image(image_name):
+    def load():
+        with timed("decode"):
+            image_bytes = image_store.read(image_name)
+            pil_image = prepare_model_image(Image.open(BytesIO(image_bytes)))
+            pil_image.load()
+        return hashlib.sha256(image_bytes).hexdigest(), pil_image
+    
+    return await asyncio.to_thread(load)
+
+async def image_result(response_text, saved, include_data_url=False, cached=False):
+    result = {
+        "success": True,
+        "message": response_text,
+        "image_url": saved["image_url"],
+        "image": saved["image"]
+    }
+    if cached:
+        result["cached"] = True
+    if include_data_url:
+        image_bytes = await asyncio.to_thread(image_store.read, os.path.basename(saved["image_url"]))
+        result["data_url"] = f"data:{saved['image']['mime_type']};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+    return result
+
+async def cache_lookup(cache_key, fresh=False):
+    if response_cache is None or fresh:
+        return None
+    return await response_cache.get(cache_key)
+
+async def cache_store(cache_key, value):
+    if response_cache is not None:
+        await response_cache.set(cache_key, value)
+
+async def run_image_generation(prompt, fresh=False, variant=None):
+    cache_key = make_cache_key(IMAGE_MODEL, prompt, config=["TEXT", "IMAGE"])
+    flight_key = cache_key
+    if variant is not None:
+        # Variants of one prompt are meant to differ, so they neither share calls nor use the cache
+        flight_key = f"{cache_key}:variant:{variant}"
+        fresh = True
+    
+    cached = await cache_lookup(cache_key, fresh)
+    record = image_store.get_record(cached["image_sha256"]) if cached else None
+    if record is not None:
+        logger.info("Serving generated image from response cache")
+        saved = {"image_url": record["url"], "image": image_meta(record)}
+        return {"text": cached["text"], "saved": saved, "cached": True}
+    
+    async def run_generation():
+        response = await upstream.generate_content(
+            model=IMAGE_MODEL,
+            contents=(prompt,),
             config=types.GenerateContentConfig(
                 response_modalities=['TEXT', 'IMAGE']
             )
@@ -91,100 +410,205 @@ async def generate_image(prompt: str = Form(...)):
         image_data = None
         response_text = ""
         
-        print(f"Response received, processing parts...")
+        logger.debug("Response received, processing parts...")
         for part in response.candidates[0].content.parts:
             if part.text is not None:
                 response_text += part.text
             elif part.inline_data is not None:
                 image_data = part.inline_data.data
         
-        if image_data:
-            clean_filename = f"{uuid.uuid4()}.png"
-            filepath = os.path.join(TEMP_DIR, clean_filename)
-            correct_image_url = f"/images/{clean_filename}"
+        if not image_data:
+            return {"text": response_text, "saved": None, "cached": False}
+        
+        saved = await save_image_bytes(decode_image_data(image_data))
+        if variant is None:
+            await cache_store(cache_key, {"text": response_text, "image_sha256": saved["image"]["sha256"]})
+        return {"text": response_text, "saved": saved, "cached": False}
+    
+    # Identical requests arriving while this one is in flight share its model call
+    return await upstream_flights.do(flight_key, run_generation)
 
-            print(f"Got image data, type: {type(image_data)}")
-            
-            try:
-                base64_encoded = None
-                try:
-                    if isinstance(image_data, bytes):
-                        try:
-                            base64.b64decode(image_data, validate=True)
-                            base64_encoded = image_data.decode('utf-8')
-                        except:
-                            base64_encoded = base64.b64encode(image_data).decode('utf-8')
-                except Exception as e:
-                    print(f"Base64 encoding failed: {e}")
-                
-                with open(filepath, "wb") as f:
-                    if isinstance(image_data, bytes):
-                        f.write(image_data)
-                    else:
-                        f.write(base64.b64decode(image_data))
-                
-                print(f"Image file saved at: {os.path.abspath(filepath)}")
-                print(f"Image URL will be: {correct_image_url}")
-                
-                if os.path.exists(filepath):
-                    print(f"✓ Image file exists on disk")
-                    file_size = os.path.getsize(filepath)
-                    print(f"  File size: {file_size} bytes")
-                else:
-                    print(f"✗ WARNING: Image file does not exist on disk")
-                
-                print(f"Image saved at: {filepath}, serving at URL: {correct_image_url}")
-                
-                save_history_entry(
-                    entry_type="generate",
-                    prompt=prompt,
-                    image_path=correct_image_url,
-                    response_text=response_text
-                )
-                
-                data_url = None
-                if base64_encoded:
-                    data_url = f"data:image/png;base64,{base64_encoded}"
-                
-                return {
-                    "success": True,
-                    "message": response_text,
-                    "image_url": correct_image_url,
-                    "data_url": data_url
-                }
-            except Exception as e:
-                print(f"Error processing image data: {e}")
-                with open(filepath, "wb") as f:
-                    if isinstance(image_data, bytes):
-                        f.write(image_data)
-                
-                return {
-                    "success": True,
-                    "message": f"{response_text}\n(Image saved, but could not create data URL)",
-                    "image_url": correct_image_url
-                }
+def generation_history_entry(prompt, result, additional_data=None):
+    data = {"image": result["saved"]["image"]}
+    if result["cached"]:
+        data["cached"] = True
+    if additional_data:
+        data.update(additional_data)
+    return build_history_entry(
+        entry_type="generate",
+        prompt=prompt,
+        image_path=result["saved"]["image_url"],
+        response_text=result["text"],
+        additional_data=data
+    )
+
+@app.post("/generate-image/")
+async def generate_image(prompt: str = Form(...), fresh: bool = Form(False), include_data_url: bool = False):
+    try:
+        logger.info(f"Generating image with prompt: {prompt}")
+        result = await run_image_generation(prompt, fresh)
+        
+        if result["saved"]:
+            with timed("history"):
+                await write_behind.add_history([generation_history_entry(prompt, result)])
+            return await image_result(result["text"], result["saved"], include_data_url, cached=result["cached"])
         else:
-            print("No image data found in the response")
+            logger.info("No image data found in the response")
             return JSONResponse(
                 status_code=500,
                 content={"success": False, "message": "No image was generated"}
             )
             
+    except (GeminiBusyError, CircuitOpenError) as e:
+        return busy_response(e)
     except Exception as e:
-        import traceback
-        print(f"Error generating image: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception(f"Error generating image: {str(e)}")
         return JSONResponse(
             status_code=500,
             content={"success": False, "message": f"Error generating image: {str(e)}"}
         )
 
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_MAX_PARALLELISM = int(os.getenv("BATCH_MAX_PARALLELISM", "8"))
+
+class BatchGenerateRequest(BaseModel):
+    prompts: List[str]
+    variants: int = 1
+    parallelism: Optional[int] = None
+    format: str = "ndjson"
+    fresh: bool = False
+
+def batch_event(payload, stream_format, event="item"):
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+    return json.dumps(payload) + "\n"
+
+@app.post("/generate-batch/")
+async def generate_batch(batch: BatchGenerateRequest):
+    if not batch.prompts or batch.variants < 1:
+        return JSONResponse(status_code=400, content={"success": False, "message": "Provide at least one prompt"})
+    # Checked before the items are built, so a huge variants count costs nothing
+    if len(batch.prompts) * batch.variants > BATCH_MAX_ITEMS:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "message": f"A batch may contain at most {BATCH_MAX_ITEMS} generations"}
+        )
+    items = [
+        (prompt, variant if batch.variants > 1 else None)
+        for prompt in batch.prompts
+        for variant in range(batch.variants)
+    ]
+    if batch.format not in ("ndjson", "sse"):
+        return JSONResponse(status_code=400, content={"success": False, "message": "format must be ndjson or sse"})
+    
+    batch_id = str(uuid.uuid4())
+    parallelism = max(1, min(batch.parallelism or BATCH_MAX_PARALLELISM, BATCH_MAX_PARALLELISM))
+    limiter = asyncio.Semaphore(parallelism)
+    logger.info(f"Starting batch {batch_id}: {len(items)} generations, parallelism {parallelism}")
+    
+    async def run_item(index, prompt, variant):
+        item = {"index": index, "prompt": prompt, "variant": variant}
+        async with limiter:
+            try:
+                result = await run_image_generation(prompt, batch.fresh, variant)
+            except Exception as e:
+                logger.error(f"Batch {batch_id} item {index} failed: {str(e)}")
+                return {**item, "success": False, "message": str(e)}, None
+        
+        if not result["saved"]:
+            return {**item, "success": False, "message": "No image was generated"}, None
+        
+        entry = generation_history_entry(prompt, result, {"batch_id": batch_id, "variant": variant})
+        payload = {
+            **item,
+            "success": True,
+            "message": result["text"],
+            "image_url": result["saved"]["image_url"],
+            "image": result["saved"]["image"],
+            "cached": result["cached"]
+        }
+        return payload, entry
+    
+    async def stream():
+        tasks = [asyncio.ensure_future(run_item(i, prompt, variant)) for i, (prompt, variant) in enumerate(items)]
+        entries = []
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                payload, entry = await next_done
+                if entry is not None:
+                    entries.append(entry)
+                    succeeded += 1
+                yield batch_event(payload, batch.format)
+            
+            yield batch_event(
+                {"done": True, "batch_id": batch_id, "succeeded": succeeded, "failed": len(items) - succeeded},
+                batch.format,
+                event="done"
+            )
+        finally:
+            for task in tasks:
+                task.cancel()
+            # One write for the whole batch instead of one per image
+            if entries:
+                with timed("history"):
+                    await write_behind.add_history(entries)
+            logger.info(f"Finished batch {batch_id}: {succeeded}/{len(items)} succeeded")
+    
+    media_type = "text/event-stream" if batch.format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+@app.api_route("/images/{filename}", methods=["GET", "HEAD"])
+async def serve_image(filename: str, w: int = None, fmt: str = None):
+    if os.path.basename(filename) != filename or filename.startswith("."):
+        return JSONResponse(status_code=404, content={"success": False, "message": "Image not found"})
+    if not await asyncio.to_thread(image_store.exists, filename):
+        return JSONResponse(status_code=404, content={"success": False, "message": "Image not found"})
+    
+    # Content-addressed names can never point at different bytes, so caches may keep them forever
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if is_content_addressed(filename) else "public, max-age=3600"}
+    
+    if w is not None or fmt is not None:
+        if w is not None and w not in DERIVATIVE_WIDTHS:
+            return JSONResponse(
+                status_code=400,
+                content={"success": False, "message": f"w must be one of: {', '.join(map(str, DERIVATIVE_WIDTHS))}"}
+            )
+        if fmt is not None and fmt not in DERIVATIVE_FORMATS:
+            return JSONResponse(
+                status_code=400,
+                content={"success": False, "message": f"fmt must be one of: {', '.join(DERIVATIVE_FORMATS)}"}
+            )
+        fmt = fmt or "webp"
+        path = await derivative_cache.get(
+            filename,
+            w or DERIVATIVE_WIDTHS[-1],
+            fmt,
+            lambda: image_store.read(filename)
+        )
+        return FileResponse(path, media_type=DERIVATIVE_FORMATS[fmt][1], headers=headers)
+    
+    local_path = await asyncio.to_thread(image_store.local_path, filename)
+    if local_path:
+        return FileResponse(local_path, headers=headers)
+    # Remote backends serve the bytes themselves instead of streaming them through this process
+    redirect_url = image_store.url_for(filename)
+    if redirect_url:
+        if not IMAGE_S3_PUBLIC_URL:
+            # A presigned URL expires, so the redirect must not be cached for longer than it is valid
+            headers = {"Cache-Control": f"private, max-age={IMAGE_S3_URL_EXPIRY // 2}"}
+        return RedirectResponse(redirect_url, headers=headers)
+    image_bytes = await asyncio.to_thread(image_store.read, filename)
+    return Response(content=image_bytes, media_type=mime_type_for(filename), headers=headers)
+
 @app.get("/test-image-serving")
 async def test_image_serving():
     images = []
-    for filename in os.listdir(TEMP_DIR):
-        if filename.endswith((".png", ".jpg", ".jpeg")):
-            image_path = os.path.join(TEMP_DIR, filename)
+    indexed, _ = image_index.page(limit=HISTORY_MAX_PAGE_SIZE)
+    for item in indexed:
+        filename = item["filename"]
+        image_path = image_store.local_path(filename)
+        if image_path:
             image_url = f"/images/{filename}"
             images.append({
                 "filename": filename,
@@ -216,7 +640,7 @@ async def test_image_serving():
     if not images:
         html_content += "<p class='error'>No images found in the temp_images directory.</p>"
     else:
-        html_content += f"<p>Found {len(images)} images:</p>"
+        html_content += f"<p>Showing the newest {len(images)} of {len(image_index)} images:</p>"
         for image in images:
             html_content += f"""
             <div class='image-container'>
@@ -225,7 +649,7 @@ async def test_image_serving():
                 <div class='path'>Full path: {image['full_path']}</div>
                 <div class='path'>URL path: {image['url']}</div>
                 <p>Image display test:</p>
-                <img src="{image['url']}" alt="{image['filename']}">
+                <img src="{image['url']}?w=256&fmt=webp" alt="{image['filename']}" loading="lazy">
                 <p class='loader-status' id="status-{image['filename']}">Loading...</p>
             </div>
             """
@@ -251,212 +675,325 @@ async def test_image_serving():
     
     return HTMLResponse(content=html_content)
 
-@app.post("/edit-image/")
-async def edit_image(
-    prompt: str = Form(...),
-    image: UploadFile = File(...)
-):
+class ImageEditError(Exception):
+    def __init__(self, message, status_code=500, image_url=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.image_url = image_url
+
+async def run_image_edit(prompt, input_image_name):
+    correct_input_image_url = f"/images/{input_image_name}"
+    try:
+        # Decoding a large upload takes long enough to stall every other request if done on the loop
+        pil_image = await asyncio.to_thread(open_stored_image, input_image_name)
+    except Image.DecompressionBombError as e:
+        raise ImageEditError(f"Input image is too large to process: {e}", status_code=413)
+    
+    text_input = (prompt,)
     try:
-        print(f"Editing image with prompt: {prompt}")
-        temp_image_path_filename = f"temp_{uuid.uuid4()}.png"
-        temp_image_path = os.path.join(TEMP_DIR, temp_image_path_filename)
-        with open(temp_image_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
+        response = await upstream.generate_content(
+            model=IMAGE_MODEL,
+            contents=[text_input, pil_image],
+            config=types.GenerateContentConfig(
+                response_modalities=['TEXT', 'IMAGE']
+            )
+        )
         
-        input_image_clean_filename = f"input_{uuid.uuid4()}.png"
-        input_image_path_on_disk = os.path.join(TEMP_DIR, input_image_clean_filename)
-        shutil.copy(temp_image_path, input_image_path_on_disk)
-        correct_input_image_url = f"/images/{input_image_clean_filename}"
+        logger.debug(f"API Response received: {response}")
         
-        pil_image = Image.open(temp_image_path)
+        if not hasattr(response, 'candidates') or not response.candidates:
+            raise ValueError("API response missing candidates")
+            
+        if not hasattr(response.candidates[0], 'content') or not response.candidates[0].content:
+            raise ValueError("API response missing content in first candidate")
+            
+        if not hasattr(response.candidates[0].content, 'parts') or not response.candidates[0].content.parts:
+            raise ValueError("API response missing parts in content")
+        
+        image_data = None
+        response_text = ""
+        
+        logger.debug("Edit response received, processing parts...")
+        for part in response.candidates[0].content.parts:
+            if part.text is not None:
+                response_text += part.text
+            elif part.inline_data is not None:
+                image_data = part.inline_data.data
         
-        text_input = (prompt,)
+    except GeminiBusyError:
+        raise
+    except Exception as api_error:
+        logger.error(f"Gemini API error: {str(api_error)}")
         try:
-            response = client.models.generate_content(
-                model="gemini-2.0-flash-exp-image-generation",
-                contents=[text_input, pil_image],
+            logger.info("Trying alternative model...")
+            response = await upstream.generate_content(
+                model=CHAT_MODEL,
+                contents=[
+                    {"text": f"I want to edit this image. {prompt}"}
+                ],
                 config=types.GenerateContentConfig(
-                    response_modalities=['TEXT', 'IMAGE']
+                    response_modalities=['TEXT']
                 )
             )
             
-            print(f"API Response received: {response}")
-            
-            if not hasattr(response, 'candidates') or not response.candidates:
-                raise ValueError("API response missing candidates")
-                
-            if not hasattr(response.candidates[0], 'content') or not response.candidates[0].content:
-                raise ValueError("API response missing content in first candidate")
-                
-            if not hasattr(response.candidates[0].content, 'parts') or not response.candidates[0].content.parts:
-                raise ValueError("API response missing parts in content")
-            
-            image_data = None
-            response_text = ""
+            error_message = "Sorry, image editing is currently unavailable. Please try again later."
+            if hasattr(response, 'candidates') and response.candidates and hasattr(response.candidates[0], 'content'):
+                error_message = response.candidates[0].content.parts[0].text
             
-            print(f"Edit response received, processing parts...")
-            for part in response.candidates[0].content.parts:
-                if part.text is not None:
-                    response_text += part.text
-                elif part.inline_data is not None:
-                    image_data = part.inline_data.data
+            raise ImageEditError(f"Error editing image: {error_message}", status_code=200, image_url=correct_input_image_url)
+        except ImageEditError:
+            raise
+        except Exception as fallback_error:
+            logger.error(f"Fallback API also failed: {str(fallback_error)}")
             
-        except Exception as api_error:
-            print(f"Gemini API error: {str(api_error)}")
-            try:
-                print("Trying alternative model...")
-                response = client.models.generate_content(
-                    model="gemini-1.5-flash-latest",
-                    contents=[
-                        {"text": f"I want to edit this image. {prompt}"}
-                    ],
-                    config=types.GenerateContentConfig(
-                        response_modalities=['TEXT']
-                    )
-                )
-                
-                error_message = "Sorry, image editing is currently unavailable. Please try again later."
-                if hasattr(response, 'candidates') and response.candidates and hasattr(response.candidates[0], 'content'):
-                    error_message = response.candidates[0].content.parts[0].text
-                
-                error_clean_filename = f"error_{uuid.uuid4()}.png"
-                orig_filepath = os.path.join(TEMP_DIR, error_clean_filename)
-                shutil.copy(temp_image_path, orig_filepath)
-                
-                correct_error_image_url = f"/images/{error_clean_filename}"
-                
-                return {
-                    "success": False,
-                    "message": f"Error editing image: {error_message}",
-                    "image_url": correct_error_image_url
-                }
-            except Exception as fallback_error:
-                print(f"Fallback API also failed: {str(fallback_error)}")
-                pass
-                
-            if os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-                
-            return JSONResponse(
-                status_code=500,
-                content={"success": False, "message": f"Error using AI to edit image: {str(api_error)}"}
-            )
-        
-        if os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
-        
-        if image_data:
-            output_clean_filename = f"{uuid.uuid4()}.png"
-            filepath = os.path.join(TEMP_DIR, output_clean_filename)
-            correct_output_image_url = f"/images/{output_clean_filename}"
+        raise ImageEditError(f"Error using AI to edit image: {str(api_error)}")
+    
+    if not image_data:
+        logger.info("No image data found in the edit response")
+        raise ImageEditError("No image was generated from edit")
+    
+    saved = await save_image_bytes(decode_image_data(image_data))
+    await save_history_entry(
+        entry_type="edit",
+        prompt=prompt,
+        image_path=saved["image_url"],
+        input_image_path=correct_input_image_url,
+        response_text=response_text,
+        additional_data={"image": saved["image"]}
+    )
+    return {"text": response_text, "saved": saved}
 
-            try:
-                base64_encoded = None
-                try:
-                    if isinstance(image_data, bytes):
-                        try:
-                            base64.b64decode(image_data, validate=True)
-                            base64_encoded = image_data.decode('utf-8')
-                        except:
-                            base64_encoded = base64.b64encode(image_data).decode('utf-8')
-                except Exception as e:
-                    print(f"Base64 encoding failed: {e}")
-                
-                with open(filepath, "wb") as f:
-                    if isinstance(image_data, bytes):
-                        f.write(image_data)
-                    else:
-                        f.write(base64.b64decode(image_data))
-                
-                data_url = None
-                if base64_encoded:
-                    data_url = f"data:image/png;base64,{base64_encoded}"
-                
-                print(f"Edited image saved at: {filepath}, serving at URL: {correct_output_image_url}")
-                
-                save_history_entry(
-                    entry_type="edit",
-                    prompt=prompt,
-                    image_path=correct_output_image_url,
-                    input_image_path=correct_input_image_url,
-                    response_text=response_text
-                )
-                
-                return {
-                    "success": True,
-                    "message": response_text,
-                    "image_url": correct_output_image_url,
-                    "data_url": data_url
-                }
-            except Exception as e:
-                print(f"Error processing image data: {e}")
-                with open(filepath, "wb") as f:
-                    if isinstance(image_data, bytes):
-                        f.write(image_data)
-                
-                return {
-                    "success": True,
-                    "message": f"{response_text}\n(Image saved, but could not create data URL)",
-                    "image_url": correct_output_image_url
-                }
-        else:
-            print("No image data found in the edit response")
-            return JSONResponse(
-                status_code=500,
-                content={"success": False, "message": "No image was generated from edit"}
-            )
-            
-    except Exception as e:
-        import traceback
-        print(f"Error editing image: {str(e)}")
-        print(traceback.format_exc())
-        
+async def resolve_edit_input(image, source_image_id, image_url):
+    if source_image_id or image_url:
+        input_image_name = await resolve_image_name(image_url=image_url, image_id=source_image_id)
+        if input_image_name is None:
+            raise ImageEditError("Source image not found", status_code=404)
+        return input_image_name
+    if image is not None:
         try:
-            if 'temp_image_path' in locals() and os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-        except:
-            pass
-            
+            with timed("upload"):
+                record = await image_store.ingest(image.read, UPLOAD_MAX_BYTES, UPLOAD_MAX_PIXELS, spool_dir=TEMP_DIR)
+        except ImageRejectedError as e:
+            raise ImageEditError(str(e), status_code=e.status_code)
+        return record["filename"]
+    raise ImageEditError("Provide an image upload, source_image_id or image_url", status_code=400)
+
+def image_edit_error_response(error):
+    content = {"success": False, "message": str(error)}
+    if error.image_url:
+        content["image_url"] = error.image_url
+    return JSONResponse(status_code=error.status_code, content=content)
+
+@app.post("/edit-image/")
+async def edit_image(
+    prompt: str = Form(...),
+    image: UploadFile = File(None),
+    source_image_id: str = Form(None),
+    image_url: str = Form(None),
+    include_data_url: bool = False
+):
+    try:
+        logger.info(f"Editing image with prompt: {prompt}")
+        input_image_name = await resolve_edit_input(image, source_image_id, image_url)
+        result = await run_image_edit(prompt, input_image_name)
+        return await image_result(result["text"], result["saved"], include_data_url)
+    except ImageEditError as e:
+        return image_edit_error_response(e)
+    except (GeminiBusyError, CircuitOpenError) as e:
+        return busy_response(e)
+    except Exception as e:
+        logger.exception(f"Error editing image: {str(e)}")
         return JSONResponse(
             status_code=500,
             content={"success": False, "message": f"Error editing image: {str(e)}"}
         )
 
+async def generate_job(payload):
+    result = await run_image_generation(payload["prompt"], payload.get("fresh", False))
+    if not result["saved"]:
+        raise RuntimeError("No image was generated")
+    await write_behind.add_history([generation_history_entry(payload["prompt"], result)])
+    return await image_result(result["text"], result["saved"], cached=result["cached"])
+
+async def edit_job(payload):
+    result = await run_image_edit(payload["prompt"], payload["input_image_name"])
+    return await image_result(result["text"], result["saved"])
+
+job_queue.register("generate", generate_job)
+job_queue.register("edit", edit_job)
+
+async def submit_job(kind, payload):
+    try:
+        job = await job_queue.submit(kind, payload)
+    except JobQueueFullError as e:
+        return busy_response(e)
+    return JSONResponse(
+        status_code=202,
+        content={"success": True, "job_id": job["id"], "status": job["status"], "status_url": f"/jobs/{job['id']}"}
+    )
+
+@app.post("/jobs/generate")
+async def submit_generate_job(prompt: str = Form(...), fresh: bool = Form(False)):
+    return await submit_job("generate", {"prompt": prompt, "fresh": fresh})
+
+@app.post("/jobs/edit")
+async def submit_edit_job(
+    prompt: str = Form(...),
+    image: UploadFile = File(None),
+    source_image_id: str = Form(None),
+    image_url: str = Form(None)
+):
+    try:
+        input_image_name = await resolve_edit_input(image, source_image_id, image_url)
+    except ImageEditError as e:
+        return image_edit_error_response(e)
+    return await submit_job("edit", {"prompt": prompt, "input_image_name": input_image_name})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"success": False, "message": "Job not found"})
+    return {"success": True, "job": job}
+
+@app.websocket("/jobs/{job_id}/ws")
+async def watch_job(websocket: WebSocket, job_id: str):
+    await websocket.accept()
+    queue = job_queue.watch(job_id)
+    try:
+        job = await job_queue.get(job_id)
+        if job is None:
+            await websocket.send_json({"success": False, "message": "Job not found"})
+            return
+        await websocket.send_json({"success": True, "job": job})
+        while job["status"] not in TERMINAL_STATUSES:
+            try:
+                job = await asyncio.wait_for(queue.get(), timeout=job_queue.poll_interval)
+            except asyncio.TimeoutError:
+                # Another worker process may be running the job, and only it notifies its watchers
+                latest = await job_queue.get(job_id)
+                if latest is None or latest == job:
+                    continue
+                job = latest
+            await websocket.send_json({"success": True, "job": job})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        job_queue.unwatch(job_id, queue)
+        await websocket.close()
+
+def chat_contents(prompt, pil_image):
+    return [
+        {"text": f"Based on this image, {prompt}"},
+        pil_image
+    ]
+
+def response_text_of(response):
+    text = ""
+    if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+        for part in response.candidates[0].content.parts:
+            if part.text is not None:
+                text += part.text
+    return text
+
+def sse_event(payload, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+# Proxies such as nginx would otherwise buffer the stream and defeat its purpose
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def stream_chat_reply(contents, finish):
+    """Relay a streamed chat reply as server-sent events.
+
+    ``await finish(response_text)`` runs once the reply is complete and returns
+    the payload of the closing ``done`` event.
+    """
+    chunks = upstream.generate_content_stream(model=CHAT_MODEL, contents=contents)
+    
+    # Wait for the first chunk before answering, so failures up to that point still get a proper status code
+    try:
+        first_chunk = await anext(chunks, None)
+    except (GeminiBusyError, CircuitOpenError) as e:
+        return busy_response(e)
+    except Exception as api_error:
+        logger.error(f"Gemini API error: {str(api_error)}")
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "message": f"Error chatting about image: {str(api_error)}"}
+        )
+    
+    async def relay():
+        parts = []
+        try:
+            chunk = first_chunk
+            while chunk is not None:
+                text = response_text_of(chunk)
+                if text:
+                    parts.append(text)
+                    yield sse_event({"text": text})
+                chunk = await anext(chunks, None)
+        except Exception as api_error:
+            logger.error(f"Gemini API error mid-stream: {str(api_error)}")
+            yield sse_event({"success": False, "message": f"Error chatting about image: {str(api_error)}"}, event="error")
+            return
+        finally:
+            await chunks.aclose()
+        
+        yield sse_event(await finish("".join(parts)), event="done")
+    
+    return StreamingResponse(relay(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @app.post("/chat-with-image/")
 async def chat_with_image(
     prompt: str = Form(...),
-    image_url: str = Form(...)
+    image_url: str = Form(...),
+    fresh: bool = Form(False)
 ):
     try:
-        print(f"Chatting about image with prompt: {prompt}")
+        logger.info(f"Chatting about image with prompt: {prompt}")
         
-        image_path = image_url.replace("/images/", "")
-        image_path = os.path.join(TEMP_DIR, image_path)
+        image_name = await resolve_image_name(image_url=image_url)
         
-        if not os.path.exists(image_path):
+        if image_name is None:
             return JSONResponse(
                 status_code=404,
                 content={"success": False, "message": "Image not found"}
             )
         
-        pil_image = Image.open(image_path)
+        image_sha256, pil_image = await image_decode_flights.do(image_name, lambda: load_chat_image(image_name))
+        cache_key = make_cache_key(CHAT_MODEL, prompt, image_sha256=image_sha256)
+        cached = await cache_lookup(cache_key, fresh)
+        if cached is not None:
+            logger.info("Serving chat reply from response cache")
+            await save_history_entry(
+                entry_type="chat",
+                prompt=prompt,
+                image_path=image_url,
+                response_text=cached["text"],
+                additional_data={"cached": True}
+            )
+            return {
+                "success": True,
+                "message": cached["text"],
+                "cached": True
+            }
         
-        try:
-            response = client.models.generate_content(
-                model="gemini-1.5-flash-latest",
-                contents=[
-                    {"text": f"Based on this image, {prompt}"},
-                    pil_image
-                ]
+        async def run_chat():
+            response = await upstream.generate_content(
+                model=CHAT_MODEL,
+                contents=chat_contents(prompt, pil_image)
             )
             
-            response_text = ""
-            if hasattr(response, 'candidates') and response.candidates:
-                for part in response.candidates[0].content.parts:
-                    if part.text is not None:
-                        response_text += part.text
+            response_text = response_text_of(response)
+            
+            await cache_store(cache_key, {"text": response_text})
+            return response_text
+        
+        try:
+            response_text = await upstream_flights.do(cache_key, run_chat)
             
-            save_history_entry(
+            await save_history_entry(
                 entry_type="chat",
                 prompt=prompt,
                 image_path=image_url,
@@ -468,95 +1005,408 @@ async def chat_with_image(
                 "message": response_text
             }
             
+        except (GeminiBusyError, CircuitOpenError) as e:
+            return busy_response(e)
         except Exception as api_error:
-            print(f"Gemini API error: {str(api_error)}")
+            logger.error(f"Gemini API error: {str(api_error)}")
             return JSONResponse(
                 status_code=500,
                 content={"success": False, "message": f"Error chatting about image: {str(api_error)}"}
             )
             
     except Exception as e:
-        import traceback
-        print(f"Error chatting about image: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception(f"Error chatting about image: {str(e)}")
         return JSONResponse(
             status_code=500,
             content={"success": False, "message": f"Error: {str(e)}"}
         )
 
+@app.post("/chat-with-image/stream")
+async def chat_with_image_stream(
+    prompt: str = Form(...),
+    image_url: str = Form(...),
+    fresh: bool = Form(False)
+):
+    logger.info(f"Streaming chat about image with prompt: {prompt}")
+    
+    image_name = await resolve_image_name(image_url=image_url)
+    if image_name is None:
+        return JSONResponse(
+            status_code=404,
+            content={"success": False, "message": "Image not found"}
+        )
+    
+    image_sha256, pil_image = await image_decode_flights.do(image_name, lambda: load_chat_image(image_name))
+    cache_key = make_cache_key(CHAT_MODEL, prompt, image_sha256=image_sha256)
+    cached = await cache_lookup(cache_key, fresh)
+    if cached is not None:
+        async def replay():
+            await save_history_entry(
+                entry_type="chat",
+                prompt=prompt,
+                image_path=image_url,
+                response_text=cached["text"],
+                additional_data={"cached": True}
+            )
+            yield sse_event({"text": cached["text"]})
+            yield sse_event({"success": True, "message": cached["text"], "cached": True}, event="done")
+        
+        return StreamingResponse(replay(), media_type="text/event-stream", headers=SSE_HEADERS)
+    
+    async def finish(response_text):
+        await cache_store(cache_key, {"text": response_text})
+        await save_history_entry(
+            entry_type="chat",
+            prompt=prompt,
+            image_path=image_url,
+            response_text=response_text,
+            additional_data={"streamed": True}
+        )
+        return {"success": True, "message": response_text}
+    
+    return await stream_chat_reply(chat_contents(prompt, pil_image), finish)
+
+def session_image_bytes(image_name):
+    """The image as sent to the model: stored bytes, or a downscaled copy when it is too large."""
+    with timed("decode"):
+        image_bytes = image_store.read(image_name)
+        with Image.open(BytesIO(image_bytes)) as img:
+            if max(img.size) <= MODEL_INPUT_MAX_DIMENSION:
+                return image_bytes, mime_type_for(image_name)
+            image_format = "JPEG" if img.format == "JPEG" else "PNG"
+            small = prepare_model_image(img)
+            out = BytesIO()
+            small.save(out, format=image_format)
+            return out.getvalue(), f"image/{image_format.lower()}"
+
+async def session_image_part(image_name):
+    """Upload the image once for the whole session, or fall back to sending it inline."""
+    data, mime_type = await asyncio.to_thread(session_image_bytes, image_name)
+    if CHAT_SESSION_UPLOAD:
+        try:
+            with timed("upload"):
+                uploaded = await upstream.upload_file(data, mime_type)
+            return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type or mime_type), uploaded.name
+        except GeminiBusyError:
+            raise
+        except Exception as e:
+            logger.warning(f"Files API upload failed, sending the session image inline instead: {e}")
+    return types.Part.from_bytes(data=data, mime_type=mime_type), None
+
+def session_user_content(session, prompt):
+    if not session.contents:
+        parts = [session.image_part, types.Part.from_text(text=f"Based on this image, {prompt}")]
+    else:
+        parts = [types.Part.from_text(text=prompt)]
+    return types.Content(role="user", parts=parts)
+
+async def record_session_turn(session, user_content, prompt, response_text):
+    session.contents.extend([
+        user_content,
+        types.Content(role="model", parts=[types.Part.from_text(text=response_text)])
+    ])
+    turn = {"prompt": prompt, "response_text": response_text, "created_at": time.time()}
+    session.turns.append(turn)
+    
+    # The whole transcript is one history entry, rewritten after every turn
+    if session.history_entry is None:
+        session.history_entry = build_history_entry(
+            "chat",
+            prompt,
+            image_path=session.image_url,
+            response_text=response_text,
+            additional_data={"id": session.id, "session_id": session.id}
+        )
+    entry = session.history_entry
+    entry["turns"] = session.turns
+    entry["response_text"] = response_text
+    entry["created_at"] = turn["created_at"]
+    with timed("history"):
+        await write_behind.add_history([entry])
+    return turn
+
+def session_not_found():
+    return JSONResponse(
+        status_code=404,
+        content={"success": False, "message": "Chat session not found or expired"}
+    )
+
+@app.post("/chat-sessions")
+async def create_chat_session(image_url: str = Form(...)):
+    image_name = await resolve_image_name(image_url=image_url)
+    if image_name is None:
+        return JSONResponse(
+            status_code=404,
+            content={"success": False, "message": "Image not found"}
+        )
+    try:
+        image_part, file_name = await session_image_part(image_name)
+    except (GeminiBusyError, CircuitOpenError) as e:
+        return busy_response(e)
+    
+    session = chat_sessions.add(ChatSession(image_name, f"/images/{image_name}", image_part, file_name))
+    return {"success": True, "expires_in": chat_sessions.ttl, **session.summary()}
+
+@app.get("/chat-sessions/{session_id}")
+async def get_chat_session(session_id: str):
+    session = chat_sessions.get(session_id)
+    if session is None:
+        return session_not_found()
+    return {"success": True, **session.summary()}
+
+@app.delete("/chat-sessions/{session_id}")
+async def delete_chat_session(session_id: str):
+    if chat_sessions.remove(session_id) is None:
+        return session_not_found()
+    return {"success": True}
+
+@app.post("/chat-sessions/{session_id}/turns")
+async def chat_session_turn(session_id: str, prompt: str = Form(...)):
+    session = chat_sessions.get(session_id)
+    if session is None:
+        return session_not_found()
+    
+    user_content = session_user_content(session, prompt)
+    try:
+        response = await upstream.generate_content(model=CHAT_MODEL, contents=[*session.contents, user_content])
+    except (GeminiBusyError, CircuitOpenError) as e:
+        return busy_response(e)
+    except Exception as api_error:
+        logger.error(f"Gemini API error: {str(api_error)}")
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "message": f"Error chatting about image: {str(api_error)}"}
+        )
+    
+    response_text = response_text_of(response)
+    turn = await record_session_turn(session, user_content, prompt, response_text)
+    return {"success": True, "message": response_text, "session_id": session.id, "turn": len(session.turns), **turn}
+
+@app.post("/chat-sessions/{session_id}/turns/stream")
+async def chat_session_turn_stream(session_id: str, prompt: str = Form(...)):
+    session = chat_sessions.get(session_id)
+    if session is None:
+        return session_not_found()
+    
+    user_content = session_user_content(session, prompt)
+    
+    async def finish(response_text):
+        await record_session_turn(session, user_content, prompt, response_text)
+        return {"success": True, "message": response_text, "session_id": session.id, "turn": len(session.turns)}
+    
+    return await stream_chat_reply([*session.contents, user_content], finish)
+
+@app.get("/cache-stats")
+async def cache_stats():
+    stats = {"success": True, "enabled": response_cache is not None}
+    if response_cache is not None:
+        stats.update(response_cache.stats())
+    stats["single_flight"] = upstream_flights.stats()
+    stats["upstream"] = upstream.stats()
+    stats["chat_sessions"] = chat_sessions.stats()
+    return stats
+
+@app.get("/metrics")
+async def metrics():
+    # Some gauges query SQLite, which may wait on another process's write lock
+    return Response(content=await asyncio.to_thread(registry.render), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/retention-stats")
+async def retention_stats():
+    return {"success": True, **retention.stats()}
+
+@app.get("/derivative-stats")
+async def derivative_stats():
+    return {"success": True, **derivative_cache.stats()}
+
+@app.get("/write-behind-stats")
+async def write_behind_stats():
+    return {"success": True, **write_behind.stats()}
+
 @app.get("/get-history")
-async def get_history():
+async def get_history(limit: int = HISTORY_PAGE_SIZE, before: str = None):
     try:
-        image_history = []
-        for filename in os.listdir(TEMP_DIR):
-            if filename.endswith((".png", ".jpg", ".jpeg")):
-                image_history.append({
-                    "url": f"/images/{filename}",
-                    "timestamp": os.path.getctime(os.path.join(TEMP_DIR, filename)),
-                    "filename": filename
-                })
-        
-        chat_history = []
-        if os.path.exists(HISTORY_DIR):
-            for filename in os.listdir(HISTORY_DIR):
-                if filename.endswith(".json"):
-                    try:
-                        with open(os.path.join(HISTORY_DIR, filename), "r") as f:
-                            import json
-                            chat_data = json.load(f)
-                            chat_history.append(chat_data)
-                    except Exception as e:
-                        print(f"Error reading chat history file {filename}: {str(e)}")
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        try:
+            cursor = parse_cursor(before) if before else None
+        except ValueError:
+            return JSONResponse(status_code=400, content={"success": False, "message": "before is not a valid cursor"})
+        # Writes still queued in this process would otherwise be missing from the page
+        await write_behind.barrier()
+        image_history, has_more = image_index.page(limit=limit, before=cursor)
+        chat_before = cursor_key(cursor)[0] if cursor is not None else None
+        chat_history = history_store.query(limit=limit, before=chat_before, entry_types=["chat"])
         
+        next_before = None
+        if has_more:
+            # The file name breaks ties, so images stored in the same instant are not skipped
+            next_before = f"{image_history[-1]['timestamp']!r}:{image_history[-1]['filename']}"
         return {
             "success": True,
-            "image_history": sorted(image_history, key=lambda x: x["timestamp"], reverse=True),
-            "chat_history": sorted(chat_history, key=lambda x: x["timestamp"], reverse=True) if chat_history else []
+            "image_history": image_history,
+            "chat_history": chat_history,
+            "total_images": len(image_index),
+            "has_more": has_more,
+            "next_before": next_before
         }
     except Exception as e:
-        import traceback
-        print(f"Error getting history: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception(f"Error getting history: {str(e)}")
         return JSONResponse(
             status_code=500,
             content={"success": False, "message": f"Error getting history: {str(e)}"}
         )
 
 @app.get("/get-full-history")
-async def get_full_history():
+async def get_full_history(
+    request: Request,
+    limit: int = HISTORY_PAGE_SIZE,
+    before: str = None,
+    after: str = None,
+    type: str = None,
+    q: str = None,
+    fields: str = None
+):
     try:
-        history = []
+        if limit < 1 or limit > HISTORY_MAX_PAGE_SIZE:
+            return JSONResponse(
+                status_code=400,
+                content={"success": False, "message": f"limit must be between 1 and {HISTORY_MAX_PAGE_SIZE}"}
+            )
         
-        if os.path.exists(PROMPTS_DIR):
-            for filename in os.listdir(PROMPTS_DIR):
-                if filename.endswith(".json"):
-                    try:
-                        with open(os.path.join(PROMPTS_DIR, filename), "r") as f:
-                            history.append(json.load(f))
-                    except Exception as e:
-                        print(f"Error reading history file {filename}: {str(e)}")
+        try:
+            entry_types = parse_history_types(type)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"success": False, "message": str(e)})
+        try:
+            before_cursor = parse_cursor(before) if before else None
+            after_cursor = parse_cursor(after) if after else None
+        except ValueError:
+            return JSONResponse(status_code=400, content={"success": False, "message": "before and after must be cursors"})
+        
+        await write_behind.barrier()
+        count, last_created_at = history_store.state()
+        etag_source = f"{count}:{last_created_at}:{request.url.query}"
+        etag = f'W/"{hashlib.sha1(etag_source.encode()).hexdigest()}"'
+        last_modified = formatdate(last_created_at, usegmt=True)
+        cache_headers = {"ETag": etag, "Last-Modified": last_modified, "Cache-Control": "no-cache"}
+        
+        if_none_match = request.headers.get("if-none-match")
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_none_match is not None:
+            if etag in [tag.strip() for tag in if_none_match.split(",")]:
+                return Response(status_code=304, headers=cache_headers)
+        elif if_modified_since:
+            try:
+                if int(last_created_at) <= parsedate_to_datetime(if_modified_since).timestamp():
+                    return Response(status_code=304, headers=cache_headers)
+            except (TypeError, ValueError):
+                pass
+        
+        history = history_store.query(
+            limit=limit + 1,
+            before=before_cursor,
+            after=after_cursor,
+            entry_types=entry_types,
+            prompt_contains=q
+        )
+        
+        ascending = after_cursor is not None and before_cursor is None
+        has_more = len(history) > limit
+        if has_more:
+            history = history[1:] if ascending else history[:limit]
+        
+        # Cursors carry the entry id as well, so entries created in the same instant are not skipped at a page boundary
+        next_before = format_cursor(history[-1]) if history and (has_more or ascending) else None
+        next_after = format_cursor(history[0]) if history else after
         
-        history.sort(key=lambda x: x.get("created_at", 0), reverse=True)
+        if fields:
+            wanted = [f.strip() for f in fields.split(",") if f.strip()]
+            history = [{k: entry[k] for k in wanted if k in entry} for entry in history]
         
+        return JSONResponse(
+            headers=cache_headers,
+            content={
+                "success": True,
+                "history": history,
+                "has_more": has_more,
+                "next_before": next_before,
+                "next_after": next_after
+            }
+        )
+    except Exception as e:
+        logger.exception(f"Error getting full history: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "message": f"Error getting history: {str(e)}"}
+        )
+
+@app.get("/search-history")
+async def search_history(q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0, type: str = None):
+    try:
+        if limit < 1 or limit > HISTORY_MAX_PAGE_SIZE:
+            return JSONResponse(
+                status_code=400,
+                content={"success": False, "message": f"limit must be between 1 and {HISTORY_MAX_PAGE_SIZE}"}
+            )
+        if offset < 0:
+            return JSONResponse(status_code=400, content={"success": False, "message": "offset must not be negative"})
+        try:
+            entry_types = parse_history_types(type)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"success": False, "message": str(e)})
+
+        await write_behind.barrier()
+        with timed("search"):
+            results, match_all = history_store.search(q, limit=limit + 1, offset=offset, entry_types=entry_types)
+        has_more = len(results) > limit
         return {
             "success": True,
-            "history": history
+            "query": q,
+            # "any" means nothing contained every word, so results match some of them
+            "match": "all" if match_all else "any",
+            "results": results[:limit],
+            "has_more": has_more,
+            "next_offset": offset + limit if has_more else None
         }
     except Exception as e:
-        import traceback
-        print(f"Error getting full history: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception(f"Error searching history: {str(e)}")
         return JSONResponse(
             status_code=500,
-            content={"success": False, "message": f"Error getting history: {str(e)}"}
+            content={"success": False, "message": f"Error searching history: {str(e)}"}
+        )
+
+@app.get("/similar-prompts")
+async def similar_prompts(prompt: str, limit: int = 5, threshold: float = SIMILAR_PROMPT_THRESHOLD, type: str = None):
+    try:
+        if limit < 1 or limit > HISTORY_MAX_PAGE_SIZE:
+            return JSONResponse(
+                status_code=400,
+                content={"success": False, "message": f"limit must be between 1 and {HISTORY_MAX_PAGE_SIZE}"}
+            )
+        if not 0 < threshold <= 1:
+            return JSONResponse(status_code=400, content={"success": False, "message": "threshold must be between 0 and 1"})
+        try:
+            entry_types = parse_history_types(type)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"success": False, "message": str(e)})
+
+        await write_behind.barrier()
+        with timed("search"):
+            results = history_store.similar(prompt, limit=limit, threshold=threshold, entry_types=entry_types)
+        return {"success": True, "results": results}
+    except Exception as e:
+        logger.exception(f"Error finding similar prompts: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "message": f"Error finding similar prompts: {str(e)}"}
         )
 
 @app.get("/")
 async def root():
     if os.path.exists("static/index.html"):
-        print("index.html found in static directory")
+        logger.debug("index.html found in static directory")
     else:
-        print("WARNING: index.html not found in static directory")
+        logger.warning("WARNING: index.html not found in static directory")
         
     return FileResponse("static/index.html")
 
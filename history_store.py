@@ -0,0 +1,693 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from prompt_search import band_keys, fts_query, jaccard, query_terms, shingles, term_score
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cursor(value):
+    """Read a cursor as written by ``format_cursor``; a bare ``created_at`` is accepted too."""
+    created_at, _, entry_id = value.partition(":")
+    return (float(created_at), entry_id) if entry_id else float(created_at)
+
+
+def format_cursor(entry):
+    # repr round-trips the float exactly, so the cursor lands on the same entry
+    return f"{float(entry.get('created_at', 0))!r}:{entry.get('id', '')}"
+
+
+def cursor_key(cursor):
+    """``(created_at, id)`` for a cursor; a bare ``created_at`` has no id."""
+    if isinstance(cursor, (tuple, list)):
+        return float(cursor[0]), cursor[1]
+    return cursor, None
+
+
+def past_cursor(entry, cursor, newer):
+    """Whether ``entry`` lies strictly beyond ``cursor``, towards newer entries if ``newer``, else older."""
+    created_at, entry_id = cursor_key(cursor)
+    key = (entry.get("created_at", 0), entry.get("id", ""))
+    if entry_id is None:
+        return key[0] > created_at if newer else key[0] < created_at
+    return key > (created_at, entry_id) if newer else key < (created_at, entry_id)
+
+
+class HistoryStore:
+    """Storage interface for prompt history entries.
+
+    Entries are plain dicts with at least ``id``, ``type`` and ``created_at``.
+    Listing is always newest first, and by ``id`` among entries created at
+    the same time. ``before``/``after`` are exclusive cursors: a
+    ``(created_at, id)`` pair, or a bare ``created_at``, which skips every
+    entry created at that time. With only ``after`` set, the page returned
+    is the one immediately newer than the cursor.
+    """
+
+    def add(self, entry):
+        self.add_many([entry])
+
+    def add_many(self, entries, replace=True):
+        raise NotImplementedError
+
+    def get(self, entry_id):
+        raise NotImplementedError
+
+    def existing_ids(self, entry_ids):
+        """Return the subset of ``entry_ids`` already stored."""
+        return {entry_id for entry_id in entry_ids if self.get(entry_id) is not None}
+
+    def delete_many(self, entry_ids):
+        raise NotImplementedError
+
+    def iter_entries(self, batch_size=500):
+        """Yield every entry once, in no particular order."""
+        raise NotImplementedError
+
+    def list(self, limit=None):
+        return self.query(limit=limit)
+
+    def query(self, limit=None, before=None, after=None, entry_types=None, prompt_contains=None):
+        raise NotImplementedError
+
+    def search(self, text, limit=20, offset=0, entry_types=None):
+        """Return ``(entries, match_all)``: entries matching ``text``, best first, each with a ``score``.
+
+        Entries have to contain every term; only when none do is any term
+        enough, and ``match_all`` comes back False. This version reads every
+        entry; stores with a search index override it.
+        """
+        terms = query_terms(text)
+        if not terms:
+            return [], True
+        for match_all in (True, False):
+            ranked = []
+            for entry in self.iter_entries():
+                if entry_types and entry.get("type") not in entry_types:
+                    continue
+                matched, score = term_score(entry, terms)
+                if matched == len(terms) or (matched and not match_all):
+                    ranked.append((score, entry.get("created_at", 0), entry))
+            if ranked:
+                break
+        ranked.sort(key=lambda item: item[:2], reverse=True)
+        return [dict(entry, score=score) for score, _, entry in ranked[offset:offset + limit]], match_all
+
+    def similar(self, prompt, limit=5, threshold=0.6, entry_types=None):
+        """Return entries whose prompt is a near-duplicate of ``prompt``, each with its ``similarity``."""
+        wanted = shingles(prompt)
+        return self._rank_similar(wanted, self.iter_entries(), limit, threshold, entry_types)
+
+    def _rank_similar(self, wanted, entries, limit, threshold, entry_types):
+        matches = []
+        for entry in entries:
+            if entry_types and entry.get("type") not in entry_types:
+                continue
+            similarity = jaccard(wanted, shingles(entry.get("prompt")))
+            if similarity >= threshold:
+                matches.append((similarity, entry.get("created_at", 0), entry))
+        matches.sort(key=lambda item: item[:2], reverse=True)
+        return [dict(entry, similarity=round(similarity, 3)) for similarity, _, entry in matches[:limit]]
+
+    def count(self):
+        raise NotImplementedError
+
+    def state(self):
+        """Return ``(count, newest created_at)``, used to version listings."""
+        raise NotImplementedError
+
+    def sync(self):
+        """Make every write so far survive a power cut, for stores that defer that."""
+
+    def close(self):
+        pass
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """History in one SQLite file, with a search index kept in step with every write.
+
+    ``entries_fts`` is an FTS5 table over ``prompt`` and ``response_text``
+    and ``prompt_bands`` holds each prompt's near-duplicate band keys (see
+    prompt_search); both share their entry's rowid, and are rebuilt once
+    from the entries when the index format changes. Without FTS5 in the
+    linked SQLite, search falls back to reading every entry.
+    """
+
+    SEARCH_INDEX_VERSION = "1"
+    # Only the newest entries per band are candidates, so a similarity lookup costs the same however much history there is
+    BAND_MAX_CANDIDATES = 50
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                id TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                prompt TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_created_at_id ON entries (created_at, id);
+            CREATE INDEX IF NOT EXISTS idx_entries_type_created_at_id ON entries (type, created_at, id);
+            DROP INDEX IF EXISTS idx_entries_created_at;
+            DROP INDEX IF EXISTS idx_entries_type_created_at;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS prompt_bands (
+                band INTEGER NOT NULL,
+                entry_rowid INTEGER NOT NULL,
+                PRIMARY KEY (band, entry_rowid)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_prompt_bands_entry_rowid ON prompt_bands (entry_rowid);
+        """)
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5("
+                "prompt, response_text, tokenize = 'porter unicode61 remove_diacritics 2')"
+            )
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite has no FTS5 ({e}); history search will scan every entry")
+            self.fts = False
+        self._build_search_index()
+
+    def _index(self, rowid, entry):
+        if self.fts:
+            self._conn.execute(
+                "INSERT INTO entries_fts (rowid, prompt, response_text) VALUES (?, ?, ?)",
+                (rowid, entry.get("prompt") or "", entry.get("response_text") or "")
+            )
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO prompt_bands (band, entry_rowid) VALUES (?, ?)",
+            [(band, rowid) for band in band_keys(entry.get("prompt"))]
+        )
+
+    def _unindex(self, rowid):
+        if self.fts:
+            self._conn.execute("DELETE FROM entries_fts WHERE rowid = ?", (rowid,))
+        self._conn.execute("DELETE FROM prompt_bands WHERE entry_rowid = ?", (rowid,))
+
+    def _build_search_index(self):
+        version = f"{self.SEARCH_INDEX_VERSION}:{int(self.fts)}"
+        with self._lock:
+            # BEGIN IMMEDIATE so only one of several starting processes does the rebuild
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT value FROM meta WHERE key = 'search_index'").fetchone()
+                if row and row[0] == version:
+                    self._conn.execute("COMMIT")
+                    return
+                if self.fts:
+                    self._conn.execute("DELETE FROM entries_fts")
+                self._conn.execute("DELETE FROM prompt_bands")
+                indexed = 0
+                for rowid, data in self._conn.execute("SELECT rowid, data FROM entries").fetchall():
+                    self._index(rowid, json.loads(data))
+                    indexed += 1
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('search_index', ?)", (version,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if indexed:
+            logger.info(f"Built the history search index for {indexed} entries")
+
+    def _row(self, entry):
+        return (
+            entry["id"],
+            entry.get("type", ""),
+            float(entry.get("created_at", 0)),
+            entry.get("prompt"),
+            json.dumps(entry),
+        )
+
+    def add_many(self, entries, replace=True):
+        written = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for entry in entries:
+                    row = self._row(entry)
+                    existing = self._conn.execute("SELECT rowid FROM entries WHERE id = ?", (row[0],)).fetchone()
+                    if existing is None:
+                        rowid = self._conn.execute(
+                            "INSERT INTO entries (id, type, created_at, prompt, data) VALUES (?, ?, ?, ?, ?)",
+                            row
+                        ).lastrowid
+                    elif replace:
+                        # Updating in place keeps the rowid the search index refers to
+                        rowid = existing[0]
+                        self._unindex(rowid)
+                        self._conn.execute(
+                            "UPDATE entries SET type = ?, created_at = ?, prompt = ?, data = ? WHERE rowid = ?",
+                            (*row[1:], rowid)
+                        )
+                    else:
+                        continue
+                    self._index(rowid, entry)
+                    written += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return written
+
+    def get(self, entry_id):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM entries WHERE id = ?", (entry_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def existing_ids(self, entry_ids):
+        entry_ids = list(entry_ids)
+        found = set()
+        with self._lock:
+            # Chunked to stay under SQLite's limit on bound parameters
+            for i in range(0, len(entry_ids), 500):
+                chunk = entry_ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT id FROM entries WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update(row[0] for row in rows)
+        return found
+
+    def delete_many(self, entry_ids):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                deleted = 0
+                for entry_id in entry_ids:
+                    row = self._conn.execute("SELECT rowid FROM entries WHERE id = ?", (entry_id,)).fetchone()
+                    if row is None:
+                        continue
+                    self._unindex(row[0])
+                    self._conn.execute("DELETE FROM entries WHERE rowid = ?", (row[0],))
+                    deleted += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return deleted
+
+    def iter_entries(self, batch_size=500):
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, data FROM entries WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            for _, data in rows:
+                yield json.loads(data)
+
+    def query(self, limit=None, before=None, after=None, entry_types=None, prompt_contains=None):
+        where = []
+        params = []
+        if entry_types:
+            where.append(f"type IN ({', '.join('?' * len(entry_types))})")
+            params.extend(entry_types)
+        for cursor, operator in ((before, "<"), (after, ">")):
+            if cursor is None:
+                continue
+            created_at, entry_id = cursor_key(cursor)
+            if entry_id is None:
+                where.append(f"created_at {operator} ?")
+                params.append(created_at)
+            else:
+                where.append(f"(created_at, id) {operator} (?, ?)")
+                params.extend((created_at, entry_id))
+        if prompt_contains:
+            escaped = prompt_contains.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            where.append("prompt LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+
+        ascending = after is not None and before is None
+        sql = "SELECT data FROM entries"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        direction = "ASC" if ascending else "DESC"
+        sql += f" ORDER BY created_at {direction}, id {direction}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        entries = [json.loads(row[0]) for row in rows]
+        if ascending:
+            entries.reverse()
+        return entries
+
+    def search(self, text, limit=20, offset=0, entry_types=None):
+        if not self.fts:
+            return super().search(text, limit, offset, entry_types)
+        terms = query_terms(text)
+        if not terms:
+            return [], True
+        type_filter = ""
+        if entry_types:
+            type_filter = f" AND e.type IN ({', '.join('?' * len(entry_types))})"
+        probe = (
+            "SELECT 1 FROM entries_fts JOIN entries e ON e.rowid = entries_fts.rowid "
+            f"WHERE entries_fts MATCH ?{type_filter} LIMIT 1"
+        )
+        # Every match is ranked, so any page can be reached; only the page's rows are read in full.
+        # Prompt matches weigh ten times response matches; bm25 is lower for better matches
+        sql = (
+            "SELECT e.data, ranked.rank FROM ("
+            "SELECT entries_fts.rowid AS id, bm25(entries_fts, 10.0, 1.0) AS rank, e.created_at FROM entries_fts "
+            "JOIN entries e ON e.rowid = entries_fts.rowid "
+            f"WHERE entries_fts MATCH ?{type_filter} ORDER BY rank, e.created_at DESC LIMIT ? OFFSET ?"
+            ") ranked JOIN entries e ON e.rowid = ranked.id ORDER BY ranked.rank, ranked.created_at DESC"
+        )
+        # Prefix matching is only tried when whole words find nothing, as it reads every matching word's postings
+        modes = [(True, False), (True, True)] + ([(False, False)] if len(terms) > 1 else [])
+        with self._lock:
+            # Probing from the start each time keeps every page of one search in the same mode
+            for match_all, prefix in modes:
+                expression = fts_query(terms, match_all, prefix)
+                if self._conn.execute(probe, (expression, *(entry_types or ()))).fetchone() is not None:
+                    break
+            rows = self._conn.execute(sql, (expression, *(entry_types or ()), limit, offset)).fetchall()
+        return [dict(json.loads(data), score=round(-rank, 4)) for data, rank in rows], match_all
+
+    def similar(self, prompt, limit=5, threshold=0.6, entry_types=None, max_candidates=200):
+        keys = band_keys(prompt)
+        if not keys:
+            return []
+        per_band = " UNION ALL ".join(
+            f"SELECT * FROM (SELECT entry_rowid FROM prompt_bands WHERE band = ? "
+            f"ORDER BY entry_rowid DESC LIMIT {self.BAND_MAX_CANDIDATES})"
+            for _ in keys
+        )
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT e.data FROM entries e JOIN ("
+                f"SELECT entry_rowid, COUNT(*) AS shared FROM ({per_band}) "
+                "GROUP BY entry_rowid ORDER BY shared DESC LIMIT ?"
+                ") candidates ON e.rowid = candidates.entry_rowid",
+                (*keys, max_candidates)
+            ).fetchall()
+        return self._rank_similar(shingles(prompt), (json.loads(row[0]) for row in rows), limit, threshold, entry_types)
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def state(self):
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*), MAX(created_at) FROM entries").fetchone()
+        return row[0], row[1] or 0
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def sync(self):
+        # With synchronous=NORMAL a commit reaches the WAL but is only fsynced by a checkpoint
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JSONDirHistoryStore(HistoryStore):
+    """The original layout: one pretty-printed JSON file per entry."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, entry):
+        return os.path.join(self.directory, f"{entry.get('type', 'entry')}_{entry['id']}.json")
+
+    def add_many(self, entries, replace=True):
+        for entry in entries:
+            if not replace and os.path.exists(self._path(entry)):
+                continue
+            with open(self._path(entry), "w") as f:
+                json.dump(entry, f, indent=2)
+        return len(entries)
+
+    def _load_all(self):
+        history = []
+        for entry in iter_json_entries(self.directory):
+            history.append(entry)
+        history.sort(key=lambda x: (x.get("created_at", 0), x.get("id", "")), reverse=True)
+        return history
+
+    def get(self, entry_id):
+        for entry in self._load_all():
+            if entry.get("id") == entry_id:
+                return entry
+        return None
+
+    def existing_ids(self, entry_ids):
+        # File names carry the id, so one listing answers without reading any entry
+        stored = {
+            filename[:-5].split("_", 1)[-1]
+            for filename in os.listdir(self.directory)
+            if filename.endswith(".json")
+        }
+        return stored.intersection(entry_ids)
+
+    def delete_many(self, entry_ids):
+        wanted = set(entry_ids)
+        deleted = 0
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json") and filename[:-5].split("_", 1)[-1] in wanted:
+                os.remove(os.path.join(self.directory, filename))
+                deleted += 1
+        return deleted
+
+    def iter_entries(self, batch_size=500):
+        return iter_json_entries(self.directory)
+
+    def query(self, limit=None, before=None, after=None, entry_types=None, prompt_contains=None):
+        history = self._load_all()
+        if entry_types:
+            history = [x for x in history if x.get("type") in entry_types]
+        if before is not None:
+            history = [x for x in history if past_cursor(x, before, newer=False)]
+        if after is not None:
+            history = [x for x in history if past_cursor(x, after, newer=True)]
+        if prompt_contains:
+            needle = prompt_contains.lower()
+            history = [x for x in history if needle in (x.get("prompt") or "").lower()]
+        if limit is not None:
+            history = history[-limit:] if after is not None and before is None else history[:limit]
+        return history
+
+    def count(self):
+        return sum(1 for filename in os.listdir(self.directory) if filename.endswith(".json"))
+
+    def state(self):
+        history = self._load_all()
+        return len(history), history[0].get("created_at", 0) if history else 0
+
+
+class RedisHistoryStore(HistoryStore):
+    """History in Redis, so several app processes or hosts share one history.
+
+    Each entry is a JSON string under ``entry:<id>``; sorted sets keyed by
+    ``created_at`` index all entries and the entries of each type.
+    """
+
+    def __init__(self, client, prefix="gem:history:"):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return self.prefix + ":".join(parts)
+
+    def add_many(self, entries, replace=True):
+        pipe = self.client.pipeline(transaction=False)
+        for entry in entries:
+            pipe.set(self._key("entry", entry["id"]), json.dumps(entry), nx=not replace)
+        written = pipe.execute()
+
+        pipe = self.client.pipeline(transaction=False)
+        for entry, was_written in zip(entries, written):
+            if not was_written:
+                continue
+            score = float(entry.get("created_at", 0))
+            pipe.zadd(self._key("by_time"), {entry["id"]: score})
+            pipe.zadd(self._key("type", entry.get("type", "")), {entry["id"]: score})
+        pipe.execute()
+        return sum(1 for was_written in written if was_written)
+
+    def _load(self, entry_ids):
+        if not entry_ids:
+            return []
+        return [json.loads(data) for data in self.client.mget([self._key("entry", i) for i in entry_ids]) if data]
+
+    def get(self, entry_id):
+        data = self.client.get(self._key("entry", entry_id))
+        return json.loads(data) if data else None
+
+    def existing_ids(self, entry_ids):
+        entry_ids = list(entry_ids)
+        if not entry_ids:
+            return set()
+        found = self.client.mget([self._key("entry", i) for i in entry_ids])
+        return {entry_id for entry_id, data in zip(entry_ids, found) if data}
+
+    def delete_many(self, entry_ids):
+        entries = self._load(list(entry_ids))
+        if not entries:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        for entry in entries:
+            pipe.delete(self._key("entry", entry["id"]))
+            pipe.zrem(self._key("by_time"), entry["id"])
+            pipe.zrem(self._key("type", entry.get("type", "")), entry["id"])
+        pipe.execute()
+        return len(entries)
+
+    def iter_entries(self, batch_size=500):
+        start = 0
+        while True:
+            entry_ids = self.client.zrange(self._key("by_time"), start, start + batch_size - 1)
+            if not entry_ids:
+                return
+            start += len(entry_ids)
+            yield from self._load(entry_ids)
+
+    def _bound(self, cursor, unbounded):
+        if cursor is None:
+            return unbounded
+        created_at, entry_id = cursor_key(cursor)
+        # With an id, entries at the cursor's own time may still be on the page; query() filters them
+        return f"{created_at!r}" if entry_id is not None else f"({created_at!r}"
+
+    def _page(self, key, before, after, ascending, offset, count):
+        upper = self._bound(before, "+inf")
+        lower = self._bound(after, "-inf")
+        if ascending:
+            return self.client.zrangebyscore(key, lower, upper, start=offset, num=count)
+        return self.client.zrevrangebyscore(key, upper, lower, start=offset, num=count)
+
+    def query(self, limit=None, before=None, after=None, entry_types=None, prompt_contains=None):
+        ascending = after is not None and before is None
+        if entry_types and len(entry_types) == 1:
+            key = self._key("type", entry_types[0])
+            entry_types = None
+        else:
+            key = self._key("by_time")
+        needle = prompt_contains.lower() if prompt_contains else None
+
+        # Filters Redis cannot apply are checked here, reading the index a page at a time
+        entries = []
+        offset = 0
+        page_size = max(limit or 500, 100)
+        while limit is None or len(entries) < limit:
+            entry_ids = self._page(key, before, after, ascending, offset, page_size)
+            if not entry_ids:
+                break
+            offset += len(entry_ids)
+            for entry in self._load(entry_ids):
+                if before is not None and not past_cursor(entry, before, newer=False):
+                    continue
+                if after is not None and not past_cursor(entry, after, newer=True):
+                    continue
+                if entry_types and entry.get("type") not in entry_types:
+                    continue
+                if needle and needle not in (entry.get("prompt") or "").lower():
+                    continue
+                entries.append(entry)
+        if limit is not None:
+            entries = entries[:limit]
+        if ascending:
+            entries.reverse()
+        return entries
+
+    def count(self):
+        return self.client.zcard(self._key("by_time"))
+
+    def state(self):
+        newest = self.client.zrevrange(self._key("by_time"), 0, 0, withscores=True)
+        return self.count(), newest[0][1] if newest else 0
+
+    def get_meta(self, key, default=None):
+        value = self.client.get(self._key("meta", key))
+        return value if value is not None else default
+
+    def set_meta(self, key, value):
+        self.client.set(self._key("meta", key), value)
+
+
+def iter_json_entries(directory):
+    if not os.path.exists(directory):
+        return
+    for filename in os.listdir(directory):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, filename), "r") as f:
+                entry = json.load(f)
+        except Exception as e:
+            logger.error(f"Error reading history file {filename}: {str(e)}")
+            continue
+        if isinstance(entry, dict) and entry.get("id"):
+            yield entry
+
+
+def migrate_json_dir(store, directory, batch_size=500):
+    """Copy every per-entry JSON file in ``directory`` into ``store``.
+
+    Entries already present (same id) are left untouched, so running the
+    migration twice is harmless.
+    """
+    migrated = 0
+    batch = []
+    for entry in iter_json_entries(directory):
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            migrated += store.add_many(batch, replace=False)
+            batch = []
+    if batch:
+        migrated += store.add_many(batch, replace=False)
+    return migrated
+
+
+def open_history_store(backend, db_path, json_dir, redis=None):
+    if backend in ("sqlite", "redis"):
+        store = SQLiteHistoryStore(db_path) if backend == "sqlite" else RedisHistoryStore(redis)
+        if store.get_meta("json_migrated") is None:
+            migrated = migrate_json_dir(store, json_dir)
+            store.set_meta("json_migrated", "1")
+            if migrated:
+                logger.info(f"Migrated {migrated} history entries from {json_dir} into the {backend} history store")
+        return store
+    if backend == "json":
+        return JSONDirHistoryStore(json_dir)
+    raise ValueError(f"Unknown history backend: {backend}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "migrate":
+        print("usage: python history_store.py migrate <prompt_history_dir> <history.db>")
+        sys.exit(1)
+    target = SQLiteHistoryStore(sys.argv[3])
+    count = migrate_json_dir(target, sys.argv[2])
+    target.set_meta("json_migrated", "1")
+    print(f"Migrated {count} entries into {sys.argv[3]}")
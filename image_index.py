@@ -0,0 +1,174 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+
+class ImageIndex:
+    """In-memory list of stored images, newest first, for cheap paginated listings.
+
+    It is filled once by scanning ``directory`` (and its shard directories)
+    and then kept current two ways: the image store reports every put and
+    delete through ``on_change``, and a polling watcher re-reads only the
+    directories whose mtime changed, which catches files added or removed
+    behind the store's back. Content-addressed images take their creation
+    time from the store's index; anything else falls back to the file ctime.
+    """
+
+    def __init__(self, image_store, directory, shard_levels=0, poll_interval=5.0):
+        self.image_store = image_store
+        self.directory = directory
+        self.shard_levels = shard_levels
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._keys = []
+        self._created = {}
+        self._dir_files = {}
+        self._dir_mtimes = {}
+        self._subdirs = {}
+        self._task = None
+        self.loaded = False
+
+    def _insert(self, filename, created_at, directory=None):
+        with self._lock:
+            old = self._created.get(filename)
+            if old is not None and old != created_at:
+                self._remove_key(old, filename)
+            if old != created_at:
+                bisect.insort(self._keys, (created_at, filename))
+                self._created[filename] = created_at
+            if directory is not None:
+                self._dir_files.setdefault(directory, set()).add(filename)
+
+    def _remove_key(self, created_at, filename):
+        index = bisect.bisect_left(self._keys, (created_at, filename))
+        if index < len(self._keys) and self._keys[index] == (created_at, filename):
+            del self._keys[index]
+
+    def _remove(self, filename):
+        with self._lock:
+            created_at = self._created.pop(filename, None)
+            if created_at is not None:
+                self._remove_key(created_at, filename)
+            for files in self._dir_files.values():
+                files.discard(filename)
+
+    def _directory_of(self, filename):
+        path = self.image_store.backend.local_path(filename)
+        return os.path.dirname(path) if path else None
+
+    def on_change(self, event, filename, created_at=None):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            return
+        if event == "put":
+            self._insert(filename, created_at, self._directory_of(filename))
+        elif event == "delete":
+            self._remove(filename)
+
+    def _created_at(self, filename, path):
+        record = self.image_store.get_record_by_filename(filename)
+        if record is not None:
+            return record["created_at"]
+        try:
+            return os.path.getctime(path)
+        except FileNotFoundError:
+            return None
+
+    def _scan_directory(self, directory, depth):
+        """Bring one directory's files in line with disk; return its subdirectories."""
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            with self._lock:
+                gone = self._dir_files.pop(directory, set())
+                self._dir_mtimes.pop(directory, None)
+                self._subdirs.pop(directory, None)
+            for filename in gone:
+                self._remove(filename)
+            return []
+
+        with self._lock:
+            if self._dir_mtimes.get(directory) == mtime:
+                # A file only changes its own directory's mtime, so the shard list is still valid
+                return self._subdirs.get(directory, [])
+
+        subdirs = []
+        present = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if depth < self.shard_levels:
+                        subdirs.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS) and not entry.name.startswith("."):
+                    present[entry.name] = entry.path
+
+        with self._lock:
+            known = set(self._dir_files.get(directory, ()))
+            self._dir_mtimes[directory] = mtime
+            self._subdirs[directory] = subdirs
+        for filename in known - present.keys():
+            # It may only have moved (e.g. into a shard directory); its new directory re-adds it
+            self._remove(filename)
+        for filename, path in present.items():
+            if filename in known:
+                continue
+            with self._lock:
+                created_at = self._created.get(filename)
+            if created_at is None:
+                created_at = self._created_at(filename, path)
+            if created_at is not None:
+                self._insert(filename, created_at, directory)
+        return subdirs
+
+    def refresh(self):
+        if not self.loaded and getattr(self.image_store.backend, "iter_files", None) is None:
+            # Remote backends cannot be scanned; start from the store's own index instead
+            for filename, created_at in self.image_store.iter_filenames():
+                self.on_change("put", filename, created_at)
+        pending = [(self.directory, 0)]
+        while pending:
+            directory, depth = pending.pop()
+            pending.extend((subdir, depth + 1) for subdir in self._scan_directory(directory, depth))
+        self.loaded = True
+
+    def page(self, limit=None, before=None):
+        """Return ``(items, has_more)``, newest first, strictly older than ``before``.
+
+        ``before`` is a ``(created_at, filename)`` pair, or a bare ``created_at``
+        that also skips every image created at that time.
+        """
+        key = tuple(before) if isinstance(before, (tuple, list)) else (before, "")
+        with self._lock:
+            end = len(self._keys) if before is None else bisect.bisect_left(self._keys, key)
+            start = 0 if limit is None else max(0, end - limit)
+            items = [
+                {"filename": filename, "url": f"/images/{filename}", "timestamp": created_at}
+                for created_at, filename in reversed(self._keys[start:end])
+            ]
+        return items, start > 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    async def _watch(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception:
+                logger.exception("Refreshing the image index failed")
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,634 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+FORMAT_EXTENSIONS = {
+    "PNG": ("png", "image/png"),
+    "JPEG": ("jpg", "image/jpeg"),
+    "WEBP": ("webp", "image/webp"),
+    "GIF": ("gif", "image/gif"),
+}
+
+MIME_TYPES = {ext: mime for ext, mime in FORMAT_EXTENSIONS.values()}
+MIME_TYPES["jpeg"] = "image/jpeg"
+
+
+class ImageRejectedError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_content_addressed(filename):
+    stem = os.path.splitext(filename)[0]
+    return len(stem) == 64 and all(c in "0123456789abcdef" for c in stem)
+
+
+def mime_type_for(filename):
+    return MIME_TYPES.get(os.path.splitext(filename)[1].lstrip(".").lower(), "application/octet-stream")
+
+
+def fsync_directory(path):
+    # A rename is only durable once the directory entry itself has reached the disk
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LocalImageBackend:
+    """Images as plain files under one directory.
+
+    With ``shard_levels`` set, content-addressed files live in nested
+    directories named after leading pairs of hash characters
+    (``ab/abcd....png``) so no single directory grows without bound. Files
+    still sitting at the top level are found too, until ``reshard`` moves them.
+    """
+
+    def __init__(self, directory, shard_levels=0):
+        self.directory = directory
+        self.shard_levels = shard_levels
+        os.makedirs(directory, exist_ok=True)
+
+    def _sharded_path(self, name):
+        if not self.shard_levels or not is_content_addressed(name):
+            return os.path.join(self.directory, name)
+        shards = [name[i * 2:i * 2 + 2] for i in range(self.shard_levels)]
+        return os.path.join(self.directory, *shards, name)
+
+    def local_path(self, name):
+        path = self._sharded_path(name)
+        flat_path = os.path.join(self.directory, name)
+        if path != flat_path and not os.path.isfile(path) and os.path.isfile(flat_path):
+            return flat_path
+        return path
+
+    def exists(self, name):
+        return os.path.isfile(self.local_path(name))
+
+    def url_for(self, name):
+        return None
+
+    def put(self, name, data, content_type=None, fsync=False):
+        # Write to a private temp name first so readers never see a half-written file
+        path = self._sharded_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4()}")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            if fsync:
+                fsync_directory(os.path.dirname(path))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def sync(self, names):
+        directories = set()
+        for name in names:
+            path = self._sharded_path(name)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path))
+        for directory in directories:
+            fsync_directory(directory)
+
+    def put_file(self, name, path, content_type=None):
+        target = self._sharded_path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    def get(self, name):
+        try:
+            with open(self.local_path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name):
+        try:
+            os.remove(self.local_path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def iter_files(self):
+        """Yield ``(name, path)`` for every file, at the top level and in shard directories."""
+        pending = [(self.directory, 0)]
+        while pending:
+            directory, depth = pending.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth < self.shard_levels:
+                            pending.append((entry.path, depth + 1))
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.name, entry.path
+
+    def reshard(self, limit=None):
+        """Move top-level content-addressed files into their shard directories."""
+        if not self.shard_levels:
+            return 0
+        moved = 0
+        with os.scandir(self.directory) as entries:
+            names = [entry.name for entry in entries if entry.is_file() and is_content_addressed(entry.name)]
+        for name in names:
+            if limit is not None and moved >= limit:
+                break
+            target = self._sharded_path(name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(os.path.join(self.directory, name), target)
+            moved += 1
+        return moved
+
+
+class S3ImageBackend:
+    """Images as objects in an S3 bucket.
+
+    Any S3-compatible server works through ``endpoint_url``, e.g. a local
+    MinIO at ``http://localhost:9000`` during development. Needs boto3.
+    Clients fetch images from ``public_url`` (a CDN or public bucket URL)
+    when it is set, or through presigned URLs valid for ``url_expiry``.
+    """
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, region_name=None, public_url=None, url_expiry=3600):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("The s3 image backend needs boto3: pip install boto3")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.url_expiry = url_expiry
+        self._client_error = ClientError
+        self._s3 = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region_name or None)
+
+    def _key(self, name):
+        return f"{self.prefix}{name}"
+
+    def local_path(self, name):
+        return None
+
+    def exists(self, name):
+        try:
+            self._s3.head_object(Bucket=self.bucket, Key=self._key(name))
+            return True
+        except self._client_error:
+            return False
+
+    def url_for(self, name):
+        if self.public_url:
+            return f"{self.public_url}/{self._key(name)}"
+        # Signing happens locally, without a round trip to S3
+        return self._s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._key(name)},
+            ExpiresIn=self.url_expiry
+        )
+
+    def put(self, name, data, content_type=None, fsync=False):
+        # A single PUT is atomic in S3: the object is either absent or complete
+        self._s3.put_object(
+            Bucket=self.bucket,
+            Key=self._key(name),
+            Body=data,
+            ContentType=content_type or mime_type_for(name),
+            CacheControl="public, max-age=31536000, immutable",
+        )
+
+    def put_file(self, name, path, content_type=None):
+        self._s3.upload_file(
+            path,
+            self.bucket,
+            self._key(name),
+            ExtraArgs={
+                "ContentType": content_type or mime_type_for(name),
+                "CacheControl": "public, max-age=31536000, immutable",
+            }
+        )
+        os.remove(path)
+
+    def get(self, name):
+        try:
+            return self._s3.get_object(Bucket=self.bucket, Key=self._key(name))["Body"].read()
+        except self._client_error:
+            return None
+
+    def delete(self, name):
+        self._s3.delete_object(Bucket=self.bucket, Key=self._key(name))
+        return True
+
+
+class ImageStore:
+    """Content-addressed image storage.
+
+    Every image is stored once under ``<sha256>.<ext>``; an index keeps its
+    metadata and a reference count of the history entries that use it,
+    along with which entries have taken their references.
+    Files written before the store existed (uuid names) are still readable
+    from ``legacy_dir``. Images handed to ``stage`` are readable straight
+    away, from memory, until the matching ``put`` has stored them.
+    """
+
+    def __init__(self, backend, index_path, legacy_dir=None):
+        self.backend = backend
+        self.legacy_dir = legacy_dir
+        self._listeners = []
+        self._staged = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(index_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                sha256 TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                mime_type TEXT,
+                created_at REAL NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_images_filename ON images (filename);
+            CREATE TABLE IF NOT EXISTS entry_refs (
+                entry_id TEXT PRIMARY KEY
+            ) WITHOUT ROWID;
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(images)")]
+        if "touched_at" not in columns:
+            # Last time the image was stored again or (un)referenced; orphans get a grace period from here
+            self._conn.execute("ALTER TABLE images ADD COLUMN touched_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_refcount ON images (refcount)")
+
+    def subscribe(self, callback):
+        """Call ``callback(event, filename, created_at)`` after every ``"put"`` and ``"delete"``."""
+        self._listeners.append(callback)
+
+    def _notify(self, event, filename, created_at=None):
+        for callback in self._listeners:
+            try:
+                callback(event, filename, created_at)
+            except Exception:
+                logger.exception(f"Image store listener failed on {event} of {filename}")
+
+    def _record(self, row):
+        sha256, filename, size, width, height, mime_type, created_at, refcount = row
+        return {
+            "sha256": sha256,
+            "filename": filename,
+            "url": f"/images/{filename}",
+            "size": size,
+            "width": width,
+            "height": height,
+            "mime_type": mime_type,
+            "created_at": created_at,
+            "refcount": refcount,
+        }
+
+    def _select(self, where, params):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256, filename, size, width, height, mime_type, created_at, refcount "
+                f"FROM images WHERE {where}",
+                params
+            ).fetchone()
+        return self._record(row) if row else None
+
+    def get_record(self, sha256):
+        return self._select("sha256 = ?", (sha256,))
+
+    def get_record_by_filename(self, filename):
+        return self._select("filename = ?", (filename,))
+
+    def _insert(self, sha256, filename, size, width, height, mime_type):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO images (sha256, filename, size, width, height, mime_type, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (sha256, filename, size, width, height, mime_type, time.time())
+            )
+        record = self.get_record(sha256)
+        self._notify("put", filename, record["created_at"])
+        return record
+
+    def _existing(self, sha256):
+        existing = self.get_record(sha256)
+        if existing and self.backend.exists(existing["filename"]):
+            with self._lock:
+                self._conn.execute("UPDATE images SET touched_at = ? WHERE sha256 = ?", (time.time(), sha256))
+            return existing
+        return None
+
+    def _describe(self, image_bytes):
+        width = height = None
+        ext, mime_type = FORMAT_EXTENSIONS["PNG"]
+        try:
+            with Image.open(BytesIO(image_bytes)) as img:
+                width, height = img.size
+                ext, mime_type = FORMAT_EXTENSIONS.get(img.format, (ext, mime_type))
+        except Exception as e:
+            logger.warning(f"Could not read image header: {e}")
+        return ext, mime_type, width, height
+
+    def put(self, image_bytes, fsync=False):
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+        existing = self._existing(sha256)
+        if existing:
+            return existing
+
+        ext, mime_type, width, height = self._describe(image_bytes)
+        filename = f"{sha256}.{ext}"
+        self.backend.put(filename, image_bytes, content_type=mime_type, fsync=fsync)
+        return self._insert(sha256, filename, len(image_bytes), width, height, mime_type)
+
+    def stage(self, image_bytes):
+        """Return the record ``put(image_bytes)`` will produce, without writing anything.
+
+        Until ``unstage`` is called the bytes are served from memory. Nothing
+        but the index is read, so this is cheap enough for a request handler.
+        """
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+        record = self.get_record(sha256)
+        if record is None:
+            ext, mime_type, width, height = self._describe(image_bytes)
+            record = self._record(
+                (sha256, f"{sha256}.{ext}", len(image_bytes), width, height, mime_type, time.time(), 0)
+            )
+        with self._lock:
+            staged = self._staged.setdefault(record["filename"], [image_bytes, 0])
+            staged[1] += 1
+        return record
+
+    def unstage(self, filename):
+        with self._lock:
+            staged = self._staged.get(filename)
+            if staged is not None:
+                staged[1] -= 1
+                if staged[1] <= 0:
+                    del self._staged[filename]
+
+    def _staged_bytes(self, filename):
+        with self._lock:
+            staged = self._staged.get(filename)
+        return staged[0] if staged else None
+
+    def sync(self, filenames):
+        """Force already stored images to disk, for files put without ``fsync``."""
+        sync = getattr(self.backend, "sync", None)
+        if sync is not None:
+            sync(filenames)
+
+    async def ingest(self, read_chunk, max_bytes, max_pixels, spool_dir=None, chunk_size=1024 * 1024):
+        """Store an upload read through ``await read_chunk(n)`` without holding it in memory.
+
+        The data is hashed while it is spooled to a temp file, then only the
+        image header is parsed to check format and dimensions, so oversized
+        or non-image uploads are rejected before anything decodes pixels.
+        Only the reads run on the event loop; disk and backend I/O run in
+        threads.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(prefix=".upload-", dir=spool_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                def spool(chunk):
+                    hasher.update(chunk)
+                    f.write(chunk)
+
+                while True:
+                    chunk = await read_chunk(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ImageRejectedError(f"Image is larger than {max_bytes} bytes", status_code=413)
+                    await asyncio.to_thread(spool, chunk)
+
+            if size == 0:
+                raise ImageRejectedError("Uploaded image is empty")
+
+            return await asyncio.to_thread(self._store_upload, hasher.hexdigest(), tmp_path, size, max_pixels)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _store_upload(self, sha256, tmp_path, size, max_pixels):
+        existing = self._existing(sha256)
+        if existing:
+            return existing
+
+        try:
+            with Image.open(tmp_path) as img:
+                width, height = img.size
+                image_format = img.format
+        except Image.DecompressionBombError as e:
+            raise ImageRejectedError(f"Image has too many pixels: {e}", status_code=413)
+        except Exception:
+            raise ImageRejectedError("Uploaded file is not a supported image", status_code=415)
+        if image_format not in FORMAT_EXTENSIONS:
+            raise ImageRejectedError(f"Unsupported image format: {image_format}", status_code=415)
+        if width * height > max_pixels:
+            raise ImageRejectedError(
+                f"Image is {width}x{height}, which is more than {max_pixels} pixels",
+                status_code=413
+            )
+
+        ext, mime_type = FORMAT_EXTENSIONS[image_format]
+        filename = f"{sha256}.{ext}"
+        self.backend.put_file(filename, tmp_path, content_type=mime_type)
+        return self._insert(sha256, filename, size, width, height, mime_type)
+
+    def _legacy_path(self, filename):
+        if not self.legacy_dir:
+            return None
+        path = os.path.join(self.legacy_dir, filename)
+        return path if os.path.isfile(path) else None
+
+    def exists(self, filename):
+        if self._staged_bytes(filename) is not None:
+            return True
+        return self.backend.exists(filename) or self._legacy_path(filename) is not None
+
+    def local_path(self, filename):
+        path = self.backend.local_path(filename)
+        if path and os.path.isfile(path):
+            return path
+        return self._legacy_path(filename)
+
+    def url_for(self, filename):
+        """Where clients can fetch the image without going through the app, or None."""
+        if self._staged_bytes(filename) is not None or self._legacy_path(filename) is not None:
+            return None
+        return self.backend.url_for(filename)
+
+    def read(self, filename):
+        data = self._staged_bytes(filename)
+        if data is not None:
+            return data
+        data = self.backend.get(filename)
+        if data is None:
+            path = self._legacy_path(filename)
+            if path:
+                with open(path, "rb") as f:
+                    data = f.read()
+        return data
+
+    def _adjust_ref(self, filename, delta):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE images SET refcount = MAX(refcount + ?, 0), touched_at = ? WHERE filename = ?",
+                (delta, time.time(), filename)
+            )
+            row = self._conn.execute("SELECT refcount FROM images WHERE filename = ?", (filename,)).fetchone()
+        return row[0] if row else None
+
+    def add_ref(self, filename):
+        return self._adjust_ref(filename, 1)
+
+    def release(self, filename):
+        return self._adjust_ref(filename, -1)
+
+    def _adjust_entry_refs(self, entries, taking):
+        now = time.time()
+        adjusted = 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for entry_id, filenames in entries.items():
+                    if taking:
+                        changed = self._conn.execute(
+                            "INSERT OR IGNORE INTO entry_refs (entry_id) VALUES (?)", (entry_id,)
+                        ).rowcount
+                        if not changed:
+                            continue
+                    else:
+                        # Entries from before this table existed have no row, but did take their references
+                        self._conn.execute("DELETE FROM entry_refs WHERE entry_id = ?", (entry_id,))
+                    for filename in filenames:
+                        self._conn.execute(
+                            "UPDATE images SET refcount = MAX(refcount + ?, 0), touched_at = ? WHERE filename = ?",
+                            (1 if taking else -1, now, filename)
+                        )
+                    adjusted += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return adjusted
+
+    def add_entry_refs(self, entries):
+        """Take the references of ``entries`` (``{entry_id: [filename, ...]}``), at most once per entry id.
+
+        The references and the note that they were taken commit together, so
+        a batch replayed after a crash counts each entry exactly once.
+        """
+        return self._adjust_entry_refs(entries, taking=True)
+
+    def release_entry_refs(self, entries):
+        return self._adjust_entry_refs(entries, taking=False)
+
+    def orphans(self, untouched_since, limit=None):
+        """Records no history entry references, left alone since ``untouched_since``."""
+        sql = (
+            "SELECT sha256, filename, size, width, height, mime_type, created_at, refcount FROM images "
+            "WHERE refcount = 0 AND COALESCE(touched_at, created_at) < ? ORDER BY created_at"
+        )
+        params = [untouched_since]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._record(row) for row in rows]
+
+    def iter_filenames(self, batch_size=1000):
+        """Yield ``(filename, created_at)`` for every indexed image."""
+        offset = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT filename, created_at FROM images ORDER BY rowid LIMIT ? OFFSET ?",
+                    (batch_size, offset)
+                ).fetchall()
+            if not rows:
+                return
+            offset += len(rows)
+            yield from rows
+
+    def referenced_bytes(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM images WHERE refcount > 0").fetchone()[0]
+
+    def total_bytes(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+
+    def delete(self, sha256, only_unreferenced=False):
+        record = self.get_record(sha256)
+        if record is None:
+            return False
+        with self._lock:
+            # Drop the index row first, so a reference taken meanwhile keeps the file
+            sql = "DELETE FROM images WHERE sha256 = ?" + (" AND refcount = 0" if only_unreferenced else "")
+            if self._conn.execute(sql, (sha256,)).rowcount == 0:
+                return False
+        self.backend.delete(record["filename"])
+        self._notify("delete", record["filename"])
+        return True
+
+
+def open_image_store(
+    backend,
+    directory,
+    index_path,
+    s3_bucket=None,
+    s3_prefix="",
+    s3_endpoint_url=None,
+    s3_region=None,
+    s3_public_url=None,
+    s3_url_expiry=3600,
+    shard_levels=0
+):
+    if backend == "local":
+        return ImageStore(LocalImageBackend(directory, shard_levels=shard_levels), index_path)
+    if backend == "s3":
+        if not s3_bucket:
+            raise ValueError("IMAGE_S3_BUCKET must be set for the s3 image backend")
+        return ImageStore(
+            S3ImageBackend(
+                s3_bucket,
+                prefix=s3_prefix,
+                endpoint_url=s3_endpoint_url,
+                region_name=s3_region,
+                public_url=s3_public_url,
+                url_expiry=s3_url_expiry
+            ),
+            index_path,
+            legacy_dir=directory
+        )
+    raise ValueError(f"Unknown image backend: {backend}")
@@ -0,0 +1,274 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """Persistent job queue drained by a fixed pool of asyncio workers.
+
+    Jobs live in SQLite, so queued work survives a restart and several
+    processes can share one queue. A running job's row is refreshed every
+    ``lease / 3`` seconds by the process running it; a job whose lease has
+    run out belonged to a process that died and is put back in the queue (up
+    to ``max_attempts`` tries) by whichever process notices first. Handlers are registered per job kind and receive
+    the job payload; whatever they return is stored as the job result.
+    A handler raising one of ``transient_errors`` (an overloaded upstream,
+    say) puts its job back in the queue, to run again after ``retry_backoff``
+    seconds, doubling with every attempt. Database calls run in threads, so
+    a process waiting for another one's write lock never stalls the loop.
+    """
+
+    def __init__(
+        self,
+        path,
+        workers=2,
+        max_queued=100,
+        max_attempts=3,
+        poll_interval=1.0,
+        lease=30.0,
+        transient_errors=(),
+        retry_backoff=10.0,
+        max_retry_backoff=300.0
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.transient_errors = tuple(transient_errors)
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self._handlers = {}
+        self._running = set()
+        self._watchers = {}
+        self._tasks = []
+        self._wakeup = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status_created_at ON jobs (status, created_at);
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "run_after" not in columns:
+            # A job put back after a transient failure is not claimed again before this time
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN run_after REAL")
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def _job(self, row):
+        job_id, kind, status, payload, result, error, attempts, created_at, updated_at = row
+        return {
+            "id": job_id,
+            "kind": kind,
+            "status": status,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "attempts": attempts,
+            "created_at": created_at,
+            "updated_at": updated_at,
+        }
+
+    def _get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, status, payload, result, error, attempts, created_at, updated_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        return self._job(row) if row else None
+
+    async def get(self, job_id):
+        return await asyncio.to_thread(self._get, job_id)
+
+    def queued_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def _insert(self, kind, payload):
+        if self.queued_count() >= self.max_queued:
+            raise JobQueueFullError("Too many jobs are waiting, please retry shortly")
+
+        now = time.time()
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, status, payload, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), now, now)
+            )
+        return self._get(job_id)
+
+    async def submit(self, kind, payload):
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind: {kind}")
+        job = await asyncio.to_thread(self._insert, kind, payload)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    def _claim(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT id, kind, payload, attempts FROM jobs "
+                    "WHERE status = 'queued' AND COALESCE(run_after, 0) <= ? ORDER BY created_at LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (now, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+            )
+
+    def _retry_later(self, job_id, error, delay):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', error = ?, run_after = ?, updated_at = ? WHERE id = ?",
+                (error, now + delay, now, job_id)
+            )
+
+    async def _notify(self, job_id):
+        if not self._watchers.get(job_id):
+            return
+        job = await self.get(job_id)
+        for queue in list(self._watchers.get(job_id, ())):
+            queue.put_nowait(job)
+
+    def watch(self, job_id):
+        queue = asyncio.Queue()
+        self._watchers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unwatch(self, job_id, queue):
+        watchers = self._watchers.get(job_id)
+        if watchers is not None:
+            watchers.discard(queue)
+            if not watchers:
+                del self._watchers[job_id]
+
+    def _recover(self):
+        # Running jobs whose lease ran out were left by a process that died; retry them unless they keep failing
+        now = time.time()
+        expired = now - self.lease
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Gave up after repeated restarts', updated_at = ? "
+                "WHERE status = 'running' AND updated_at < ? AND attempts >= ?",
+                (now, expired, self.max_attempts)
+            )
+            recovered = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running' AND updated_at < ?",
+                (now, expired)
+            ).rowcount
+        if recovered:
+            logger.info(f"Re-queued {recovered} jobs interrupted by a restart")
+        return recovered
+
+    def _renew(self):
+        if not self._running:
+            return
+        job_ids = list(self._running)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET updated_at = ? WHERE status = 'running' AND id IN ({', '.join('?' * len(job_ids))})",
+                (time.time(), *job_ids)
+            )
+
+    async def _keep_leases(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await asyncio.to_thread(self._renew)
+                if await asyncio.to_thread(self._recover):
+                    self._wakeup.set()
+            except Exception:
+                logger.exception("Renewing job leases failed")
+
+    async def _worker(self, number):
+        while True:
+            row = await asyncio.to_thread(self._claim)
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, kind, payload, attempts = row
+            attempts += 1
+            self._running.add(job_id)
+            await self._notify(job_id)
+            try:
+                result = await self._handlers[kind](json.loads(payload))
+                await asyncio.to_thread(self._finish, job_id, "succeeded", result=result)
+            except asyncio.CancelledError:
+                raise
+            except self.transient_errors as e:
+                if attempts >= self.max_attempts:
+                    logger.error(f"Job {job_id} ({kind}) gave up after {attempts} attempts in worker {number}: {str(e)}")
+                    await asyncio.to_thread(self._finish, job_id, "failed", error=str(e))
+                else:
+                    delay = min(
+                        max(self.retry_backoff * 2 ** (attempts - 1), getattr(e, "retry_after", 0)),
+                        self.max_retry_backoff
+                    )
+                    logger.warning(f"Job {job_id} ({kind}) will be retried in {delay:.0f}s: {str(e)}")
+                    await asyncio.to_thread(self._retry_later, job_id, str(e), delay)
+            except Exception as e:
+                logger.error(f"Job {job_id} ({kind}) failed in worker {number}: {str(e)}")
+                await asyncio.to_thread(self._finish, job_id, "failed", error=str(e))
+            finally:
+                self._running.discard(job_id)
+            await self._notify(job_id)
+
+    async def start(self):
+        await asyncio.to_thread(self._recover)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._keep_leases()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
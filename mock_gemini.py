@@ -0,0 +1,174 @@
+"""A stand-in for the Gemini API, for running gem.py without network access.
+
+    python mock_gemini.py --port 8001 --latency 0.5 --error-rate 0.1
+    GEMINI_BASE_URL=http://127.0.0.1:8001 GEMINI_API_KEY=mock uvicorn gem:app
+
+It answers generateContent and streamGenerateContent for any model with a
+canned text part, plus a generated PNG when the request asks for images.
+Files can be uploaded (the resumable protocol the SDK speaks), fetched and
+deleted, so chat sessions can reference their image by URI.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from io import BytesIO
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from PIL import Image
+
+
+def make_png(width, height, seed):
+    rng = random.Random(seed)
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    out = BytesIO()
+    Image.new("RGB", (width, height), color).save(out, format="PNG")
+    return out.getvalue()
+
+
+def create_app(latency=0.0, jitter=0.0, error_rate=0.0, error_code=503, fail_first=0, image_size=(256, 256), text="Here is your image.", seed=None):
+    app = FastAPI()
+    rng = random.Random(seed)
+    state = {"calls": 0}
+    files = {}
+
+    def wants_image(body):
+        modalities = (body.get("generationConfig") or {}).get("responseModalities") or []
+        return "IMAGE" in [m.upper() for m in modalities]
+
+    def prompt_of(body):
+        for content in body.get("contents") or []:
+            for part in content.get("parts") or []:
+                if "text" in part:
+                    return part["text"]
+        return ""
+
+    def candidate(parts):
+        return {"content": {"role": "model", "parts": parts}, "finishReason": "STOP", "index": 0}
+
+    async def before_reply():
+        state["calls"] += 1
+        delay = latency + (rng.uniform(-jitter, jitter) if jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if state["calls"] <= fail_first or rng.random() < error_rate:
+            return JSONResponse(
+                status_code=error_code,
+                content={"error": {"code": error_code, "message": "Injected failure", "status": "UNAVAILABLE"}}
+            )
+        return None
+
+    @app.get("/stats")
+    async def stats():
+        return {"calls": state["calls"], "files": len(files)}
+
+    def file_not_found(name):
+        return JSONResponse(
+            status_code=404,
+            content={"error": {"code": 404, "message": f"File {name} does not exist", "status": "NOT_FOUND"}}
+        )
+
+    @app.post("/upload/{api_version}/files")
+    async def upload_file(api_version: str, request: Request, upload_id: str = None):
+        if upload_id is None:
+            # Start of a resumable upload: hand out the URL the bytes go to
+            failure = await before_reply()
+            if failure is not None:
+                return failure
+            body = await request.json()
+            file_id = uuid.uuid4().hex[:12]
+            name = f"files/{file_id}"
+            files[name] = {
+                "name": name,
+                "displayName": (body.get("file") or {}).get("displayName", file_id),
+                "mimeType": request.headers.get("x-goog-upload-header-content-type", "application/octet-stream"),
+                "sizeBytes": "0",
+                "createTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "uri": f"{request.base_url}{api_version}/{name}",
+                "state": "PROCESSING",
+            }
+            upload_url = str(request.url.include_query_params(upload_id=file_id))
+            return JSONResponse(content={}, headers={"X-Goog-Upload-URL": upload_url, "X-Goog-Upload-Status": "active"})
+
+        file = files.get(f"files/{upload_id}")
+        if file is None:
+            return file_not_found(f"files/{upload_id}")
+        file["sizeBytes"] = str(int(file["sizeBytes"]) + len(await request.body()))
+        if "finalize" not in request.headers.get("x-goog-upload-command", ""):
+            return Response(headers={"X-Goog-Upload-Status": "active"})
+        file["state"] = "ACTIVE"
+        return JSONResponse(content={"file": file}, headers={"X-Goog-Upload-Status": "final"})
+
+    @app.get("/{api_version}/files/{file_id}")
+    async def get_file(api_version: str, file_id: str):
+        file = files.get(f"files/{file_id}")
+        return file if file is not None else file_not_found(f"files/{file_id}")
+
+    @app.delete("/{api_version}/files/{file_id}")
+    async def delete_file(api_version: str, file_id: str):
+        if files.pop(f"files/{file_id}", None) is None:
+            return file_not_found(f"files/{file_id}")
+        return {}
+
+    @app.post("/{api_version}/models/{model_action}")
+    async def models(api_version: str, model_action: str, request: Request):
+        model, _, action = model_action.partition(":")
+        body = await request.json()
+        failure = await before_reply()
+        if failure is not None:
+            return failure
+
+        prompt = prompt_of(body)
+        parts = [{"text": f"{text} ({model}: {prompt[:40]})"}]
+        if wants_image(body):
+            png = make_png(image_size[0], image_size[1], prompt)
+            parts.append({"inlineData": {"mimeType": "image/png", "data": base64.b64encode(png).decode("ascii")}})
+
+        if action == "streamGenerateContent":
+            async def stream():
+                words = parts[0]["text"].split(" ")
+                for i, word in enumerate(words):
+                    chunk = {"candidates": [candidate([{"text": word + (" " if i < len(words) - 1 else "")}])]}
+                    yield f"data: {json.dumps(chunk)}\r\n\r\n"
+                    await asyncio.sleep(0.01)
+            return StreamingResponse(stream(), media_type="text/event-stream")
+
+        return {
+            "candidates": [candidate(parts)],
+            "usageMetadata": {"promptTokenCount": len(prompt.split()), "candidatesTokenCount": len(parts[0]["text"].split())},
+            "modelVersion": model,
+        }
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the Gemini API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds of random latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls that fail")
+    parser.add_argument("--error-code", type=int, default=503)
+    parser.add_argument("--fail-first", type=int, default=0, help="fail this many calls before answering")
+    parser.add_argument("--image-size", type=int, default=256)
+    args = parser.parse_args()
+
+    uvicorn.run(
+        create_app(
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            error_code=args.error_code,
+            fail_first=args.fail_first,
+            image_size=(args.image_size, args.image_size),
+        ),
+        host=args.host,
+        port=args.port,
+    )
@@ -0,0 +1,263 @@
+"""A stand-in for Redis, for trying STATE_BACKEND=redis without a Redis server.
+
+    python mock_redis.py --port 6390
+    STATE_BACKEND=redis REDIS_URL=redis://127.0.0.1:6390/0 uvicorn gem:app --workers 4
+
+It speaks enough of the RESP protocol for the commands gem.py uses (strings
+with expiry, counters and sorted sets), keeps everything in memory in one
+process, and answers anything else with an error.
+"""
+import argparse
+import asyncio
+import bisect
+import fnmatch
+import time
+
+
+class Store:
+    def __init__(self):
+        self.strings = {}
+        self.zsets = {}
+        self.expires = {}
+
+    def _alive(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.strings.pop(key, None)
+            self.zsets.pop(key, None)
+            del self.expires[key]
+        return key in self.strings or key in self.zsets
+
+    def delete(self, key):
+        self.expires.pop(key, None)
+        found = self.strings.pop(key, None) is not None
+        return int(self.zsets.pop(key, None) is not None or found)
+
+    def zset(self, key):
+        self._alive(key)
+        return self.zsets.setdefault(key, ({}, []))
+
+    def zrange(self, key, lower, upper, reverse=False):
+        self._alive(key)
+        _, ordered = self.zsets.get(key, ({}, []))
+        items = [(score, member) for score, member in ordered if lower(score) and upper(score)]
+        return list(reversed(items)) if reverse else items
+
+
+def parse_bound(value, lower):
+    value = value.decode()
+    exclusive = value.startswith("(")
+    number = float(value[1:] if exclusive else value)
+    if lower:
+        return (lambda score: score > number) if exclusive else (lambda score: score >= number)
+    return (lambda score: score < number) if exclusive else (lambda score: score <= number)
+
+
+def format_score(score):
+    return repr(score).encode() if score != int(score) else str(int(score)).encode()
+
+
+class Handler:
+    def __init__(self, store):
+        self.store = store
+
+    def run(self, command, args):
+        method = getattr(self, f"cmd_{command.lower()}", None)
+        if method is None:
+            return Error(f"ERR unknown command '{command}'")
+        try:
+            return method(*args)
+        except (TypeError, ValueError, IndexError):
+            return Error(f"ERR wrong arguments for '{command}'")
+
+    def cmd_ping(self, *args):
+        return args[0] if args else Status("PONG")
+
+    def cmd_client(self, *args):
+        return Status("OK")
+
+    def cmd_select(self, db):
+        return Status("OK")
+
+    def cmd_flushall(self, *args):
+        self.store.__init__()
+        return Status("OK")
+
+    def cmd_get(self, key):
+        return self.store.strings.get(key) if self.store._alive(key) else None
+
+    def cmd_mget(self, *keys):
+        return [self.cmd_get(key) for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        if b"NX" in options and self.store._alive(key):
+            return None
+        self.store.delete(key)
+        self.store.strings[key] = value
+        for unit, scale in ((b"PX", 0.001), (b"EX", 1.0)):
+            if unit in options:
+                self.store.expires[key] = time.time() + int(options[options.index(unit) + 1]) * scale
+        return Status("OK")
+
+    def cmd_del(self, *keys):
+        return sum(self.store.delete(key) for key in keys if self.store._alive(key))
+
+    def cmd_incrby(self, key, amount):
+        value = int(self.store.strings.get(key, b"0")) if self.store._alive(key) else 0
+        value += int(amount)
+        self.store.strings[key] = str(value).encode()
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, b"1")
+
+    def cmd_pexpire(self, key, milliseconds):
+        if not self.store._alive(key):
+            return 0
+        self.store.expires[key] = time.time() + int(milliseconds) / 1000
+        return 1
+
+    def cmd_pttl(self, key):
+        if not self.store._alive(key):
+            return -2
+        expires_at = self.store.expires.get(key)
+        return -1 if expires_at is None else int((expires_at - time.time()) * 1000)
+
+    def cmd_zadd(self, key, *pairs):
+        scores, ordered = self.store.zset(key)
+        added = 0
+        for i in range(0, len(pairs), 2):
+            score, member = float(pairs[i]), pairs[i + 1]
+            old = scores.get(member)
+            if old is not None:
+                ordered.remove((old, member))
+            else:
+                added += 1
+            scores[member] = score
+            bisect.insort(ordered, (score, member))
+        return added
+
+    def cmd_zrem(self, key, *members):
+        if not self.store._alive(key):
+            return 0
+        scores, ordered = self.store.zsets[key]
+        removed = 0
+        for member in members:
+            score = scores.pop(member, None)
+            if score is not None:
+                ordered.remove((score, member))
+                removed += 1
+        if not scores:
+            self.store.delete(key)
+        return removed
+
+    def cmd_zcard(self, key):
+        return len(self.store.zsets[key][0]) if self.store._alive(key) else 0
+
+    def _reply_range(self, items, options):
+        options = [option.upper() for option in options]
+        if b"LIMIT" in options:
+            index = options.index(b"LIMIT")
+            offset, count = int(options[index + 1]), int(options[index + 2])
+            items = items[offset:] if count < 0 else items[offset:offset + count]
+        if b"WITHSCORES" in options:
+            return [value for score, member in items for value in (member, format_score(score))]
+        return [member for _, member in items]
+
+    def _by_index(self, key, start, stop, options, reverse):
+        items = self.store.zrange(key, lambda s: True, lambda s: True, reverse)
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start += len(items)
+        stop = stop + len(items) if stop < 0 else stop
+        return self._reply_range(items[max(start, 0):stop + 1], options)
+
+    def cmd_zrange(self, key, start, stop, *options):
+        return self._by_index(key, start, stop, options, reverse=False)
+
+    def cmd_zrevrange(self, key, start, stop, *options):
+        return self._by_index(key, start, stop, options, reverse=True)
+
+    def cmd_zrangebyscore(self, key, lower, upper, *options):
+        items = self.store.zrange(key, parse_bound(lower, True), parse_bound(upper, False))
+        return self._reply_range(items, options)
+
+    def cmd_zrevrangebyscore(self, key, upper, lower, *options):
+        items = self.store.zrange(key, parse_bound(lower, True), parse_bound(upper, False), reverse=True)
+        return self._reply_range(items, options)
+
+    def cmd_keys(self, pattern):
+        keys = [key for key in list(self.store.strings) + list(self.store.zsets) if self.store._alive(key)]
+        return [key for key in keys if fnmatch.fnmatchcase(key.decode(), pattern.decode())]
+
+
+class Status(str):
+    pass
+
+
+class Error(str):
+    pass
+
+
+def encode(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, Error):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, Status):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, list):
+        return f"*{len(value)}\r\n".encode() + b"".join(encode(item) for item in value)
+    return f"${len(value)}\r\n".encode() + value + b"\r\n"
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # Inline command, as typed into telnet
+        return line.split()
+    args = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+def create_server(host, port):
+    handler = Handler(Store())
+
+    async def serve(reader, writer):
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                writer.write(encode(handler.run(args[0].decode(), args[1:])))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return asyncio.start_server(serve, host, port)
+
+
+async def main(host, port):
+    server = await create_server(host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in for Redis")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(main(args.host, args.port))
@@ -0,0 +1,97 @@
+"""Helpers for searching prompt history: query parsing and near-duplicate hashing.
+
+Near-duplicate lookup uses one-permutation MinHash over character trigrams:
+each trigram is hashed once into one of ``SIGNATURE_BINS`` bins and every bin
+keeps its smallest hash. The signature is cut into bands, and two prompts
+become candidates when any band matches exactly, so a lookup only touches
+entries that share a band instead of the whole history.
+"""
+import re
+import zlib
+
+SIGNATURE_BINS = 64
+BAND_ROWS = 4
+STOPWORDS = frozenset(
+    "a an and any are as at be but by for from i in is it me my of on one or "
+    "some that the this those to was with".split()
+)
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def query_terms(text):
+    """Words worth searching for, in order; stopwords are dropped unless nothing else is left."""
+    words = [word.lower() for word in _WORD.findall(text or "")]
+    terms = [word for word in words if word not in STOPWORDS]
+    return list(dict.fromkeys(terms or words))
+
+
+def fts_query(terms, match_all=True, prefix=False):
+    """Build an FTS5 MATCH expression; with ``prefix`` the last term also matches longer words."""
+    quoted = [f'"{term}"' for term in terms]
+    if quoted and prefix:
+        quoted[-1] += "*"
+    return (" " if match_all else " OR ").join(quoted)
+
+
+def term_score(entry, terms):
+    """Rank an entry without an index: prompt matches count ten times response matches."""
+    prompt = (entry.get("prompt") or "").lower()
+    response = (entry.get("response_text") or "").lower()
+    score = 0.0
+    matched = 0
+    for term in terms:
+        in_prompt = prompt.count(term)
+        in_response = response.count(term)
+        if in_prompt or in_response:
+            matched += 1
+        score += 10 * in_prompt + in_response
+    return matched, score
+
+
+def shingles(text, n=3):
+    normalized = " ".join((text or "").lower().split())
+    if len(normalized) <= n:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + n] for i in range(len(normalized) - n + 1)}
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def signature(grams):
+    bins = [None] * SIGNATURE_BINS
+    for gram in grams:
+        h = zlib.crc32(gram.encode())
+        index = h % SIGNATURE_BINS
+        value = h // SIGNATURE_BINS
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+    if all(value is None for value in bins):
+        return None
+    # Short prompts leave bins empty; borrow from the next filled bin so bands stay comparable
+    for index in range(SIGNATURE_BINS):
+        if bins[index] is not None:
+            continue
+        distance = 1
+        while bins[(index + distance) % SIGNATURE_BINS] is None:
+            distance += 1
+        bins[index] = bins[(index + distance) % SIGNATURE_BINS] + (distance << 32)
+    return bins
+
+
+def band_keys(text):
+    """Return the LSH band keys for ``text`` (signed 63-bit ints, so SQLite can store them)."""
+    bins = signature(shingles(text))
+    if bins is None:
+        return []
+    keys = []
+    for band in range(SIGNATURE_BINS // BAND_ROWS):
+        key = band
+        for value in bins[band * BAND_ROWS:(band + 1) * BAND_ROWS]:
+            key = (key * 1000003 ^ value) & 0x7FFFFFFFFFFFFFFF
+        keys.append(key)
+    return keys
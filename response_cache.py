@@ -0,0 +1,273 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt):
+    return " ".join(prompt.split())
+
+
+def make_cache_key(model, prompt, image_sha256=None, config=None):
+    payload = {
+        "model": model,
+        "prompt": normalize_prompt(prompt),
+        "image": image_sha256,
+        "config": config,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache for model results.
+
+    Values must be JSON-serialisable. The memory tier is an LRU bounded by
+    entry count and by the total size of the serialised values; the optional
+    disk tier keeps one JSON file per key in ``disk_dir``, oldest evicted
+    first beyond ``disk_max_bytes``. ``shared`` is an optional third tier
+    every worker process can see (anything with ``get(key)`` and
+    ``set(key, value, ttl)``). All tiers honour the same TTL. Only the
+    memory tier is read on the event loop; the others go through a thread.
+    """
+
+    def __init__(
+        self,
+        max_entries=512,
+        max_bytes=16 * 1024 * 1024,
+        ttl=3600,
+        disk_dir=None,
+        shared=None,
+        disk_max_bytes=256 * 1024 * 1024
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.shared = shared
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_files = OrderedDict()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            for _, name, size in self._list_disk():
+                self._disk_files[name] = size
+                self._disk_bytes += size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _list_disk(self):
+        """``(mtime, name, size)`` of every cache file, oldest first."""
+        entries = []
+        with os.scandir(self.disk_dir) as found:
+            for entry in found:
+                if entry.name.startswith(".") or not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        return sorted(entries)
+
+    def _remove_disk_file(self, name):
+        with self._lock:
+            self._disk_bytes -= self._disk_files.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.disk_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def _remember_disk(self, name, size):
+        with self._lock:
+            self._disk_bytes -= self._disk_files.pop(name, 0)
+            self._disk_files[name] = size
+            self._disk_bytes += size
+            evicted = []
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk_files) > 1:
+                old_name, old_size = self._disk_files.popitem(last=False)
+                self._disk_bytes -= old_size
+                evicted.append(old_name)
+                self.disk_evictions += 1
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.disk_dir, old_name))
+            except FileNotFoundError:
+                pass
+
+    def sweep_disk(self):
+        """Delete expired cache files, then the oldest while the directory is over ``disk_max_bytes``.
+
+        Other processes may share the directory, so this goes by what is on
+        disk rather than by what this process wrote. Returns the files removed.
+        """
+        if not self.disk_dir:
+            return 0
+        # A file's expiry is its write time plus the TTL, so the mtime tells without reading it
+        cutoff = time.time() - self.ttl
+        removed = 0
+        entries = self._list_disk()
+        total = sum(size for _, _, size in entries)
+        for mtime, name, size in entries:
+            if mtime >= cutoff and total <= self.disk_max_bytes:
+                break
+            self._remove_disk_file(name)
+            total -= size
+            removed += 1
+        return removed
+
+    def _remember(self, key, value, expires_at, size):
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (expires_at, size, value)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._bytes -= self._entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    async def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, size, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self._bytes -= size
+
+        if self.disk_dir or self.shared is not None:
+            return await asyncio.to_thread(self._get_stored, key, now)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _get_stored(self, key, now):
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "r") as f:
+                    stored = json.load(f)
+                if stored["expires_at"] > now:
+                    with self._lock:
+                        self._remember(key, stored["value"], stored["expires_at"], len(json.dumps(stored["value"])))
+                        self.disk_hits += 1
+                    return stored["value"]
+                self._remove_disk_file(f"{key}.json")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Error reading response cache file for {key}: {e}")
+
+        if self.shared is not None:
+            try:
+                stored = self.shared.get(key)
+                if stored is not None and stored["expires_at"] > now:
+                    with self._lock:
+                        self._remember(key, stored["value"], stored["expires_at"], len(json.dumps(stored["value"])))
+                        self.shared_hits += 1
+                    return stored["value"]
+            except Exception as e:
+                logger.error(f"Error reading shared response cache for {key}: {e}")
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        serialised = json.dumps(value)
+        with self._lock:
+            self._remember(key, value, expires_at, len(serialised))
+        if self.disk_dir or self.shared is not None:
+            await asyncio.to_thread(self._set_stored, key, value, expires_at)
+
+    def _set_stored(self, key, value, expires_at):
+        if self.disk_dir:
+            tmp_path = os.path.join(self.disk_dir, f".tmp-{uuid.uuid4()}")
+            try:
+                data = json.dumps({"expires_at": expires_at, "value": value})
+                with open(tmp_path, "w") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._disk_path(key))
+                self._remember_disk(f"{key}.json", len(data.encode()))
+            except Exception as e:
+                logger.error(f"Error writing response cache file for {key}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        if self.shared is not None:
+            try:
+                self.shared.set(key, {"expires_at": expires_at, "value": value}, self.ttl)
+            except Exception as e:
+                logger.error(f"Error writing shared response cache for {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.shared_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_files": len(self._disk_files),
+                "disk_bytes": self._disk_bytes,
+                "disk_evictions": self.disk_evictions,
+                "hit_ratio": (self.hits + self.disk_hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one.
+
+    The first caller for a key starts ``func()`` as a task; callers that
+    arrive while it is running await the same task. The task is shielded,
+    so a caller that disconnects does not cancel the work for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.started = 0
+        self.joined = 0
+
+    async def do(self, key, func):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "started": self.started, "joined": self.joined}
@@ -0,0 +1,333 @@
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+from history_store import JSONDirHistoryStore, iter_json_entries
+from image_store import is_content_addressed
+
+logger = logging.getLogger(__name__)
+
+TEMP_FILE_PREFIXES = ("temp_", ".tmp-", ".upload-")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+
+def entry_image_names(entry):
+    names = []
+    for key in ("image_path", "input_image_path"):
+        if entry.get(key):
+            names.append(os.path.basename(entry[key].split("?", 1)[0]))
+    return names
+
+
+class RetentionService:
+    """Periodically trims history and deletes images nothing refers to any more.
+
+    Each sweep, in order:
+
+    - retires history entries older than ``max_age_days``, beyond the newest
+      ``max_entries``, or (oldest first) while the images history refers to
+      exceed ``max_image_bytes``. Retired entries are appended to a gzipped
+      JSON-lines archive per day and release their image references
+    - deletes indexed images whose reference count has been zero for
+      ``orphan_grace`` seconds, and legacy (uuid-named) files in the image
+      directory that no history entry mentions
+    - removes temp files left behind by a crash (``temp_``, ``.tmp-``,
+      ``.upload-``) once they are ``temp_file_max_age`` seconds old
+    - lets each of ``caches`` drop its expired on-disk entries and trim
+      itself to size (``sweep_disk()``)
+    - moves flat image files into shard directories, and folds the legacy
+      ``prompt_history/*.json`` files into the archive once they have been
+      imported into the history store
+
+    A policy left at ``None`` is not applied. With several app processes,
+    ``lock`` (anything with non-blocking ``acquire``/``release``) keeps the
+    sweep to one of them at a time.
+
+    Reference counts live in the image store's index, which is only shared
+    by processes on one machine. When several machines share history and
+    image storage, set ``verify_references``: an orphan is then checked
+    against every history entry before it is deleted, and one that is
+    still referenced gets its count back instead. Counts restored this way
+    are never released by the other machines, so such images are kept
+    rather than ever deleted wrongly.
+    """
+
+    def __init__(
+        self,
+        history_store,
+        image_store,
+        archive_dir,
+        temp_dirs=(),
+        legacy_image_dir=None,
+        legacy_history_dir=None,
+        max_age_days=None,
+        max_entries=None,
+        max_image_bytes=None,
+        orphan_grace=86400.0,
+        temp_file_max_age=3600.0,
+        batch_size=500,
+        interval=3600.0,
+        lock=None,
+        verify_references=False,
+        caches=()
+    ):
+        self.history_store = history_store
+        self.image_store = image_store
+        self.archive_dir = archive_dir
+        self.temp_dirs = [directory for directory in temp_dirs if directory]
+        self.legacy_image_dir = legacy_image_dir
+        self.legacy_history_dir = legacy_history_dir
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.max_image_bytes = max_image_bytes
+        self.orphan_grace = orphan_grace
+        self.temp_file_max_age = temp_file_max_age
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = lock
+        self.verify_references = verify_references
+        self.caches = list(caches)
+        self.last_report = None
+        self._task = None
+
+    def _archive(self, entries, name_prefix="history"):
+        if not entries:
+            return
+        os.makedirs(self.archive_dir, exist_ok=True)
+        day = datetime.date.today().isoformat()
+        # Appending makes a multi-member gzip file, which gzip.open reads back as one stream
+        with gzip.open(os.path.join(self.archive_dir, f"{name_prefix}-{day}.jsonl.gz"), "at") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+
+    def _retire(self, entries, report):
+        self._archive(entries)
+        self.history_store.delete_many([entry["id"] for entry in entries])
+        self.image_store.release_entry_refs({entry["id"]: entry_image_names(entry) for entry in entries})
+        report["history_retired"] += len(entries)
+
+    def _expire_history(self, report):
+        if self.max_age_days is not None:
+            cutoff = time.time() - self.max_age_days * 86400
+            while True:
+                entries = self.history_store.query(limit=self.batch_size, before=cutoff)
+                if not entries:
+                    break
+                self._retire(entries, report)
+
+        if self.max_entries is not None:
+            excess = self.history_store.count() - self.max_entries
+            while excess > 0:
+                entries = self.history_store.query(limit=min(self.batch_size, excess), after=float("-inf"))
+                if not entries:
+                    break
+                self._retire(entries, report)
+                excess -= len(entries)
+
+        if self.max_image_bytes is not None:
+            while True:
+                excess = self.image_store.referenced_bytes() - self.max_image_bytes
+                if excess <= 0:
+                    break
+                entries = self.history_store.query(limit=self.batch_size, after=float("-inf"))
+                if not entries:
+                    break
+                self._retire(self._covering(entries, excess), report)
+
+    def _covering(self, entries, excess):
+        """The fewest oldest of ``entries`` (listed newest first) that free ``excess`` image bytes, else all."""
+        oldest_first = entries[::-1]
+        released = Counter()
+        records = {}
+        freed = 0
+        for taken, entry in enumerate(oldest_first, 1):
+            for name in entry_image_names(entry):
+                if name not in records:
+                    records[name] = self.image_store.get_record_by_filename(name)
+                record = records[name]
+                released[name] += 1
+                # An image only frees its bytes once every entry using it is gone
+                if record is not None and released[name] == record["refcount"]:
+                    freed += record["size"]
+            if freed >= excess:
+                return oldest_first[:taken]
+        return entries
+
+    def _referenced_images(self):
+        referenced = Counter()
+        for entry in self.history_store.iter_entries(self.batch_size):
+            referenced.update(entry_image_names(entry))
+        return referenced
+
+    def _sweep_orphans(self, report):
+        untouched_since = time.time() - self.orphan_grace
+        referenced = None
+        while True:
+            orphans = self.image_store.orphans(untouched_since, limit=self.batch_size)
+            if not orphans:
+                break
+            if self.verify_references and referenced is None:
+                referenced = self._referenced_images()
+            for record in orphans:
+                if referenced and referenced[record["filename"]]:
+                    # Referenced by an entry another machine wrote; its count lives in that machine's index
+                    for _ in range(referenced[record["filename"]]):
+                        self.image_store.add_ref(record["filename"])
+                    report["image_refs_restored"] += 1
+                    continue
+                if self.image_store.delete(record["sha256"], only_unreferenced=True):
+                    report["images_deleted"] += 1
+                    report["bytes_freed"] += record["size"]
+            if len(orphans) < self.batch_size:
+                break
+
+    def _sweep_legacy_images(self, report):
+        if not self.legacy_image_dir or not os.path.isdir(self.legacy_image_dir):
+            return
+        cutoff = time.time() - self.orphan_grace
+        candidates = []
+        with os.scandir(self.legacy_image_dir) as entries:
+            for entry in entries:
+                if (
+                    entry.is_file()
+                    and entry.name.lower().endswith(IMAGE_EXTENSIONS)
+                    and not is_content_addressed(entry.name)
+                    and entry.stat().st_mtime < cutoff
+                ):
+                    candidates.append(entry)
+        if not candidates:
+            return
+
+        referenced = set()
+        for history_entry in self.history_store.iter_entries(self.batch_size):
+            referenced.update(entry_image_names(history_entry))
+        for entry in candidates:
+            if entry.name in referenced:
+                continue
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            report["images_deleted"] += 1
+            report["bytes_freed"] += size
+
+    def _sweep_temp_files(self, report):
+        cutoff = time.time() - self.temp_file_max_age
+        for directory in self.temp_dirs:
+            if not os.path.isdir(directory):
+                continue
+            for root, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    if not filename.startswith(TEMP_FILE_PREFIXES):
+                        continue
+                    path = os.path.join(root, filename)
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            report["temp_files_removed"] += 1
+                    except FileNotFoundError:
+                        pass
+
+    def _sweep_caches(self, report):
+        for cache in self.caches:
+            report["cache_files_removed"] += cache.sweep_disk()
+
+    def _compact_legacy_history(self, report):
+        # Only once the store has imported them; with the json backend these files are the history
+        if not self.legacy_history_dir or isinstance(self.history_store, JSONDirHistoryStore):
+            return
+        if self.history_store.get_meta("json_migrated") is None or not os.path.isdir(self.legacy_history_dir):
+            return
+        entries = list(iter_json_entries(self.legacy_history_dir))
+        if not entries:
+            return
+        self.history_store.add_many(entries, replace=False)
+        self._archive(entries, name_prefix="prompt_history")
+        for filename in os.listdir(self.legacy_history_dir):
+            if filename.endswith(".json"):
+                os.remove(os.path.join(self.legacy_history_dir, filename))
+                report["legacy_history_compacted"] += 1
+
+    def sweep(self):
+        started = time.time()
+        report = {
+            "history_retired": 0,
+            "images_deleted": 0,
+            "image_refs_restored": 0,
+            "bytes_freed": 0,
+            "temp_files_removed": 0,
+            "cache_files_removed": 0,
+            "images_resharded": 0,
+            "legacy_history_compacted": 0,
+        }
+        steps = (
+            self._expire_history,
+            self._sweep_orphans,
+            self._sweep_legacy_images,
+            self._sweep_temp_files,
+            self._sweep_caches,
+            self._compact_legacy_history,
+        )
+        for step in steps:
+            try:
+                step(report)
+            except Exception:
+                logger.exception(f"Retention step {step.__name__} failed")
+        reshard = getattr(self.image_store.backend, "reshard", None)
+        if reshard is not None:
+            try:
+                report["images_resharded"] = reshard(limit=self.batch_size * 10)
+            except Exception:
+                logger.exception("Resharding images failed")
+
+        report["started_at"] = started
+        report["seconds"] = round(time.time() - started, 3)
+        self.last_report = report
+        logger.info(f"Retention sweep finished: {report}")
+        return report
+
+    def _locked_sweep(self):
+        if self.lock is None:
+            return self.sweep()
+        if not self.lock.acquire():
+            return None
+        try:
+            return self.sweep()
+        finally:
+            self.lock.release()
+
+    async def _run(self):
+        while True:
+            await asyncio.to_thread(self._locked_sweep)
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self.interval and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "policies": {
+                "max_age_days": self.max_age_days,
+                "max_entries": self.max_entries,
+                "max_image_bytes": self.max_image_bytes,
+                "orphan_grace": self.orphan_grace,
+                "temp_file_max_age": self.temp_file_max_age,
+            },
+            "image_bytes": self.image_store.total_bytes(),
+            "referenced_image_bytes": self.image_store.referenced_bytes(),
+            "last_report": self.last_report,
+        }
@@ -0,0 +1,182 @@
+"""State shared by every worker process, for running more than one.
+
+``STATE_BACKEND=local`` keeps shared state in SQLite files next to the app,
+which is enough for several workers on one machine. ``STATE_BACKEND=redis``
+keeps it in Redis (or anything that speaks its protocol) so workers can
+run on several machines.
+"""
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+def redis_client(url):
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError("The redis state backend needs the redis package: pip install redis")
+    # RESP2 works with every Redis version and compatible server, and replies have the same shapes
+    return redis.Redis.from_url(url, decode_responses=True, protocol=2)
+
+
+class SQLiteRateLimiter:
+    """Fixed-window request counter kept in a SQLite file.
+
+    Every process that opens the same file shares the counts; ``BEGIN
+    IMMEDIATE`` takes SQLite's write lock, so the check and the increment
+    happen as one step across processes.
+    """
+
+    def __init__(self, path, limit, window=60.0):
+        self.limit = limit
+        self.window = window
+        self.limited = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_windows (
+                key TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (key, slot)
+            )
+        """)
+
+    def acquire(self, key):
+        """Count one request for ``key``; return 0, or the seconds to wait when the window is full."""
+        now = time.time()
+        window = int(now // self.window)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT count FROM rate_windows WHERE key = ? AND slot = ?", (key, window)
+                ).fetchone()
+                if row and row[0] >= self.limit:
+                    self._conn.execute("COMMIT")
+                    self.limited += 1
+                    return (window + 1) * self.window - now
+                self._conn.execute(
+                    "INSERT INTO rate_windows (key, slot, count) VALUES (?, ?, 1) "
+                    "ON CONFLICT (key, slot) DO UPDATE SET count = count + 1",
+                    (key, window)
+                )
+                self._conn.execute("DELETE FROM rate_windows WHERE slot < ?", (window - 1,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return 0
+
+    def stats(self):
+        return {"backend": "sqlite", "limit": self.limit, "window": self.window, "limited": self.limited}
+
+
+class RedisRateLimiter:
+    """Fixed-window request counter kept in Redis, shared by every worker on every host."""
+
+    def __init__(self, client, limit, window=60.0, prefix="gem:ratelimit:"):
+        self.client = client
+        self.limit = limit
+        self.window = window
+        self.prefix = prefix
+        self.limited = 0
+
+    def acquire(self, key):
+        now = time.time()
+        window = int(now // self.window)
+        counter = f"{self.prefix}{key}:{window}"
+        count = self.client.incr(counter)
+        if count == 1:
+            self.client.pexpire(counter, int(self.window * 2000))
+        if count > self.limit:
+            self.limited += 1
+            return (window + 1) * self.window - now
+        return 0
+
+    def stats(self):
+        return {"backend": "redis", "limit": self.limit, "window": self.window, "limited": self.limited}
+
+
+class RedisCacheTier:
+    """Response cache tier in Redis, so a result computed by one worker serves them all."""
+
+    def __init__(self, client, prefix="gem:cache:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        stored = self.client.get(f"{self.prefix}{key}")
+        return json.loads(stored) if stored is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(f"{self.prefix}{key}", json.dumps(value), px=int(ttl * 1000))
+
+
+class FileLock:
+    """Non-blocking lock held through ``flock`` on a file, for work only one local process should do."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class RedisLock:
+    """Non-blocking lock in Redis that expires after ``ttl`` seconds if its holder dies."""
+
+    def __init__(self, client, name, ttl=3600.0):
+        self.client = client
+        self.name = f"gem:lock:{name}"
+        self.ttl = ttl
+        self._token = None
+
+    def acquire(self):
+        token = str(uuid.uuid4())
+        if not self.client.set(self.name, token, nx=True, px=int(self.ttl * 1000)):
+            return False
+        self._token = token
+        return True
+
+    def release(self):
+        if self._token is not None and self.client.get(self.name) == self._token:
+            self.client.delete(self.name)
+        self._token = None
+
+
+def open_lock(backend, name, directory=".", redis=None, ttl=3600.0):
+    if backend == "local":
+        return FileLock(os.path.join(directory, f".{name}.lock"))
+    if backend == "redis":
+        return RedisLock(redis, name, ttl)
+    raise ValueError(f"Unknown state backend: {backend}")
+
+
+def open_rate_limiter(backend, limit, window=60.0, sqlite_path=None, redis=None):
+    if not limit:
+        return None
+    if backend == "local":
+        return SQLiteRateLimiter(sqlite_path, limit, window)
+    if backend == "redis":
+        return RedisRateLimiter(redis, limit, window)
+    raise ValueError(f"Unknown state backend: {backend}")
@@ -182,24 +182,7 @@ function initImageGeneration() {
         // Switch to edit tab
         document.querySelector('nav a[data-tab="edit"]').click();
         
-        // Convert the generated image to a File object
-        fetch(document.getElementById('generated-image').src)
-            .then(res => res.blob())
-            .then(blob => {
-                const file = new File([blob], "generated-image.png", {type: "image/png"});
-                
-                // Create a new DataTransfer object
-                const dataTransfer = new DataTransfer();
-                dataTransfer.items.add(file);
-                
-                // Set the file to the input
-                const fileInput = document.getElementById('edit-image-upload');
-                fileInput.files = dataTransfer.files;
-                
-                // Trigger change event
-                const event = new Event('change');
-                fileInput.dispatchEvent(event);
-            });
+        selectImageForEditing(document.getElementById('generated-image').src);
     });
     
     // Handle download generated image
@@ -213,6 +196,58 @@ function initImageGeneration() {
         document.body.removeChild(link);
     });
     
+    // While a prompt is typed, offer earlier images made from nearly the same prompt
+    const promptInput = document.getElementById('generate-prompt');
+    const similarContainer = document.getElementById('similar-prompts');
+    let similarTimer = null;
+    
+    function showExistingImage(entry) {
+        const correctedImageUrl = fixImagePath(entry.image_path);
+        generatedImage.src = correctedImageUrl;
+        generatedImage.setAttribute('data-original-url', entry.image_path);
+        generatedText.textContent = entry.response_text || entry.prompt;
+        loader.style.display = 'none';
+        resultContent.style.display = 'block';
+    }
+    
+    promptInput.addEventListener('input', function() {
+        clearTimeout(similarTimer);
+        const prompt = this.value.trim();
+        if (prompt.length < 8) {
+            similarContainer.style.display = 'none';
+            return;
+        }
+        similarTimer = setTimeout(function() {
+            const params = new URLSearchParams({ prompt: prompt, type: 'generate', limit: 4 });
+            fetch(getApiBaseUrl() + '/similar-prompts?' + params.toString())
+                .then(response => response.json())
+                .then(data => {
+                    const matches = data.success ? data.results.filter(entry => entry.image_path) : [];
+                    similarContainer.innerHTML = '';
+                    if (matches.length === 0 || promptInput.value.trim() !== prompt) {
+                        similarContainer.style.display = 'none';
+                        return;
+                    }
+                    const label = document.createElement('div');
+                    label.textContent = 'You made similar images before. Click one to reuse it:';
+                    const list = document.createElement('div');
+                    list.className = 'similar-list';
+                    matches.forEach(entry => {
+                        const img = document.createElement('img');
+                        img.src = fixImagePath(entry.image_path) + '?w=128&fmt=webp';
+                        img.alt = entry.prompt;
+                        img.title = entry.prompt;
+                        img.addEventListener('click', () => showExistingImage(entry));
+                        list.appendChild(img);
+                    });
+                    similarContainer.appendChild(label);
+                    similarContainer.appendChild(list);
+                    similarContainer.style.display = 'block';
+                })
+                .catch(error => console.error('Error looking up similar prompts:', error));
+        }, 400);
+    });
+    
     // Handle form submission
     generateForm.addEventListener('submit', function(e) {
         e.preventDefault();
@@ -267,6 +302,17 @@ function initImageGeneration() {
     });
 }
 
+// Point the edit form at an image the server already has, so it is edited by reference instead of re-uploaded
+function selectImageForEditing(imageUrl) {
+    const editForm = document.getElementById('edit-form');
+    const fileInput = document.getElementById('edit-image-upload');
+    const imagePreview = document.getElementById('edit-image-preview');
+    
+    fileInput.value = '';
+    editForm.dataset.sourceImageUrl = imageUrl;
+    imagePreview.innerHTML = `<img src="${imageUrl}" alt="Image to Edit">`;
+}
+
 // Image Editing
 function initImageEditing() {
     const editForm = document.getElementById('edit-form');
@@ -302,6 +348,7 @@ function initImageEditing() {
     // Handle file upload preview
     imageUpload.addEventListener('change', function() {
         if (this.files && this.files[0]) {
+            delete editForm.dataset.sourceImageUrl;
             const reader = new FileReader();
             
             reader.onload = function(e) {
@@ -329,13 +376,14 @@ function initImageEditing() {
         
         const prompt = document.getElementById('edit-prompt').value.trim();
         const imageFile = imageUpload.files[0];
+        const sourceImageUrl = editForm.dataset.sourceImageUrl;
         
         if (!prompt) {
             alert('Please enter editing instructions');
             return;
         }
         
-        if (!imageFile) {
+        if (!imageFile && !sourceImageUrl) {
             alert('Please upload an image to edit');
             return;
         }
@@ -347,7 +395,11 @@ function initImageEditing() {
         // Create form data
         const formData = new FormData();
         formData.append('prompt', prompt);
-        formData.append('image', imageFile);
+        if (imageFile) {
+            formData.append('image', imageFile);
+        } else {
+            formData.append('image_url', sourceImageUrl);
+        }
         
         // Send request to server with absolute URL
         fetch(getApiBaseUrl() + '/edit-image/', {
@@ -502,22 +554,20 @@ function initChatWithImage() {
         chatMessages.appendChild(loadingElement);
         chatMessages.scrollTop = chatMessages.scrollHeight;
         
-        const formData = new FormData();
-        formData.append('prompt', prompt);
-        formData.append('image_url', imageUrl);
-        
-        fetch(getApiBaseUrl() + '/chat-with-image/', { method: 'POST', body: formData })
-            .then(response => response.json())
-            .then(data => {
-                if (loadingElement.parentNode === chatMessages) {
-                    chatMessages.removeChild(loadingElement);
-                }
-                if (data.success) {
-                    addMessage(data.message, 'ai');
-                } else {
-                    addMessage('Error: ' + data.message, 'ai');
+        // Replies arrive as server-sent events and are rendered as they stream in
+        sendChatTurn(imageUrl, prompt, true)
+            .then(response => {
+                const contentType = response.headers.get('content-type') || '';
+                if (!contentType.includes('text/event-stream')) {
+                    // Errors raised before the model started answering come back as plain JSON
+                    return response.json().then(data => {
+                        if (loadingElement.parentNode === chatMessages) {
+                            chatMessages.removeChild(loadingElement);
+                        }
+                        addMessage('Error: ' + data.message, 'ai');
+                    });
                 }
-                loadHistory(); 
+                return readChatStream(response, loadingElement).then(() => loadHistory());
             })
             .catch(error => {
                 if (loadingElement.parentNode === chatMessages) {
@@ -528,6 +578,93 @@ function initChatWithImage() {
             });
     }
     
+    // One server-side session per chat image, so follow-up questions keep the conversation and skip re-sending the image
+    let chatSessionId = null;
+    let chatSessionImageUrl = null;
+    
+    function ensureChatSession(imageUrl) {
+        if (chatSessionId && chatSessionImageUrl === imageUrl) {
+            return Promise.resolve(chatSessionId);
+        }
+        const formData = new FormData();
+        formData.append('image_url', imageUrl);
+        return fetch(getApiBaseUrl() + '/chat-sessions', { method: 'POST', body: formData })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) throw new Error(data.message);
+                chatSessionId = data.session_id;
+                chatSessionImageUrl = imageUrl;
+                return chatSessionId;
+            });
+    }
+    
+    function sendChatTurn(imageUrl, prompt, retryExpired) {
+        return ensureChatSession(imageUrl).then(sessionId => {
+            const formData = new FormData();
+            formData.append('prompt', prompt);
+            return fetch(getApiBaseUrl() + `/chat-sessions/${sessionId}/turns/stream`, { method: 'POST', body: formData });
+        }).then(response => {
+            if (response.status === 404 && retryExpired) {
+                // The session expired on the server; start a new one and ask again
+                chatSessionId = null;
+                return sendChatTurn(imageUrl, prompt, false);
+            }
+            return response;
+        });
+    }
+    
+    function readChatStream(response, messageElement) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let receivedText = false;
+        
+        function handleEvent(block) {
+            let eventName = 'message';
+            let data = '';
+            block.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (!data) return;
+            const payload = JSON.parse(data);
+            
+            if (eventName === 'message' && payload.text) {
+                if (!receivedText) {
+                    receivedText = true;
+                    messageElement.classList.remove('loading');
+                    messageElement.textContent = '';
+                }
+                messageElement.textContent += payload.text;
+            } else if (eventName === 'done' && !receivedText) {
+                messageElement.classList.remove('loading');
+                messageElement.textContent = payload.message;
+            } else if (eventName === 'error') {
+                messageElement.classList.remove('loading');
+                messageElement.textContent = (receivedText ? messageElement.textContent + '\n\n' : '') + 'Error: ' + payload.message;
+            }
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
+        
+        function pump() {
+            return reader.read().then(({ done, value }) => {
+                buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                let separator;
+                while ((separator = buffer.indexOf('\n\n')) !== -1) {
+                    handleEvent(buffer.slice(0, separator));
+                    buffer = buffer.slice(separator + 2);
+                }
+                if (done) {
+                    if (buffer.trim()) handleEvent(buffer);
+                    return;
+                }
+                return pump();
+            });
+        }
+        
+        return pump();
+    }
+    
     function addMessage(text, sender) {
         if (!chatMessages) return; 
         if (chatMessages.querySelector('.empty-state')) {
@@ -545,14 +682,46 @@ function initChatWithImage() {
 function initHistoryView() {
     const refreshHistoryBtn = document.getElementById('refresh-history');
     
+    const loadMoreHistoryBtn = document.getElementById('load-more-history');
+    const searchForm = document.getElementById('history-search-form');
+    const searchInput = document.getElementById('history-search');
+    
     // Handle refresh button click
-    refreshHistoryBtn.addEventListener('click', loadHistory);
+    refreshHistoryBtn.addEventListener('click', () => loadHistory());
+    loadMoreHistoryBtn.addEventListener('click', () => loadHistory(true));
+    
+    // Searching is done by the server; an empty search goes back to the plain newest-first list
+    searchForm.addEventListener('submit', function(e) {
+        e.preventDefault();
+        historySearchQuery = searchInput.value.trim();
+        loadHistory();
+    });
+    searchInput.addEventListener('search', function() {
+        if (!this.value.trim() && historySearchQuery) {
+            historySearchQuery = '';
+            loadHistory();
+        }
+    });
 }
 
-// Load history from server
-function loadHistory() {
-    console.log("Loading history...");
-    fetch(getApiBaseUrl() + '/get-full-history')
+// Cursor for the next page of history (a created_at, or an offset while searching), null when there is nothing more to load
+let historyNextCursor = null;
+let historySearchQuery = '';
+const HISTORY_PAGE_SIZE = 50;
+
+// Load history from server, one page at a time
+function loadHistory(append = false) {
+    console.log("Loading history...", append ? "(next page)" : "");
+    const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE, type: 'generate,edit' });
+    let endpoint = '/get-full-history?';
+    if (historySearchQuery) {
+        endpoint = '/search-history?';
+        params.set('q', historySearchQuery);
+    }
+    if (append && historyNextCursor !== null) {
+        params.set(historySearchQuery ? 'offset' : 'before', historyNextCursor);
+    }
+    fetch(getApiBaseUrl() + endpoint + params.toString())
         .then(response => {
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
@@ -562,19 +731,26 @@ function loadHistory() {
         .then(data => {
             console.log("Received history data:", data);
             if (data.success) {
-                const fullHistory = data.history || [];
+                const fullHistory = data.history || data.results || [];
                 console.log("Processing fullHistory array:", fullHistory);
                 
                 const imagesGrid = document.getElementById('history-images-grid');
-                imagesGrid.innerHTML = ''; 
+                if (!append) {
+                    imagesGrid.innerHTML = ''; 
+                }
+                
+                historyNextCursor = data.has_more ? (historySearchQuery ? data.next_offset : data.next_before) : null;
+                document.getElementById('load-more-history').style.display = data.has_more ? '' : 'none';
                 
                 const imageEntries = fullHistory.filter(entry => 
                     (entry.type === 'generate' || entry.type === 'edit') && entry.image_path
                 );
                 console.log("Filtered image entries for history:", imageEntries);
                 
-                if (imageEntries.length === 0) {
-                    imagesGrid.innerHTML = '<div class="empty-state">No images in history yet.</div>';
+                if (imageEntries.length === 0 && !append) {
+                    imagesGrid.innerHTML = historySearchQuery ?
+                        '<div class="empty-state">No images match this search.</div>' :
+                        '<div class="empty-state">No images in history yet.</div>';
                 } else {
                     imageEntries.forEach(entry => {
                         console.log("Processing history entry:", entry);
@@ -587,15 +763,13 @@ function loadHistory() {
                         card.className = 'image-card';
                         
                         const img = document.createElement('img');
-                        let correctedHistoryImageUrl = fixImagePath(entry.image_path);
-                        
-                        // Add cache-busting parameter to non-data URLs
-                        if (correctedHistoryImageUrl && !correctedHistoryImageUrl.startsWith('data:')) {
-                            correctedHistoryImageUrl += (correctedHistoryImageUrl.includes('?') ? '&' : '?') + 'v=' + new Date().getTime();
-                        }
+                        // Image files never change once written, so let the browser cache them
+                        const correctedHistoryImageUrl = fixImagePath(entry.image_path);
                         
-                        console.log(`History: Original URL from entry: "${entry.image_path}", Corrected & Cache-busted URL for <img> src: "${correctedHistoryImageUrl}"`);
-                        img.src = correctedHistoryImageUrl;
+                        console.log(`History: Original URL from entry: "${entry.image_path}", Corrected URL for <img> src: "${correctedHistoryImageUrl}"`);
+                        // Tiles only need a small preview; the modal still opens the full-size image
+                        img.src = correctedHistoryImageUrl.startsWith('data:') ? correctedHistoryImageUrl : correctedHistoryImageUrl + '?w=256&fmt=webp';
+                        img.loading = 'lazy';
                         img.alt = entry.prompt ? `Image for prompt: ${entry.prompt.substring(0,30)}...` : 'History Image';
                         
                         const info = document.createElement('div'); // Define info div earlier to use in onerror
@@ -754,22 +928,8 @@ function initModal() {
     modalEditBtn.addEventListener('click', function() {
         document.querySelector('nav a[data-tab="edit"]').click();
         
-        fetch(modalImage.src)
-            .then(res => res.blob())
-            .then(blob => {
-                const file = new File([blob], "image-to-edit.png", {type: "image/png"});
-                
-                const dataTransfer = new DataTransfer();
-                dataTransfer.items.add(file);
-                
-                const fileInput = document.getElementById('edit-image-upload');
-                fileInput.files = dataTransfer.files;
-                
-                const event = new Event('change');
-                fileInput.dispatchEvent(event);
-                
-                modal.style.display = 'none';
-            });
+        selectImageForEditing(modalImage.src);
+        modal.style.display = 'none';
     });
     
     modalDownloadBtn.addEventListener('click', function() {
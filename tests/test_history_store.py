@@ -0,0 +1,43 @@
+from history_store import SQLiteHistoryStore, format_cursor, parse_cursor
+
+
+def entry(n, prompt, created_at=None):
+    return {"id": f"entry-{n:04d}", "type": "generate", "prompt": prompt, "created_at": float(n if created_at is None else created_at)}
+
+
+def test_search_reaches_matches_beyond_the_first_few_hundred(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    store.add_many([entry(n, f"a red car number {n}") for n in range(700)])
+
+    seen = set()
+    offset = 0
+    while True:
+        results, match_all = store.search("red car", limit=100, offset=offset)
+        if not results:
+            break
+        seen.update(result["id"] for result in results)
+        offset += len(results)
+
+    assert match_all
+    assert len(seen) == 700
+
+
+def test_pages_do_not_skip_entries_created_at_the_same_time(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    # A batch written in one flush: several entries share each timestamp
+    store.add_many([entry(n, f"prompt {n}", created_at=n // 4) for n in range(20)])
+
+    seen = []
+    cursor = None
+    while True:
+        page = store.query(limit=3, before=cursor)
+        if not page:
+            break
+        seen.extend(item["id"] for item in page)
+        cursor = parse_cursor(format_cursor(page[-1]))
+
+    assert sorted(seen) == sorted(f"entry-{n:04d}" for n in range(20))
+    assert len(seen) == 20
+
+    newer = store.query(limit=3, after=parse_cursor(format_cursor(store.query(limit=20)[-1])))
+    assert [item["id"] for item in newer] == ["entry-0003", "entry-0002", "entry-0001"]
@@ -0,0 +1,113 @@
+import asyncio
+import sqlite3
+import time
+
+from jobs import JobQueue
+from upstream import CircuitOpenError, GeminiBusyError
+
+
+def make_queue(tmp_path, **kwargs):
+    kwargs.setdefault("transient_errors", (GeminiBusyError, CircuitOpenError))
+    kwargs.setdefault("retry_backoff", 0.05)
+    return JobQueue(str(tmp_path / "jobs.db"), workers=1, poll_interval=0.02, **kwargs)
+
+
+async def wait_until_done(queue, job_id):
+    for _ in range(500):
+        job = await queue.get(job_id)
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job stayed {job['status']}")
+
+
+def test_transient_failure_is_retried(tmp_path):
+    async def run():
+        queue = make_queue(tmp_path)
+        errors = [GeminiBusyError("busy"), CircuitOpenError("open")]
+
+        async def handler(payload):
+            if errors:
+                raise errors.pop(0)
+            return {"ok": payload["n"]}
+
+        queue.register("work", handler)
+        await queue.start()
+        try:
+            job = await queue.submit("work", {"n": 1})
+            job = await wait_until_done(queue, job["id"])
+        finally:
+            await queue.stop()
+
+        assert job["status"] == "succeeded"
+        assert job["result"] == {"ok": 1}
+        assert job["error"] is None
+        assert job["attempts"] == 3
+
+    asyncio.run(run())
+
+
+def test_transient_failure_gives_up_after_max_attempts(tmp_path):
+    async def run():
+        queue = make_queue(tmp_path, max_attempts=2)
+        calls = []
+
+        async def handler(payload):
+            calls.append(payload)
+            raise GeminiBusyError("busy")
+
+        queue.register("work", handler)
+        await queue.start()
+        try:
+            job = await queue.submit("work", {})
+            job = await wait_until_done(queue, job["id"])
+        finally:
+            await queue.stop()
+
+        assert job["status"] == "failed"
+        assert job["error"] == "busy"
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_other_errors_fail_at_once(tmp_path):
+    async def run():
+        queue = make_queue(tmp_path)
+
+        async def handler(payload):
+            raise ValueError("bad input")
+
+        queue.register("work", handler)
+        await queue.start()
+        try:
+            job = await queue.submit("work", {})
+            job = await wait_until_done(queue, job["id"])
+        finally:
+            await queue.stop()
+
+        assert job["status"] == "failed"
+        assert job["attempts"] == 1
+
+    asyncio.run(run())
+
+
+def test_waiting_for_another_process_lock_does_not_block_the_loop(tmp_path):
+    async def run():
+        queue = make_queue(tmp_path)
+        queue.register("work", lambda payload: None)
+        await queue.start()
+        # Another process holding the write lock, as a second worker would
+        other = sqlite3.connect(str(tmp_path / "jobs.db"), isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        try:
+            started = time.monotonic()
+            for _ in range(20):
+                await asyncio.sleep(0.01)
+            assert time.monotonic() - started < 1
+        finally:
+            other.execute("ROLLBACK")
+            other.close()
+            await queue.stop()
+
+    asyncio.run(run())
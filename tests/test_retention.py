@@ -0,0 +1,46 @@
+from history_store import SQLiteHistoryStore
+from image_store import ImageStore, LocalImageBackend
+from retention import RetentionService
+
+
+def stores(tmp_path):
+    history_store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    image_store = ImageStore(LocalImageBackend(str(tmp_path / "images")), str(tmp_path / "index.db"))
+    return history_store, image_store
+
+
+def add_entry(history_store, image_store, n, image_bytes):
+    record = image_store.put(image_bytes)
+    image_store.add_ref(record["filename"])
+    history_store.add({"id": f"entry-{n}", "type": "generate", "prompt": f"p{n}", "created_at": float(n), "image_path": record["url"]})
+    return record
+
+
+def test_image_budget_retires_only_the_entries_it_needs(tmp_path):
+    history_store, image_store = stores(tmp_path)
+    for n in range(10):
+        add_entry(history_store, image_store, n, bytes([n]) * 1000)
+    retention = RetentionService(history_store, image_store, str(tmp_path / "archive"), max_image_bytes=7500)
+
+    report = retention.sweep()
+
+    assert report["history_retired"] == 3
+    assert [entry["id"] for entry in history_store.query(after=float("-inf"), limit=1)] == ["entry-3"]
+    assert image_store.referenced_bytes() == 7000
+
+
+def test_image_budget_counts_shared_images_once_all_their_entries_go(tmp_path):
+    history_store, image_store = stores(tmp_path)
+    shared = b"s" * 1000
+    # The two oldest entries share one image, so retiring only the first frees nothing
+    add_entry(history_store, image_store, 0, shared)
+    add_entry(history_store, image_store, 1, shared)
+    for n in range(2, 6):
+        add_entry(history_store, image_store, n, bytes([n]) * 1000)
+    retention = RetentionService(history_store, image_store, str(tmp_path / "archive"), max_image_bytes=4500)
+
+    report = retention.sweep()
+
+    assert report["history_retired"] == 2
+    assert history_store.count() == 4
+    assert image_store.referenced_bytes() == 4000
@@ -0,0 +1,124 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from upstream import CircuitOpenError, GeminiBusyError, GeminiUpstream
+
+MODEL = "test-model"
+
+
+class FakeModels:
+    def __init__(self):
+        self.calls = 0
+        self.hang = False
+
+    async def _answer(self):
+        self.calls += 1
+        if self.hang:
+            await asyncio.Event().wait()
+        return "ok"
+
+    async def generate_content(self, model, **kwargs):
+        return await self._answer()
+
+    async def generate_content_stream(self, model, **kwargs):
+        await self._answer()
+
+        async def chunks():
+            yield "chunk"
+
+        return chunks()
+
+
+class SlowRateLimiter:
+    def acquire(self, key):
+        return 60.0
+
+
+def half_open_upstream(**kwargs):
+    upstream = GeminiUpstream("key", breaker_reset=30.0, **kwargs)
+    models = FakeModels()
+    upstream._client = SimpleNamespace(aio=SimpleNamespace(models=models))
+    breaker = upstream.breaker(MODEL)
+    breaker.failures = breaker.failure_threshold
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout
+    return upstream, models
+
+
+async def collect(upstream):
+    return [chunk async for chunk in upstream.generate_content_stream(MODEL, contents="hi")]
+
+
+def test_cancelled_trial_lets_the_next_call_through():
+    async def run():
+        upstream, models = half_open_upstream()
+        models.hang = True
+        trial = asyncio.create_task(upstream.generate_content(MODEL, contents="hi"))
+        while not models.calls:
+            await asyncio.sleep(0)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+        assert not upstream.breaker(MODEL).trial_in_flight
+        assert upstream.in_flight == 0
+        models.hang = False
+        assert await upstream.generate_content(MODEL, contents="hi") == "ok"
+        assert upstream.breaker(MODEL).state == "closed"
+
+    asyncio.run(run())
+
+
+def test_cancelled_stream_trial_lets_the_next_call_through():
+    async def run():
+        upstream, models = half_open_upstream()
+        models.hang = True
+        trial = asyncio.create_task(collect(upstream))
+        while not models.calls:
+            await asyncio.sleep(0)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+        assert not upstream.breaker(MODEL).trial_in_flight
+        models.hang = False
+        assert await collect(upstream) == ["chunk"]
+        assert upstream.breaker(MODEL).state == "closed"
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("busy", [{"max_queue": 0}, {"rate_limiter": SlowRateLimiter(), "rate_limit_max_wait": 1.0}])
+def test_busy_trial_is_handed_back(busy):
+    async def run():
+        upstream, models = half_open_upstream(**busy)
+        with pytest.raises(GeminiBusyError):
+            await upstream.generate_content(MODEL, contents="hi")
+        with pytest.raises(GeminiBusyError):
+            await collect(upstream)
+
+        breaker = upstream.breaker(MODEL)
+        assert not breaker.trial_in_flight
+        assert breaker.state == "half-open"
+        assert models.calls == 0
+
+    asyncio.run(run())
+
+
+def test_only_one_trial_at_a_time():
+    async def run():
+        upstream, models = half_open_upstream()
+        models.hang = True
+        trial = asyncio.create_task(upstream.generate_content(MODEL, contents="hi"))
+        while not models.calls:
+            await asyncio.sleep(0)
+        with pytest.raises(CircuitOpenError):
+            await upstream.generate_content(MODEL, contents="hi")
+        # A rejected caller must not release the trial it never held
+        assert upstream.breaker(MODEL).trial_in_flight
+        trial.cancel()
+        await asyncio.gather(trial, return_exceptions=True)
+
+    asyncio.run(run())
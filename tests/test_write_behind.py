@@ -0,0 +1,218 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+
+from history_store import SQLiteHistoryStore
+from image_store import ImageStore, LocalImageBackend
+from write_behind import WriteBehind
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs a writer that queues one batch and is SIGKILLed at ``point`` while flushing it
+CRASHING_WRITER = textwrap.dedent("""
+    import asyncio, json, os, signal, sys
+
+    import write_behind
+    from history_store import SQLiteHistoryStore
+    from image_store import ImageStore, LocalImageBackend
+
+    directory, point, batch = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+
+    def die():
+        os.kill(os.getpid(), signal.SIGKILL)
+
+    class CrashingImageStore(ImageStore):
+        def add_entry_refs(self, entries):
+            taken = super().add_entry_refs(entries)
+            if point == "refs":
+                die()
+            return taken
+
+    class CrashingHistoryStore(SQLiteHistoryStore):
+        def add_many(self, entries, replace=True):
+            written = super().add_many(entries, replace)
+            if point == "applied":
+                die()
+            return written
+
+    class CrashingJson:
+        dumps_calls = 0
+
+        @classmethod
+        def dumps(cls, value):
+            cls.dumps_calls += 1
+            if point == "journal" and cls.dumps_calls == 3:
+                die()
+            return json.dumps(value)
+
+    write_behind.json = CrashingJson
+    image_store = CrashingImageStore(LocalImageBackend(os.path.join(directory, "images")), os.path.join(directory, "index.db"))
+    history_store = CrashingHistoryStore(os.path.join(directory, "history.db"))
+
+    async def main():
+        writer = write_behind.WriteBehind(
+            image_store, history_store, os.path.join(directory, "wb"), fsync="interval", fsync_interval=3600
+        )
+        await writer.start()
+        await writer.add_history(batch, ack="applied")
+
+    asyncio.run(main())
+""")
+
+
+def stores(tmp_path):
+    image_store = ImageStore(LocalImageBackend(str(tmp_path / "images")), str(tmp_path / "index.db"))
+    history_store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    return image_store, history_store
+
+
+def writer(tmp_path, image_store, history_store, **kwargs):
+    return WriteBehind(image_store, history_store, str(tmp_path / "wb"), **kwargs)
+
+
+def refcount(image_store, record):
+    return image_store.get_record(record["sha256"])["refcount"]
+
+
+def entry(entry_id, created_at, record, **extra):
+    return {"id": entry_id, "type": "generate", "created_at": created_at, "image_path": record["url"], **extra}
+
+
+@pytest.mark.parametrize("point", ["journal", "refs", "applied"])
+def test_replay_after_a_crash_applies_each_entry_once(tmp_path, point):
+    image_store, history_store = stores(tmp_path)
+    shared, fresh, chat_image = (image_store.put(bytes([n]) * 100) for n in range(3))
+
+    async def write_baseline():
+        first = writer(tmp_path, image_store, history_store)
+        await first.start()
+        await first.add_history([entry("chat", 1.0, chat_image, turns=1)], ack="applied")
+        await first.stop()
+
+    asyncio.run(write_baseline())
+    batch = [
+        entry("new-1", 2.0, fresh),
+        entry("chat", 1.0, chat_image, turns=2),
+        entry("new-2", 3.0, shared),
+        entry("chat", 1.0, chat_image, turns=3),
+    ]
+
+    crashed = subprocess.run(
+        [sys.executable, "-c", CRASHING_WRITER, str(tmp_path), point, json.dumps(batch)],
+        cwd=ROOT, env={**os.environ, "PYTHONPATH": ROOT}, capture_output=True
+    )
+    assert crashed.returncode == -9, crashed.stderr.decode()
+    slot_dir = tmp_path / "wb" / "slot-0"
+    leftovers = sorted(os.listdir(slot_dir))
+    if point == "journal":
+        # Died halfway through the segment, before it was renamed into place: nothing was acknowledged
+        assert len(leftovers) == 1 and leftovers[0].startswith(".tmp-")
+    else:
+        assert leftovers == ["segment-000000000001.jsonl"]
+
+    async def restart():
+        second = writer(tmp_path, image_store, history_store)
+        await second.start()
+        await second.stop()
+        return second.replayed
+
+    replayed = asyncio.run(restart())
+
+    assert not any(name.startswith("segment-") for name in os.listdir(slot_dir))
+    if point == "journal":
+        assert replayed == 0
+        assert history_store.count() == 1
+        assert history_store.get("chat")["turns"] == 1
+        assert (refcount(image_store, shared), refcount(image_store, fresh), refcount(image_store, chat_image)) == (0, 0, 1)
+    else:
+        assert replayed == len(batch)
+        assert history_store.count() == 3
+        assert history_store.get("chat")["turns"] == 3
+        assert (refcount(image_store, shared), refcount(image_store, fresh), refcount(image_store, chat_image)) == (1, 1, 1)
+
+
+def test_replaying_a_segment_twice_takes_no_extra_references(tmp_path):
+    image_store, history_store = stores(tmp_path)
+    record = image_store.put(b"x" * 100)
+    slot_dir = tmp_path / "slot-0"
+    slot_dir.mkdir()
+    segment = slot_dir / "segment-000000000001.jsonl"
+    contents = json.dumps(entry("a", 1.0, record)) + "\n"
+    replayer = writer(tmp_path, image_store, history_store)
+
+    segment.write_text(contents)
+    replayer.replay(str(slot_dir))
+    # As if the process died after applying the segment but before deleting it
+    segment.write_text(contents)
+    replayer.replay(str(slot_dir))
+
+    assert history_store.count() == 1
+    assert refcount(image_store, record) == 1
+    assert replayer.replayed == 2
+
+
+def test_corrupt_segment_is_set_aside(tmp_path):
+    image_store, history_store = stores(tmp_path)
+    record = image_store.put(b"x" * 100)
+    slot_dir = tmp_path / "slot-0"
+    slot_dir.mkdir()
+    (slot_dir / "segment-000000000001.jsonl").write_text('{"id": "broken", "created_')
+    (slot_dir / "segment-000000000002.jsonl").write_text(json.dumps(entry("a", 1.0, record)) + "\n")
+
+    writer(tmp_path, image_store, history_store).replay(str(slot_dir))
+
+    assert sorted(os.listdir(slot_dir)) == ["segment-000000000001.jsonl.corrupt"]
+    assert [found["id"] for found in history_store.query(limit=10)] == ["a"]
+    assert refcount(image_store, record) == 1
+
+
+class GatedHistoryStore(SQLiteHistoryStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.gate = threading.Event()
+
+    def add_many(self, entries, replace=True):
+        self.gate.wait(5)
+        return super().add_many(entries, replace)
+
+
+@pytest.mark.parametrize("ack", ["queued", "journaled", "applied"])
+def test_ack_level_decides_when_the_caller_is_released(tmp_path, ack):
+    image_store = ImageStore(LocalImageBackend(str(tmp_path / "images")), str(tmp_path / "index.db"))
+    history_store = GatedHistoryStore(str(tmp_path / "history.db"))
+    record = image_store.put(b"x" * 100)
+
+    async def run():
+        wb = writer(tmp_path, image_store, history_store, ack=ack)
+        await wb.start()
+        try:
+            add = asyncio.create_task(wb.add_history([entry("a", 1.0, record)]))
+            released = False
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if add.done():
+                    released = True
+                    break
+            segments = [name for name in os.listdir(tmp_path / "wb" / "slot-0") if name.startswith("segment-")]
+            applied = history_store.count()
+            history_store.gate.set()
+            await add
+        finally:
+            await wb.stop()
+        return released, segments, applied
+
+    released, segments, applied = asyncio.run(run())
+
+    # The store is held shut, so only "applied" is still waiting
+    assert released == (ack != "applied")
+    assert applied == 0
+    if ack != "queued":
+        assert segments == ["segment-000000000001.jsonl"]
+    assert history_store.count() == 1
+    assert refcount(image_store, record) == 1
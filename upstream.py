@@ -0,0 +1,357 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from io import BytesIO
+
+import httpx
+from google import genai
+from google.genai import errors, types
+
+from observability import record_stage, upstream_duration
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class GeminiBusyError(Exception):
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def parse_model_timeouts(value):
+    """Parse ``"model-a=90,model-b=30"`` into ``{"model-a": 90.0, "model-b": 30.0}``."""
+    timeouts = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            model, seconds = item.split("=", 1)
+            timeouts[model.strip()] = float(seconds)
+    return timeouts
+
+
+def is_transient(error):
+    if isinstance(error, errors.APIError):
+        return error.code in TRANSIENT_STATUS_CODES
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """Fail fast after repeated upstream failures.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    rejects calls for ``reset_timeout`` seconds; then a single trial call is
+    let through, and its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def cancel_trial(self):
+        """Give the trial back when its call ended without saying anything about the model."""
+        self.trial_in_flight = False
+
+
+class GeminiUpstream:
+    """Owns the Gemini client and every policy around calls to it.
+
+    One client (and so one pooled httpx transport) is shared by all requests.
+    Calls are bounded by a concurrency limit with a short waiting queue, get a
+    per-model timeout, are retried with jittered exponential backoff when the
+    error is transient, and are short-circuited by a per-model breaker. An
+    optional ``rate_limiter`` caps calls per window across every process
+    using the same API key; a call waits up to ``rate_limit_max_wait``
+    seconds for the next window before it is turned away as busy.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        base_url=None,
+        max_concurrency=8,
+        max_queue=32,
+        max_connections=20,
+        max_keepalive_connections=10,
+        keepalive_expiry=30.0,
+        http2=False,
+        default_timeout=60.0,
+        model_timeouts=None,
+        max_retries=2,
+        backoff_base=0.5,
+        backoff_max=8.0,
+        breaker_threshold=5,
+        breaker_reset=30.0,
+        rate_limiter=None,
+        rate_limit_max_wait=5.0
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.default_timeout = default_timeout
+        self.model_timeouts = model_timeouts or {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.max_queue = max_queue
+        self.rate_limiter = rate_limiter
+        self.rate_limit_max_wait = rate_limit_max_wait
+        self.rate_limit_key = hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+        self.waiting = 0
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._breakers = {}
+        self._client = None
+
+    def _build_client(self):
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+        client_args = {"limits": limits}
+        if self.http2:
+            client_args["http2"] = True
+        http_options = types.HttpOptions(
+            base_url=self.base_url,
+            # The SDK timeout is in milliseconds; per-model limits are enforced in generate_content
+            timeout=int(max([self.default_timeout, *self.model_timeouts.values()]) * 1000),
+            async_client_args=client_args
+        )
+        return genai.Client(api_key=self.api_key, http_options=http_options)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._build_client()
+        return self._client
+
+    async def start(self):
+        return self.client
+
+    async def close(self):
+        if self._client is None:
+            return
+        api_client = getattr(self._client, "_api_client", None)
+        async_httpx = getattr(api_client, "_async_httpx_client", None)
+        if async_httpx is not None:
+            await async_httpx.aclose()
+        self._client = None
+
+    def breaker(self, model):
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+        return self._breakers[model]
+
+    def timeout_for(self, model):
+        return self.model_timeouts.get(model, self.default_timeout)
+
+    def backoff(self, attempt):
+        # "Full jitter": a random delay up to the exponential cap spreads retries out
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _wait_for_rate_limit(self):
+        if self.rate_limiter is None:
+            return
+        while True:
+            wait = await asyncio.to_thread(self.rate_limiter.acquire, self.rate_limit_key)
+            if not wait:
+                return
+            if wait > self.rate_limit_max_wait:
+                raise GeminiBusyError("Gemini rate limit reached, please retry shortly", retry_after=max(1, round(wait)))
+            await asyncio.sleep(wait)
+
+    async def _acquire(self):
+        if self.waiting >= self.max_queue:
+            raise GeminiBusyError("Too many requests waiting for the model, please retry shortly")
+
+        self.waiting += 1
+        try:
+            await self._wait_for_rate_limit()
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def _observe(self, model, start, outcome):
+        elapsed = time.perf_counter() - start
+        upstream_duration.observe(elapsed, model=model, outcome=outcome)
+        record_stage("model", elapsed)
+
+    async def generate_content(self, model, **kwargs):
+        breaker = self.breaker(model)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(f"{model} is failing, not calling it for now")
+            # Set only when this call is the half-open trial; a call that ends busy, rate-limited
+            # or cancelled has no outcome to record, and must hand the trial back
+            trial = breaker.trial_in_flight
+            settled = False
+            try:
+                await self._acquire()
+                start = time.perf_counter()
+                try:
+                    response = await asyncio.wait_for(
+                        self.client.aio.models.generate_content(model=model, **kwargs),
+                        timeout=self.timeout_for(model)
+                    )
+                except Exception as e:
+                    self._observe(model, start, "transient_error" if is_transient(e) else "error")
+                    settled = True
+                    if is_transient(e):
+                        breaker.record_failure()
+                    else:
+                        # The model answered; a bad request says nothing about its health
+                        breaker.record_success()
+                    if not is_transient(e) or attempt >= self.max_retries:
+                        raise
+                    delay = self.backoff(attempt)
+                    logger.warning(f"Transient error from {model} ({str(e) or type(e).__name__}), retrying in {delay:.2f}s")
+                else:
+                    self._observe(model, start, "ok")
+                    settled = True
+                    breaker.record_success()
+                    return response
+                finally:
+                    self._release()
+            finally:
+                if trial and not settled:
+                    breaker.cancel_trial()
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def generate_content_stream(self, model, **kwargs):
+        """Yield response chunks as the model produces them.
+
+        The same breaker, concurrency limit and retries apply, but a call is
+        only retried if it failed before its first chunk; after that the
+        error goes to the caller. The model timeout bounds the wait for each
+        chunk rather than the whole reply.
+        """
+        breaker = self.breaker(model)
+        timeout = self.timeout_for(model)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(f"{model} is failing, not calling it for now")
+            trial = breaker.trial_in_flight
+            settled = False
+            try:
+                await self._acquire()
+                start = time.perf_counter()
+                started = False
+                try:
+                    stream = await asyncio.wait_for(
+                        self.client.aio.models.generate_content_stream(model=model, **kwargs),
+                        timeout=timeout
+                    )
+                    chunks = stream.__aiter__()
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                        except StopAsyncIteration:
+                            break
+                        if not started:
+                            started = True
+                            record_stage("model_first_chunk", time.perf_counter() - start)
+                        yield chunk
+                except (GeneratorExit, asyncio.CancelledError):
+                    # The caller went away; only a reply that had started says anything about the model
+                    if started:
+                        settled = True
+                        breaker.record_success()
+                    raise
+                except Exception as e:
+                    self._observe(model, start, "transient_error" if is_transient(e) else "error")
+                    settled = True
+                    if is_transient(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    if started or not is_transient(e) or attempt >= self.max_retries:
+                        raise
+                    delay = self.backoff(attempt)
+                    logger.warning(f"Transient error from {model} ({str(e) or type(e).__name__}), retrying in {delay:.2f}s")
+                else:
+                    self._observe(model, start, "ok")
+                    settled = True
+                    breaker.record_success()
+                    return
+                finally:
+                    self._release()
+            finally:
+                if trial and not settled:
+                    breaker.cancel_trial()
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def upload_file(self, data, mime_type):
+        """Upload ``data`` through the files API and return the SDK ``File``."""
+        await self._acquire()
+        try:
+            return await asyncio.wait_for(
+                self.client.aio.files.upload(file=BytesIO(data), config=types.UploadFileConfig(mime_type=mime_type)),
+                timeout=self.default_timeout
+            )
+        finally:
+            self._release()
+
+    async def delete_file(self, name):
+        await asyncio.wait_for(self.client.aio.files.delete(name=name), timeout=self.default_timeout)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "breakers": {model: breaker.state for model, breaker in self._breakers.items()},
+            "rate_limit": self.rate_limiter.stats() if self.rate_limiter is not None else None,
+        }
@@ -0,0 +1,351 @@
+"""Write-behind for generated images and history entries.
+
+Request handlers hand their writes to ``WriteBehind`` and carry on; one
+background task stores them in batches, off the event loop. Each batch is
+written in three steps:
+
+1. new images are stored (written to a temp name, then renamed into place)
+2. the batch's history entries go into a journal segment, the same way
+3. the entries are added to the history store in one ``add_many``
+
+A segment is deleted once the history store has made its entries durable,
+so the segments left after a crash are the writes that may be missing, and
+they are replayed on the next start. Replaying is idempotent: an entry takes
+its image references once, however often it is applied. Until an image is
+stored it is served from memory.
+
+``fsync`` decides when data is forced to disk: ``"always"`` for every batch,
+``"interval"`` every ``fsync_interval`` seconds, ``"never"`` only when the
+OS gets round to it (a crashed process loses nothing, a power cut can).
+``ack`` (for history) and ``image_ack`` decide when a caller is released:
+once its write is ``"queued"``, ``"journaled"`` or ``"applied"`` to the
+stores. Images default to ``"applied"``: a queued image exists only in the
+memory of the process that made it, so its URL would not work on other
+workers, nor at all if storing it failed. History defaults to
+``"journaled"``, so an acknowledged entry survives a crash.
+"""
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+import uuid
+
+from image_store import fsync_directory
+from retention import entry_image_names
+from shared_state import FileLock
+
+logger = logging.getLogger(__name__)
+
+ACK_LEVELS = ("queued", "journaled", "applied")
+FSYNC_POLICIES = ("never", "interval", "always")
+
+
+class _Write:
+    __slots__ = ("kind", "data", "filename", "size", "ack", "future")
+
+    def __init__(self, kind, data, filename=None, size=0, ack="queued"):
+        self.kind = kind
+        self.data = data
+        self.filename = filename
+        self.size = size
+        self.ack = ack
+        self.future = None
+
+
+class WriteBehind:
+    """Queue of image and history writes, flushed in batches by a background task.
+
+    At most ``max_pending`` writes (and ``max_pending_bytes`` of image data)
+    wait at a time; beyond that, callers wait for the writer to catch up.
+    Each process journals into its own ``slot-<n>`` directory under
+    ``directory``, held through a file lock; on start, slots no live process
+    holds are replayed.
+    """
+
+    def __init__(
+        self,
+        image_store,
+        history_store,
+        directory="write_behind",
+        ack="journaled",
+        image_ack="applied",
+        fsync="interval",
+        fsync_interval=1.0,
+        batch_size=64,
+        max_pending=256,
+        max_pending_bytes=256 * 1024 * 1024
+    ):
+        if ack not in ACK_LEVELS or image_ack not in ACK_LEVELS:
+            raise ValueError(f"ack must be one of: {', '.join(ACK_LEVELS)}")
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of: {', '.join(FSYNC_POLICIES)}")
+        self.image_store = image_store
+        self.history_store = history_store
+        self.directory = directory
+        self.ack = ack
+        self.image_ack = image_ack
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+        self.pending = 0
+        self.pending_bytes = 0
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.replayed = 0
+        self._submitted = 0
+        self._flushed = 0
+        self._queue = None
+        self._changed = None
+        self._tasks = []
+        self._slot_dir = None
+        self._slot_lock = None
+        self._seq = 0
+        self._lock = threading.Lock()
+        # Written since the last checkpoint, and so not yet known to be on disk
+        self._segments = []
+        self._unsynced_images = []
+
+    def _acquire_slot(self):
+        os.makedirs(self.directory, exist_ok=True)
+        slots = sorted(
+            int(name[5:]) for name in os.listdir(self.directory)
+            if name.startswith("slot-") and name[5:].isdigit()
+        )
+        for slot in range(max(slots, default=-1) + 2):
+            if self._slot_lock is not None and slot not in slots:
+                continue
+            lock = FileLock(os.path.join(self.directory, f"slot-{slot}.lock"))
+            if not lock.acquire():
+                continue
+            slot_dir = os.path.join(self.directory, f"slot-{slot}")
+            os.makedirs(slot_dir, exist_ok=True)
+            self.replay(slot_dir)
+            if self._slot_lock is None:
+                self._slot_lock = lock
+                self._slot_dir = slot_dir
+            else:
+                lock.release()
+
+    def replay(self, slot_dir):
+        """Apply the segments a process left behind in ``slot_dir``, oldest first, then delete them."""
+        segments = sorted(name for name in os.listdir(slot_dir) if name.startswith("segment-"))
+        replayed = []
+        for name in segments:
+            path = os.path.join(slot_dir, name)
+            try:
+                with open(path) as f:
+                    entries = [json.loads(line) for line in f if line.strip()]
+            except ValueError:
+                logger.exception(f"Could not read write-behind segment {path}, setting it aside")
+                os.replace(path, f"{path}.corrupt")
+                continue
+            self._apply(entries)
+            replayed.append(path)
+            self.replayed += len(entries)
+        if replayed:
+            self.history_store.sync()
+            for path in replayed:
+                os.remove(path)
+            logger.info(f"Replayed {len(replayed)} write-behind segments from {slot_dir}")
+
+    def _apply(self, entries):
+        # An entry takes its image references only the first time it is written, and the image index
+        # remembers that it did, so replaying a batch after a crash at any point counts it exactly once.
+        # References go first, so no stored entry ever points at an image the sweep may delete
+        seen = self.history_store.existing_ids({entry["id"] for entry in entries})
+        refs = {}
+        for entry in entries:
+            if entry["id"] not in seen:
+                refs.setdefault(entry["id"], entry_image_names(entry))
+        self.image_store.add_entry_refs(refs)
+        # Later versions of an entry (a chat transcript is rewritten after every turn) replace earlier ones
+        latest = {entry["id"]: entry for entry in entries}
+        self.history_store.add_many(list(latest.values()))
+
+    def _store_images(self, writes):
+        failed = []
+        for write in writes:
+            try:
+                self.image_store.put(write.data, fsync=self.fsync == "always")
+                if self.fsync == "interval":
+                    with self._lock:
+                        self._unsynced_images.append(write.filename)
+            except Exception as e:
+                logger.exception(f"Could not store image {write.filename}")
+                failed.append((write, e))
+            finally:
+                self.image_store.unstage(write.filename)
+        return failed
+
+    def _journal(self, entries):
+        if self._slot_dir is None:
+            return None
+        self._seq += 1
+        path = os.path.join(self._slot_dir, f"segment-{self._seq:012d}.jsonl")
+        tmp_path = os.path.join(self._slot_dir, f".tmp-{uuid.uuid4()}")
+        with open(tmp_path, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            if self.fsync == "always":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.fsync == "always":
+            fsync_directory(self._slot_dir)
+        return path
+
+    def _retire(self, segment):
+        if segment is None:
+            return
+        if self.fsync == "never":
+            os.remove(segment)
+        else:
+            with self._lock:
+                self._segments.append(segment)
+
+    def checkpoint(self):
+        """Force everything written so far to disk and drop the journal segments that covered it."""
+        with self._lock:
+            segments, self._segments = self._segments, []
+            images, self._unsynced_images = self._unsynced_images, []
+        if images:
+            self.image_store.sync(images)
+        self.history_store.sync()
+        for path in segments:
+            os.remove(path)
+
+    def _release(self, writes, level):
+        for write in writes:
+            if write.future is not None and not write.future.done() and ACK_LEVELS.index(write.ack) <= level:
+                write.future.set_result(None)
+
+    async def _flush(self, batch):
+        images = [write for write in batch if write.kind == "image"]
+        history = [write for write in batch if write.kind == "history"]
+        failed = []
+        try:
+            if images:
+                failed = await asyncio.to_thread(self._store_images, images)
+                for write, error in failed:
+                    if write.future is not None and not write.future.done():
+                        write.future.set_exception(error)
+                self._release(images, ACK_LEVELS.index("applied"))
+            if history:
+                entries = [entry for write in history for entry in write.data]
+                segment = await asyncio.to_thread(self._journal, entries)
+                self._release(history, ACK_LEVELS.index("journaled"))
+                await asyncio.to_thread(self._apply, entries)
+                self._retire(segment)
+                self._release(history, ACK_LEVELS.index("applied"))
+            self.batches += 1
+            self.written += len(batch) - len(failed)
+            self.failed += len(failed)
+        except Exception as e:
+            logger.exception(f"Write-behind batch of {len(batch)} writes failed")
+            self.failed += len(batch)
+            for write in batch:
+                if write.future is not None and not write.future.done():
+                    write.future.set_exception(e)
+
+    async def _submit(self, write):
+        if not self._tasks:
+            # Not started (e.g. outside the app's lifespan): write straight through
+            if write.ack != "queued":
+                write.future = asyncio.get_running_loop().create_future()
+            await self._flush([write])
+            if write.future is not None:
+                await write.future
+            return
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: not self.pending or (
+                    self.pending < self.max_pending and self.pending_bytes + write.size <= self.max_pending_bytes
+                )
+            )
+            self.pending += 1
+            self.pending_bytes += write.size
+            self._submitted += 1
+        if write.ack != "queued":
+            write.future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(write)
+        if write.future is not None:
+            await write.future
+
+    async def submit_image(self, image_bytes, ack=None):
+        """Queue an image for storing and return its record; until it is stored it is served from memory."""
+        record = self.image_store.stage(image_bytes)
+        await self._submit(_Write("image", image_bytes, record["filename"], len(image_bytes), ack or self.image_ack))
+        return record
+
+    async def add_history(self, entries, ack=None):
+        # Copied, since callers such as chat sessions keep changing their entry after it is queued
+        await self._submit(_Write("history", copy.deepcopy(list(entries)), ack=ack or self.ack))
+
+    async def barrier(self):
+        """Wait until every write queued so far has been applied, so a listing includes them."""
+        if not self._tasks:
+            return
+        target = self._submitted
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._flushed >= target)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._flush(batch)
+            async with self._changed:
+                self.pending -= len(batch)
+                self.pending_bytes -= sum(write.size for write in batch)
+                self._flushed += len(batch)
+                self._changed.notify_all()
+
+    async def _run_checkpoints(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await asyncio.to_thread(self.checkpoint)
+            except Exception:
+                logger.exception("Write-behind checkpoint failed")
+
+    async def start(self):
+        await asyncio.to_thread(self._acquire_slot)
+        self._queue = asyncio.Queue()
+        self._changed = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._run())]
+        if self.fsync != "never":
+            self._tasks.append(asyncio.create_task(self._run_checkpoints()))
+
+    async def stop(self):
+        if not self._tasks:
+            return
+        await self.barrier()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.to_thread(self.checkpoint)
+        if self._slot_lock is not None:
+            self._slot_lock.release()
+            self._slot_lock = None
+
+    def stats(self):
+        return {
+            "ack": self.ack,
+            "image_ack": self.image_ack,
+            "fsync": self.fsync,
+            "fsync_interval": self.fsync_interval,
+            "pending": self.pending,
+            "pending_bytes": self.pending_bytes,
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "replayed": self.replayed,
+            "average_batch": round(self.written / self.batches, 2) if self.batches else 0,
+        }